@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import metrics
+from config import (
+    ACTIONS_CHAT_BURST,
+    ACTIONS_CHAT_RATE,
+    ACTIONS_DRAIN_TIMEOUT,
+    ACTIONS_GLOBAL_BURST,
+    ACTIONS_GLOBAL_RATE,
+    ACTIONS_MAX_ATTEMPTS,
+    ACTIONS_NOTICE_BURST,
+    ACTIONS_NOTICE_RATE,
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_DELETE_BATCH = 100  # deleteMessages limit
+MAX_NOTICE_LENGTH = 4000
+IDLE_PRUNE_INTERVAL = 60
+
+actions_total = metrics.Counter("bot_actions_total", "Telegram API calls made by the action scheduler", ["action"])
+actions_merged = metrics.Counter("bot_actions_merged_total", "Queued actions folded into another call", ["action"])
+retry_after_total = metrics.Counter("bot_actions_retry_after_total", "429 Too Many Requests responses")
+
+
+def _consume_exception(fut: asyncio.Future):
+    # Most callers fire and forget; failures are already logged by the scheduler.
+    if not fut.cancelled():
+        fut.exception()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _ChatQueue:
+    __slots__ = ("deletes", "moderation", "notices", "bucket", "notice_bucket", "blocked_until", "busy")
+
+    def __init__(self):
+        self.deletes: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.moderation: Deque[Tuple[str, tuple, asyncio.Future, int]] = deque()
+        # (text, future, mergeable); a notice split out of a rejected batch goes alone.
+        self.notices: Deque[Tuple[str, asyncio.Future, bool]] = deque()
+        self.bucket = TokenBucket(ACTIONS_CHAT_RATE, ACTIONS_CHAT_BURST)
+        # Sending messages to a group has a much lower limit than moderation calls.
+        self.notice_bucket = TokenBucket(ACTIONS_NOTICE_RATE, ACTIONS_NOTICE_BURST)
+        self.blocked_until = 0.0
+        self.busy = False
+
+    def has_moderation(self) -> bool:
+        return bool(self.deletes or self.moderation)
+
+    def has_work(self) -> bool:
+        return bool(self.deletes or self.moderation or self.notices)
+
+    def next_bucket(self) -> TokenBucket:
+        return self.bucket if self.has_moderation() else self.notice_bucket
+
+
+class ActionScheduler:
+    # Outbound moderation queue. Each chat gets at most one call in flight, paced by
+    # per-chat (moderation and notice) and global token buckets; 429 retry_after pauses
+    # the chat and requeues.
+    # Pending deletions in a chat are merged into one deleteMessages call and pending
+    # notices into one message. Chats with deletions/bans are served before notice-only ones.
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._ready: "OrderedDict[int, None]" = OrderedDict()
+        self._global = TokenBucket(ACTIONS_GLOBAL_RATE, ACTIONS_GLOBAL_BURST)
+        self._wakeup = asyncio.Event()
+        self._inflight = set()
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = time.monotonic()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(q.deletes) + len(q.moderation) + len(q.notices) for q in self._chats.values())
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = ACTIONS_DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while (self._ready or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for q in self._chats.values():
+            futures = [fut for _, fut in q.deletes] + [fut for _, _, fut, _ in q.moderation] + [fut for _, fut, _ in q.notices]
+            for fut in futures:
+                if not fut.done():
+                    fut.cancel()
+        self._chats.clear()
+        self._ready.clear()
+
+    def _queue(self, chat_id: int) -> _ChatQueue:
+        q = self._chats.get(chat_id)
+        if q is None:
+            q = self._chats[chat_id] = _ChatQueue()
+        self._ready[chat_id] = None
+        self._wakeup.set()
+        return q
+
+    def _future(self) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_consume_exception)
+        return fut
+
+    def delete(self, chat_id: int, message_id: int) -> asyncio.Future:
+        fut = self._future()
+        self._queue(chat_id).deletes.append((message_id, fut))
+        return fut
+
+    def ban(self, chat_id: int, user_id: int, revoke_messages: bool = False) -> asyncio.Future:
+        fut = self._future()
+        self._queue(chat_id).moderation.append(("ban", (user_id, revoke_messages), fut, 0))
+        return fut
+
+    def restrict(self, chat_id: int, user_id: int, permissions: types.ChatPermissions) -> asyncio.Future:
+        fut = self._future()
+        self._queue(chat_id).moderation.append(("restrict", (user_id, permissions), fut, 0))
+        return fut
+
+    def notify(self, chat_id: int, text: str) -> asyncio.Future:
+        fut = self._future()
+        self._queue(chat_id).notices.append((text, fut, True))
+        return fut
+
+    async def _run(self):
+        while True:
+            next_wake = self._dispatch()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), next_wake)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self) -> Optional[float]:
+        now = time.monotonic()
+        next_wake: Optional[float] = None
+
+        def later(delay: float):
+            nonlocal next_wake
+            next_wake = delay if next_wake is None else min(next_wake, delay)
+
+        moderation_first = sorted(self._ready, key=lambda cid: not self._chats[cid].has_moderation())
+        for chat_id in moderation_first:
+            q = self._chats[chat_id]
+            if not q.has_work():
+                del self._ready[chat_id]
+                continue
+            if q.busy:
+                continue
+            bucket = q.next_bucket()
+            wait = max(q.blocked_until - now, bucket.wait_time(now))
+            if wait > 0:
+                later(wait)
+                continue
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                later(global_wait)
+                break
+
+            bucket.take(now)
+            self._global.take(now)
+            q.busy = True
+            self._ready.move_to_end(chat_id)
+            task = asyncio.create_task(self._execute(chat_id, q))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+        if now - self._last_prune > IDLE_PRUNE_INTERVAL:
+            self._last_prune = now
+            for chat_id in [cid for cid, q in self._chats.items()
+                            if cid not in self._ready and not q.busy
+                            and q.bucket.full(now) and q.notice_bucket.full(now)]:
+                del self._chats[chat_id]
+        return next_wake
+
+    async def _execute(self, chat_id: int, q: _ChatQueue):
+        try:
+            if q.deletes:
+                await self._delete_batch(chat_id, q)
+            elif q.moderation:
+                await self._moderate(chat_id, q)
+            elif q.notices:
+                await self._send_notices(chat_id, q)
+        finally:
+            q.busy = False
+            self._wakeup.set()
+
+    def _retry_later(self, chat_id: int, q: _ChatQueue, e: TelegramRetryAfter):
+        retry_after_total.inc()
+        q.blocked_until = time.monotonic() + e.retry_after
+        logger.warning("Flood control in chat %s, retrying in %s s", chat_id, e.retry_after)
+
+    async def _delete_batch(self, chat_id: int, q: _ChatQueue):
+        batch = [q.deletes.popleft() for _ in range(min(MAX_DELETE_BATCH, len(q.deletes)))]
+        message_ids = [message_id for message_id, _ in batch]
+        try:
+            if len(message_ids) == 1:
+                result = await self.bot.delete_message(chat_id, message_ids[0])
+            else:
+                result = await self.bot.delete_messages(chat_id, message_ids)
+                actions_merged.inc("delete", value=len(message_ids) - 1)
+            actions_total.inc("delete")
+        except TelegramRetryAfter as e:
+            self._retry_later(chat_id, q, e)
+            q.deletes.extendleft(reversed(batch))
+            return
+        except Exception as e:
+            logger.exception("Failed to delete %d message(s) in chat %s", len(batch), chat_id)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_result(result)
+
+    async def _moderate(self, chat_id: int, q: _ChatQueue):
+        action, args, fut, attempts = q.moderation.popleft()
+        try:
+            if action == "ban":
+                user_id, revoke_messages = args
+                result = await self.bot.ban_chat_member(chat_id, user_id, revoke_messages=revoke_messages or None)
+            else:
+                user_id, permissions = args
+                result = await self.bot.restrict_chat_member(chat_id, user_id, permissions=permissions)
+            actions_total.inc(action)
+        except TelegramRetryAfter as e:
+            self._retry_later(chat_id, q, e)
+            if attempts + 1 < ACTIONS_MAX_ATTEMPTS:
+                q.moderation.appendleft((action, args, fut, attempts + 1))
+            elif not fut.done():
+                fut.set_exception(e)
+            return
+        except Exception as e:
+            logger.exception("Failed to %s user %s in chat %s", action, args[0], chat_id)
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        if not fut.done():
+            fut.set_result(result)
+
+    async def _send_notices(self, chat_id: int, q: _ChatQueue):
+        batch: List[Tuple[str, asyncio.Future, bool]] = [q.notices.popleft()]
+        length = len(batch[0][0])
+        while batch[0][2] and q.notices and q.notices[0][2] and length + 2 + len(q.notices[0][0]) <= MAX_NOTICE_LENGTH:
+            item = q.notices.popleft()
+            length += 2 + len(item[0])
+            batch.append(item)
+        if len(batch) > 1:
+            actions_merged.inc("notice", value=len(batch) - 1)
+
+        # Notices are plain text that embeds user names, so no parse mode: one name with
+        # a stray "_" or "*" would otherwise make Telegram reject the whole merged batch.
+        try:
+            result = await self.bot.send_message(chat_id, "\n\n".join(text for text, _, _ in batch), parse_mode=None)
+            actions_total.inc("notice")
+        except TelegramRetryAfter as e:
+            self._retry_later(chat_id, q, e)
+            q.notices.extendleft(reversed(batch))
+            return
+        except Exception as e:
+            if isinstance(e, TelegramBadRequest) and len(batch) > 1:
+                # Keep one bad notice from taking the others with it: requeue them to be
+                # sent one by one, paced like any other notice.
+                logger.warning("Merged notice rejected in chat %s, requeueing %d notices separately", chat_id, len(batch))
+                q.notices.extendleft(reversed([(text, fut, False) for text, fut, _ in batch]))
+                return
+            logger.exception("Failed to send notice to chat %s", chat_id)
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for _, fut, _ in batch:
+            if not fut.done():
+                fut.set_result(result)
+
+actions = ActionScheduler()
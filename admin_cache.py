@@ -0,0 +1,58 @@
+import asyncio
+import time
+from typing import Dict, FrozenSet, Tuple
+
+from aiogram import Bot
+
+from config import ADMIN_CACHE_TTL
+
+ADMIN_STATUSES = ("creator", "administrator")
+
+
+class AdminCache:
+    # Per-chat set of administrator ids with a TTL. Concurrent lookups for the same chat
+    # share one getChatAdministrators request.
+    def __init__(self, ttl: float = ADMIN_CACHE_TTL):
+        self.ttl = ttl
+        self._entries: Dict[int, Tuple[float, FrozenSet[int]]] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self._generation: Dict[int, int] = {}
+
+    async def get_admins(self, bot: Bot, chat_id: int) -> FrozenSet[int]:
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        fut = self._inflight.get(chat_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = fut
+            fut.add_done_callback(lambda f: self._forget(chat_id, f))
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, bot: Bot, chat_id: int) -> FrozenSet[int]:
+        generation = self._generation.get(chat_id, 0)
+        admins = await bot.get_chat_administrators(chat_id)
+        ids = frozenset(a.user.id for a in admins)
+        # Don't store a result that raced with an invalidation.
+        if self._generation.get(chat_id, 0) == generation:
+            self._entries[chat_id] = (time.monotonic() + self.ttl, ids)
+        return ids
+
+    def _forget(self, chat_id: int, fut: asyncio.Future):
+        if self._inflight.get(chat_id) is fut:
+            del self._inflight[chat_id]
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+        self._generation[chat_id] = self._generation.get(chat_id, 0) + 1
+        self._inflight.pop(chat_id, None)
+
+
+def admin_status_changed(update) -> bool:
+    old_admin = update.old_chat_member.status in ADMIN_STATUSES
+    new_admin = update.new_chat_member.status in ADMIN_STATUSES
+    return old_admin or new_admin
+
+
+admin_cache = AdminCache()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceBatcher:
+    # Collects texts for up to max_wait_ms (or until max_size are pending) and scores
+    # them with a single vectorized call, so per-call sklearn overhead is paid per batch.
+    # Up to max_inflight batches are scored concurrently; while all slots are busy new
+    # texts keep accumulating, so batches grow with load.
+    def __init__(
+        self,
+        predict: Callable[[List[str]], Awaitable[Sequence[Optional[float]]]],
+        max_size: int = BATCH_MAX_SIZE,
+        max_wait_ms: float = BATCH_MAX_WAIT_MS,
+        max_inflight: int = 1,
+    ):
+        self.predict = predict
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_inflight = max(1, max_inflight)
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_inflight)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        pending, self._pending = self._pending, []
+        for _, fut in pending:
+            if not fut.done():
+                fut.cancel()
+
+    async def score(self, text: str) -> Optional[float]:
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((text, fut))
+        if len(self._pending) == 1:
+            self._wakeup.set()
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+        return await fut
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            if len(self._pending) < self.max_size and self.max_wait > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            await self._slots.acquire()
+
+            batch = self._pending[:self.max_size]
+            del self._pending[:self.max_size]
+            if self._pending:
+                self._wakeup.set()
+                if len(self._pending) >= self.max_size:
+                    self._full.set()
+
+            task = asyncio.create_task(self._process(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _process(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in batch]
+        try:
+            results = await self.predict(texts)
+        except Exception as e:
+            logger.exception("Batch prediction failed for %d texts", len(texts))
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
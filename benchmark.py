@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List
+
+import config
+
+BOT_ID = 1000
+ADMIN_ID = 1
+SPAM_TEXTS = [
+    "Заработок от 5000 рублей в день без вложений! Пиши в личку",
+    "Бесплатная крипта каждому, успей забрать бонус по ссылке в профиле",
+    "Казино с выводом на карту, бонус 200% новым игрокам https://t.me/casino_bonus_bot",
+]
+HAM_TEXTS = [
+    "Привет, как дела?",
+    "Завтра встречаемся в офисе в десять",
+    "Спасибо за ответ, вопрос решился",
+    "Кто-нибудь знает, во сколько начинается митап?",
+    "Скиньте, пожалуйста, ссылку на документацию",
+    "Отличная новость, поздравляю!",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "total_ms": sum(values) * 1000,
+    }
+
+
+def setup_environment(db_path: str):
+    # Must run before the bot modules are imported: they read config at import time.
+    if not config.BOT_TOKEN:
+        config.BOT_TOKEN = "123456:benchmark-token"
+    config.DB_PATH = db_path
+    config.VERDICT_CACHE_PATH = None
+    config.CAMPAIGN_INDEX_PATH = None
+    config.MODEL_WATCH_INTERVAL = 0
+    config.RETENTION_INTERVAL = 0
+
+
+def make_fake_session():
+    from aiogram import types
+    from aiogram.client.session.base import BaseSession
+
+    class FakeSession(BaseSession):
+        # Records Bot API calls instead of sending them and returns plausible results.
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] += 1
+            if name == "GetMe":
+                return types.User(id=BOT_ID, is_bot=True, first_name="bench", username="bench_bot")
+            if name == "GetChatAdministrators":
+                admin = types.User(id=ADMIN_ID, is_bot=False, first_name="admin")
+                return [types.ChatMemberOwner(user=admin, is_anonymous=False)]
+            if name in ("SendMessage", "EditMessageText"):
+                chat_id = getattr(method, "chat_id", None) or 0
+                return types.Message(
+                    message_id=random.randint(1, 2 ** 31),
+                    date=datetime.now(),
+                    chat=types.Chat(id=chat_id, type="supergroup"),
+                    text=getattr(method, "text", ""),
+                )
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+    return FakeSession()
+
+
+def build_updates(args) -> List[Dict]:
+    rng = random.Random(args.seed)
+    now = int(time.time())
+    chats = [-1000000000000 - i for i in range(args.chats)]
+    raw = []
+    update_id = 0
+
+    def message(chat_id, user_id, text, **extra):
+        nonlocal update_id
+        update_id += 1
+        data = {
+            "message_id": update_id,
+            "date": now,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        data.update(extra)
+        return {"update_id": update_id, "message": data}
+
+    for _ in range(args.messages):
+        chat_id = rng.choice(chats)
+        spam = rng.random() < args.spam_ratio
+        text = rng.choice(SPAM_TEXTS if spam else HAM_TEXTS)
+        if args.unique:
+            text = f"{text} {rng.randint(0, 10 ** 6)}"
+        raw.append(message(chat_id, rng.randint(100, 100 + args.users), text))
+
+    # A bot farm hitting the first chat: every account joins, then posts spam.
+    raiders = range(10 ** 6, 10 ** 6 + args.raid)
+    for user_id in raiders:
+        update_id += 1
+        raw.append({"update_id": update_id, "message": {
+            "message_id": update_id,
+            "date": now,
+            "chat": {"id": chats[0], "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"raider{user_id}"},
+            "new_chat_members": [{"id": user_id, "is_bot": False, "first_name": f"raider{user_id}"}],
+        }})
+    for _ in range(args.raid * args.raid_messages):
+        raw.append(message(chats[0], rng.choice(raiders), f"{rng.choice(SPAM_TEXTS)} {rng.randint(0, 10 ** 6)}"))
+
+    for _ in range(args.reports):
+        chat_id = rng.choice(chats)
+        original = message(chat_id, rng.randint(100, 100 + args.users), rng.choice(SPAM_TEXTS))["message"]
+        raw.append(message(chat_id, ADMIN_ID, "/report", reply_to_message=original))
+
+    for _ in range(args.stats):
+        raw.append(message(rng.choice(chats), ADMIN_ID, "/stats"))
+
+    for _ in range(args.callbacks):
+        update_id += 1
+        chat_id = rng.choice(chats)
+        raw.append({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"},
+                "chat_instance": str(chat_id),
+                "data": rng.choice(["threshold_weak", "threshold_normal", "threshold_high"]),
+                "message": {
+                    "message_id": update_id,
+                    "date": now,
+                    "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+                    "text": "threshold menu",
+                },
+            },
+        })
+
+    rng.shuffle(raw)
+    return raw
+
+
+def seed_reputation(raw_updates: List[Dict]):
+    # A mature community: every sender is already an established member.
+    from db import connect, init
+
+    init()
+    members = {
+        (update["message"]["chat"]["id"], update["message"]["from"]["id"])
+        for update in raw_updates if "message" in update
+    }
+    first_seen = int(time.time()) - config.TRUST_MIN_AGE - 1
+    conn = connect()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO reputation (chat_id, user_id, clean, first_seen) VALUES (?,?,?,?)",
+            [(chat_id, user_id, config.TRUST_MIN_MESSAGES, first_seen) for chat_id, user_id in members]
+        )
+    conn.close()
+
+
+async def run_benchmark(args) -> Dict:
+    import filters
+    import main
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    session = make_fake_session()
+    for middleware in main.bot.session.middleware:
+        session.middleware(middleware)
+    main.bot.session = session
+
+    handler_times: Dict[str, List[float]] = defaultdict(list)
+
+    async def timing_middleware(handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_times[name].append(time.perf_counter() - started)
+
+    main.dp.message.middleware(timing_middleware)
+    main.dp.callback_query.middleware(timing_middleware)
+
+    spam_filter_call = filters.SpamFilter.__call__
+
+    async def timed_spam_filter(self, message):
+        started = time.perf_counter()
+        try:
+            return await spam_filter_call(self, message)
+        finally:
+            handler_times["SpamFilter"].append(time.perf_counter() - started)
+
+    filters.SpamFilter.__call__ = timed_spam_filter
+
+    raw_updates = build_updates(args)
+    if args.mature:
+        seed_reputation(raw_updates)
+
+    started = time.perf_counter()
+    await main.on_startup()
+    if not args.cold:
+        await main.startup.ready.wait()
+    startup = time.perf_counter() - started
+
+    latencies: List[float] = []
+    rejected = 0
+
+    if args.webhook:
+        from aiohttp import ClientSession
+        from webhook import WebhookServer
+
+        async def process(bot, update):
+            update_started = time.perf_counter()
+            await main.dp.feed_raw_update(bot, update)
+            latencies.append(time.perf_counter() - update_started)
+
+        server = WebhookServer(
+            main.dp, main.bot, host="127.0.0.1", port=0, secret="benchmark",
+            max_concurrency=args.concurrency, queue_size=args.webhook_queue, process=process,
+        )
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}{server.path}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "benchmark"}
+        clients = asyncio.Semaphore(args.clients)
+
+        async def feed(http, update):
+            # Stand-in for Telegram: POST the update and redeliver it while the bot answers 503.
+            nonlocal rejected
+            async with clients:
+                while True:
+                    async with http.post(url, json=update, headers=headers) as response:
+                        if response.status != 503:
+                            return
+                    rejected += 1
+                    await asyncio.sleep(0.05)
+
+        async with ClientSession() as http:
+            for update in raw_updates[:args.warmup]:
+                await feed(http, update)
+            await server.handler.queue.join()
+            latencies.clear()
+            handler_times.clear()
+
+            measured = raw_updates[args.warmup:]
+            main.metrics.loop_monitor.max_lag = 0.0
+            started = time.perf_counter()
+            await asyncio.gather(*(feed(http, update) for update in measured))
+            await server.handler.queue.join()
+            elapsed = time.perf_counter() - started
+        await server.stop()
+    else:
+        from aiogram import types
+
+        updates = [types.Update.model_validate(data, context={"bot": main.bot}) for data in raw_updates]
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def feed(update):
+            async with semaphore:
+                update_started = time.perf_counter()
+                await main.dp.feed_update(main.bot, update)
+                latencies.append(time.perf_counter() - update_started)
+
+        # Warm up caches and pool workers outside the measured window.
+        for update in updates[:args.warmup]:
+            await feed(update)
+        latencies.clear()
+        handler_times.clear()
+
+        measured = updates[args.warmup:]
+        main.metrics.loop_monitor.max_lag = 0.0
+        started = time.perf_counter()
+        await asyncio.gather(*(feed(update) for update in measured))
+        elapsed = time.perf_counter() - started
+
+    max_loop_lag = main.metrics.loop_monitor.max_lag
+    first_update, ready_after = main.startup.first_update, main.startup.ready_after
+    await main.on_shutdown()
+
+    if args.metrics:
+        print(main.metrics.render())
+
+    return {
+        "updates": len(measured),
+        "elapsed_s": elapsed,
+        "updates_per_sec": len(measured) / elapsed if elapsed else 0.0,
+        "startup_s": startup,
+        "first_update_s": first_update,
+        "ready_s": ready_after,
+        "model_loaded": main.scorer.model_loaded,
+        "latency": summarize(latencies),
+        "handlers": {name: summarize(values) for name, values in sorted(handler_times.items())},
+        "api_calls": dict(session.calls),
+        "webhook_rejected": rejected,
+        "max_loop_lag_ms": max_loop_lag * 1000,
+        "trusted_skips": main.reputation.skipped,
+        "raids": main.raid.raids,
+    }
+
+
+def shard_worker_setup(db_path: str, index: int):
+    # Runs in each shard process (see sharding.ShardSupervisor): the same environment
+    # as the in-process benchmark, with the fake Bot API session.
+    setup_environment(db_path)
+    config.METRICS_PORT = 0
+    logging.getLogger().setLevel(logging.WARNING)
+    import main
+
+    main.bot.session = make_fake_session()
+
+
+async def run_sharded_benchmark(args, db_path: str) -> Dict:
+    # Feeds the synthetic updates through the sharded ingester path: routing by chat_id
+    # over IPC queues to worker processes. Only throughput is measured, since updates
+    # finish in other processes.
+    from db import init
+    from sharding import ShardSupervisor
+
+    init()
+    raw_updates = build_updates(args)
+    supervisor = ShardSupervisor(args.shards, setup=functools.partial(shard_worker_setup, db_path))
+
+    async def wait_processed(count: int):
+        while supervisor.total_processed < count:
+            await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    supervisor.start()
+    for update in raw_updates[:args.warmup]:
+        await supervisor.route(update)
+    await wait_processed(args.warmup)
+    startup = time.perf_counter() - started
+
+    measured = raw_updates[args.warmup:]
+    started = time.perf_counter()
+    for update in measured:
+        await supervisor.route(update)
+    await wait_processed(len(raw_updates))
+    elapsed = time.perf_counter() - started
+    per_shard = supervisor.processed[:]
+    await supervisor.stop()
+
+    return {
+        "updates": len(measured),
+        "elapsed_s": elapsed,
+        "updates_per_sec": len(measured) / elapsed if elapsed else 0.0,
+        "startup_s": startup,
+        "shards": per_shard,
+    }
+
+
+def print_report(result: Dict):
+    if "shards" in result:
+        print(f"Обработано апдейтов: {result['updates']} за {result['elapsed_s']:.2f} с "
+              f"({result['updates_per_sec']:.1f} апдейтов/с), запуск {result['startup_s']:.2f} с")
+        print("Апдейтов по шардам:", ", ".join(f"{i}={n}" for i, n in enumerate(result["shards"])))
+        return
+    latency = result["latency"]
+    print(f"Обработано апдейтов: {result['updates']} за {result['elapsed_s']:.2f} с "
+          f"({result['updates_per_sec']:.1f} апдейтов/с), модель загружена: {result['model_loaded']}")
+    print(f"Задержка: p50={latency['p50_ms']:.2f} мс p95={latency['p95_ms']:.2f} мс p99={latency['p99_ms']:.2f} мс, "
+          f"макс. блокировка event loop: {result['max_loop_lag_ms']:.2f} мс")
+    print(f"{'обработчик':<24}{'вызовов':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'всего мс':>12}")
+    for name, stats in result["handlers"].items():
+        print(f"{name:<24}{stats['count']:>10}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['total_ms']:>12.1f}")
+    if result["first_update_s"] is not None and result["ready_s"] is not None:
+        print(f"От старта процесса: первый апдейт через {result['first_update_s']:.2f} с, "
+              f"модель и кэши готовы через {result['ready_s']:.2f} с")
+    print("Вызовы Bot API:", ", ".join(f"{k}={v}" for k, v in sorted(result["api_calls"].items())))
+    if result["trusted_skips"]:
+        print(f"Сообщений доверенных участников без скоринга: {result['trusted_skips']}")
+    if result["raids"]:
+        print(f"Рейдов обнаружено: {result['raids']}")
+    if result["webhook_rejected"]:
+        print(f"Вебхук ответил 503 (перегрузка): {result['webhook_rejected']} раз")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline replay benchmark for the bot's update handling")
+    parser.add_argument("--messages", type=int, default=2000, help="group text messages")
+    parser.add_argument("--reports", type=int, default=50, help="/report replies from an admin")
+    parser.add_argument("--stats", type=int, default=50, help="/stats commands from an admin")
+    parser.add_argument("--callbacks", type=int, default=50, help="threshold_* callback presses")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--spam-ratio", type=float, default=0.1)
+    parser.add_argument("--mature", action="store_true", help="start with every sender already a trusted member")
+    parser.add_argument("--raid", type=int, default=0, help="accounts of a bot farm that join the first chat and spam it")
+    parser.add_argument("--no-raid-mode", action="store_true", help="disable raid detection (RAID_ENABLED)")
+    parser.add_argument("--raid-messages", type=int, default=3, help="spam messages per raid account")
+    parser.add_argument("--unique", action="store_true", help="make every text unique (defeats the verdict cache)")
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at once")
+    parser.add_argument("--webhook", action="store_true", help="POST updates to a local webhook server instead of feed_update")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent HTTP clients in --webhook mode")
+    parser.add_argument("--webhook-queue", type=int, default=1000, help="webhook queue size in --webhook mode")
+    parser.add_argument("--shards", type=int, default=0, help="route updates to this many shard processes (sharding.py)")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--cold", action="store_true", help="feed updates right after on_startup, while the model is still loading")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--metrics", action="store_true", help="print the Prometheus metrics after the run")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    parser.add_argument("--max-p99-ms", type=float, help="exit with status 1 if p99 latency is higher")
+    parser.add_argument("--min-throughput", type=float, help="exit with status 1 if updates/sec is lower")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_environment(os.path.join(tmp, "bench.db"))
+        if args.no_raid_mode:
+            config.RAID_ENABLED = False
+        if args.shards:
+            result = asyncio.run(run_sharded_benchmark(args, os.path.join(tmp, "bench.db")))
+        else:
+            result = asyncio.run(run_benchmark(args))
+
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+    failed = False
+    if args.max_p99_ms is not None and "latency" in result and result["latency"]["p99_ms"] > args.max_p99_ms:
+        print(f"p99 {result['latency']['p99_ms']:.2f} мс превышает {args.max_p99_ms} мс")
+        failed = True
+    if args.min_throughput is not None and result["updates_per_sec"] < args.min_throughput:
+        print(f"Пропускная способность {result['updates_per_sec']:.1f}/с ниже {args.min_throughput}/с")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from config import (
+    CALIBRATION_BINS,
+    CALIBRATION_CHUNK_SIZE,
+    CALIBRATION_DAYS,
+    CALIBRATION_INTERVAL,
+    CALIBRATION_MAX_THRESHOLD,
+    CALIBRATION_MIN_HAM,
+    CALIBRATION_MIN_SPAM,
+    CALIBRATION_MIN_THRESHOLD,
+    CALIBRATION_TARGET_FPR,
+    DB_PATH,
+)
+from actions import actions
+from db import text_hash
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Labels come only from what admins did: reported messages are spam, and logged
+# messages that were neither reported nor deleted by the bot are ham. The bot's own
+# deletions are left out: they are just the model's score against the threshold of the
+# time, and counting them as spam would make every pass suggest a lower threshold.
+# Scores are binned per chat, so memory depends on the number of chats, not rows.
+SELECT_REPORTS = (
+    "SELECT chat_id, spam_prob, message_text FROM reports "
+    "WHERE created_at >= datetime('now', ?) AND spam_prob IS NOT NULL"
+)
+SELECT_LOGS = (
+    "SELECT chat_id, spam_prob FROM ml_logs "
+    "WHERE created_at >= datetime('now', ?) AND spam_prob IS NOT NULL AND is_deleted = 0 "
+    "AND (text_hash IS NULL OR text_hash NOT IN (SELECT hash FROM temp.reported))"
+)
+CHAT_FILTER = " AND chat_id IN (SELECT chat_id FROM temp.calibration_chats)"
+
+
+class Curve:
+    # Confusion counts at every threshold k / bins: a message is flagged when its score
+    # is >= the threshold, so counts are reverse cumulative sums of the score histograms.
+    def __init__(self, spam_hist: np.ndarray, ham_hist: np.ndarray):
+        self.bins = len(spam_hist)
+        self.tp = np.cumsum(spam_hist[::-1])[::-1]
+        self.fp = np.cumsum(ham_hist[::-1])[::-1]
+        self.spam = int(spam_hist.sum())
+        self.ham = int(ham_hist.sum())
+
+    def _index(self, threshold: float) -> int:
+        return min(self.bins - 1, max(0, int(np.ceil(threshold * self.bins - 1e-9))))
+
+    def at(self, threshold: float) -> Tuple[float, float, float]:
+        # (precision, recall, false-positive rate)
+        k = self._index(threshold)
+        tp, fp = int(self.tp[k]), int(self.fp[k])
+        precision = tp / (tp + fp) if tp + fp else 1.0
+        recall = tp / self.spam if self.spam else 0.0
+        fpr = fp / self.ham if self.ham else 0.0
+        return precision, recall, fpr
+
+    def enough_data(self, min_spam: int = CALIBRATION_MIN_SPAM, min_ham: int = CALIBRATION_MIN_HAM) -> bool:
+        return self.spam >= min_spam and self.ham >= min_ham
+
+    def suggest(
+        self,
+        target_fpr: float = CALIBRATION_TARGET_FPR,
+        low: float = CALIBRATION_MIN_THRESHOLD,
+        high: float = CALIBRATION_MAX_THRESHOLD,
+        floor: Optional[float] = None,
+    ) -> Optional[float]:
+        # The lowest threshold (most recall) whose false-positive rate meets the target.
+        # Pass the chat's current threshold as floor: messages above it were deleted
+        # without a label, so the curve can't tell how much ham a lower threshold catches.
+        if not self.enough_data():
+            return None
+        if floor is not None:
+            low = min(high, max(low, floor))
+        fpr = self.fp / self.ham
+        ks = np.arange(self._index(low), self._index(high) + 1)
+        ok = ks[fpr[ks] <= target_fpr]
+        if not len(ok):
+            return high
+        return round(float(ok[0]) / self.bins, 3)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.execute("CREATE TEMP TABLE reported (hash BLOB PRIMARY KEY)")
+    conn.execute("CREATE TEMP TABLE calibration_chats (chat_id INTEGER PRIMARY KEY)")
+    return conn
+
+
+def _chunks(cursor: sqlite3.Cursor, size: int) -> Iterable[np.ndarray]:
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield np.array(rows, dtype=np.float64)
+
+
+def compute_curves(
+    chat_ids: Optional[Iterable[int]] = None,
+    days: int = CALIBRATION_DAYS,
+    path: str = DB_PATH,
+    bins: int = CALIBRATION_BINS,
+    chunk_size: int = CALIBRATION_CHUNK_SIZE,
+) -> Dict[int, Curve]:
+    # Blocking: run it in a thread. Uses its own read-only connection, so it never
+    # queues behind (or holds up) the storage thread.
+    conn = _connect(path)
+    window = f"-{days} days"
+    index: Dict[int, int] = {}
+    hist = np.zeros((0, 2, bins), dtype=np.int64)
+
+    def add(chunk: np.ndarray, labels: np.ndarray):
+        nonlocal hist
+        chats, inverse = np.unique(chunk[:, 0], return_inverse=True)
+        chat_list = chats.astype(np.int64).tolist()
+        for chat_id in chat_list:
+            index.setdefault(chat_id, len(index))
+        if len(index) > len(hist):
+            hist = np.concatenate([hist, np.zeros((len(index) - len(hist), 2, bins), dtype=np.int64)])
+        rows = np.array([index[chat_id] for chat_id in chat_list], dtype=np.int64)[inverse.ravel()]
+        scores = np.clip((chunk[:, 1] * bins).astype(np.int64), 0, bins - 1)
+        np.add.at(hist, (rows, labels.astype(np.int64), scores), 1)
+
+    try:
+        chat_filter = ""
+        if chat_ids is not None:
+            conn.executemany("INSERT OR IGNORE INTO temp.calibration_chats VALUES (?)", ((c,) for c in chat_ids))
+            chat_filter = CHAT_FILTER
+
+        cursor = conn.execute(SELECT_REPORTS + chat_filter, (window,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            conn.executemany(
+                "INSERT OR IGNORE INTO temp.reported VALUES (?)",
+                ((text_hash(text),) for _, _, text in rows if text)
+            )
+            chunk = np.array([(chat_id, prob) for chat_id, prob, _ in rows], dtype=np.float64)
+            add(chunk, np.ones(len(chunk)))
+
+        for chunk in _chunks(conn.execute(SELECT_LOGS + chat_filter, (window,)), chunk_size):
+            add(chunk, np.zeros(len(chunk)))
+    finally:
+        conn.close()
+    return {chat_id: Curve(hist[i, 1], hist[i, 0]) for chat_id, i in index.items()}
+
+
+class CalibrationJob:
+    # Every CALIBRATION_INTERVAL seconds, recomputes the curves of the chats this process
+    # has served (in sharded mode: the shard's own chats) in a worker thread, and moves
+    # the threshold of chats with auto_threshold on to the suggested value.
+    def __init__(self, interval: float = CALIBRATION_INTERVAL):
+        self.interval = interval
+        self.curves: Dict[int, Curve] = {}
+        self.updated = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Calibration pass failed")
+
+    async def run_once(self):
+        chat_ids = storage.cached_chats
+        if not chat_ids:
+            return
+        started = time.perf_counter()
+        self.curves = await asyncio.to_thread(compute_curves, chat_ids)
+        self.updated = time.time()
+        logger.info("Calibrated %d chats in %.2f s", len(self.curves), time.perf_counter() - started)
+
+        for chat_id, curve in self.curves.items():
+            settings = await storage.get_chat_settings(chat_id)
+            if not settings["auto_threshold"]:
+                continue
+            old = settings["threshold"]
+            # Only ever raised: see Curve.suggest().
+            suggested = curve.suggest(floor=old)
+            if suggested is None or suggested - old < 0.005:
+                continue
+            await storage.set_chat_field(chat_id, "threshold", suggested)
+            logger.info("Chat %s threshold %.3f -> %.3f (auto)", chat_id, old, suggested)
+            actions.notify(chat_id, f"🎯 Порог автоматически изменён: {old:g} → {suggested:g}.")
+
+    async def curve(self, chat_id: int) -> Curve:
+        # Serves /calibrate: the last scheduled result while it is fresh, otherwise an
+        # on-demand pass over just this chat's rows.
+        curve = self.curves.get(chat_id)
+        if curve is not None and (not self.interval or time.time() - self.updated < self.interval):
+            return curve
+        curves = await asyncio.to_thread(compute_curves, [chat_id])
+        empty = np.zeros(CALIBRATION_BINS, dtype=np.int64)
+        return curves.get(chat_id) or Curve(empty, empty)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+calibration_job = CalibrationJob()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precision/recall/FPR curves and suggested thresholds from ml_logs and reports")
+    parser.add_argument("--chat", type=int, action="append", help="only these chats (repeatable)")
+    parser.add_argument("--days", type=int, default=CALIBRATION_DAYS)
+    parser.add_argument("--target-fpr", type=float, default=CALIBRATION_TARGET_FPR)
+    parser.add_argument("--floor", type=float, help="current threshold; suggestions never go below it")
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    curves = compute_curves(args.chat, args.days, args.db)
+    elapsed = time.perf_counter() - started
+    rows = sum(curve.spam + curve.ham for curve in curves.values())
+    print(f"{len(curves)} chats, {rows} labelled rows in {elapsed:.2f} s")
+    for chat_id, curve in sorted(curves.items()):
+        suggested = curve.suggest(args.target_fpr, floor=args.floor)
+        print(f"\nchat {chat_id}: spam={curve.spam} ham={curve.ham} suggested={suggested}")
+        for threshold in (0.5, 0.7, 0.8, 0.9, 0.95, 0.99):
+            precision, recall, fpr = curve.at(threshold)
+            print(f"  {threshold:.2f}  precision={precision:.3f} recall={recall:.3f} fpr={fpr:.4f}")
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import (
+    CAMPAIGN_INDEX_PATH,
+    CAMPAIGN_MAX_AGE,
+    CAMPAIGN_MAX_SIZE,
+    CAMPAIGN_MIN_LENGTH,
+    CAMPAIGN_PENDING_SIZE,
+    CAMPAIGN_REPORT_MIN_CHATS,
+    CAMPAIGN_SAVE_EVERY,
+    CAMPAIGN_SIMILARITY,
+)
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+_PRIME = np.uint64(4294967311)
+
+# Fixed seed: persisted signatures must stay comparable across restarts.
+_rng = np.random.RandomState(20240601)
+_A = _rng.randint(1, 2 ** 31 - 1, size=(NUM_PERM, 1)).astype(np.uint64)
+_B = _rng.randint(0, 2 ** 31 - 1, size=(NUM_PERM, 1)).astype(np.uint64)
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def signature(text: str) -> Optional[np.ndarray]:
+    text = normalize(text)
+    if len(text) < CAMPAIGN_MIN_LENGTH:
+        return None
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((_A * hashes + _B) % _PRIME).min(axis=1)
+
+
+class CampaignIndex:
+    # MinHash LSH index over character shingles of recently confirmed spam. A message whose
+    # estimated Jaccard similarity to an indexed one reaches `similarity` is a campaign copy.
+    def __init__(
+        self,
+        similarity: float = CAMPAIGN_SIMILARITY,
+        max_size: int = CAMPAIGN_MAX_SIZE,
+        max_age: float = CAMPAIGN_MAX_AGE,
+        path: Optional[str] = CAMPAIGN_INDEX_PATH,
+    ):
+        self.similarity = similarity
+        self.max_size = max_size
+        self.max_age = max_age
+        self.path = path
+        self.matches = 0
+        self._next_id = 0
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._buckets: List[Dict[bytes, Set[int]]] = [{} for _ in range(BANDS)]
+        self._unsaved = 0
+        # One background save at a time (a request made meanwhile runs after it), and
+        # the lock keeps it from racing the final save() on the shared tmp file.
+        self._saving: Optional[asyncio.Future] = None
+        self._save_again = False
+        self._write_lock = threading.Lock()
+        # Reported texts not yet in the index, and the chats each was reported in.
+        self._pending: Optional["CampaignIndex"] = None
+        self._report_chats: Dict[int, Set[int]] = {}
+        # Called with ("add", sig, None) for every new entry and ("report", sig, chat_id)
+        # for every nomination; sharding.py relays these to the other shards' apply().
+        self.listener: Optional[Callable[[Tuple[str, list, Optional[int]]], None]] = None
+        # Until load_async() finishes (if cancelled, for good) saving would overwrite
+        # the file with a partial index.
+        self.loading = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _bands(self, sig: np.ndarray):
+        for band in range(BANDS):
+            yield band, sig[band * ROWS:(band + 1) * ROWS].tobytes()
+
+    def _best_match(self, sig: np.ndarray):
+        now = time.time()
+        candidates = set()
+        for band, key in self._bands(sig):
+            ids = self._buckets[band].get(key)
+            if ids:
+                candidates.update(ids)
+
+        best_id, best_sim = None, 0.0
+        for entry_id in candidates:
+            cand_sig, added = self._entries[entry_id]
+            if now - added > self.max_age:
+                continue
+            sim = float(np.count_nonzero(cand_sig == sig)) / NUM_PERM
+            if sim > best_sim:
+                best_id, best_sim = entry_id, sim
+        return best_id, best_sim
+
+    def match(self, text: str) -> Optional[float]:
+        if not self._entries:
+            return None
+        sig = signature(text)
+        if sig is None:
+            return None
+        _, sim = self._best_match(sig)
+        if sim >= self.similarity:
+            self.matches += 1
+            return sim
+        return None
+
+    def nominate(self, text: str, chat_id: int, min_chats: int = CAMPAIGN_REPORT_MIN_CHATS) -> bool:
+        # Records a /report of text in chat_id. True once near copies of it were reported
+        # in min_chats different chats, so one admin can't push a text into every chat.
+        sig = signature(text)
+        if sig is None:
+            return False
+        if self.listener is not None:
+            self.listener(("report", sig.tolist(), chat_id))
+        return self._record_report(sig, chat_id, min_chats)
+
+    def _record_report(self, sig: np.ndarray, chat_id: int, min_chats: int = CAMPAIGN_REPORT_MIN_CHATS) -> bool:
+        if self._pending is None:
+            self._pending = CampaignIndex(self.similarity, CAMPAIGN_PENDING_SIZE, self.max_age, None)
+        pending = self._pending
+        entry_id, sim = pending._best_match(sig)
+        if entry_id is None or sim < self.similarity:
+            entry_id = pending._next_id
+            pending._insert(sig, time.time())
+            pending._evict()
+            if len(self._report_chats) > 2 * CAMPAIGN_PENDING_SIZE:
+                self._report_chats = {i: c for i, c in self._report_chats.items() if i in pending._entries}
+        chats = self._report_chats.setdefault(entry_id, set())
+        chats.add(chat_id)
+        if len(chats) < min_chats:
+            return False
+        if entry_id in pending._entries:
+            pending._remove(entry_id)
+        del self._report_chats[entry_id]
+        return True
+
+    def add(self, text: str):
+        sig = signature(text)
+        if sig is not None:
+            self._add(sig, notify=True)
+
+    def apply(self, event: Tuple[str, list, Optional[int]]):
+        # An add or report relayed from another shard; not relayed again.
+        kind, sig, chat_id = event
+        sig = np.asarray(sig, dtype=np.uint64)
+        if kind == "add" or self._record_report(sig, chat_id):
+            self._add(sig, notify=False)
+
+    def _add(self, sig: np.ndarray, notify: bool):
+        entry_id, sim = self._best_match(sig)
+        if entry_id is not None and sim >= self.similarity:
+            # Known variant: just refresh its age.
+            self._entries[entry_id] = (self._entries[entry_id][0], time.time())
+            self._entries.move_to_end(entry_id)
+            return
+
+        self._insert(sig, time.time())
+        self._evict()
+        if notify and self.listener is not None:
+            self.listener(("add", sig.tolist(), None))
+        self._unsaved += 1
+        if self.path and not self.loading and self._unsaved >= CAMPAIGN_SAVE_EVERY:
+            self.schedule_save()
+
+    def _insert(self, sig: np.ndarray, added: float):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (sig, added)
+        for band, key in self._bands(sig):
+            self._buckets[band].setdefault(key, set()).add(entry_id)
+
+    def _remove(self, entry_id: int):
+        sig, _ = self._entries.pop(entry_id)
+        for band, key in self._bands(sig):
+            ids = self._buckets[band].get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._buckets[band][key]
+
+    def _evict(self):
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            oldest_id, (_, added) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and added >= cutoff:
+                break
+            self._remove(oldest_id)
+
+    def _snapshot(self):
+        if not self._entries:
+            return np.empty((0, NUM_PERM), dtype=np.uint64), np.empty(0)
+        sigs, added = zip(*self._entries.values())
+        return np.stack(sigs), np.array(added)
+
+    def _write(self, sigs: np.ndarray, added: np.ndarray):
+        tmp_path = self.path + ".tmp.npz"
+        with self._write_lock:
+            try:
+                np.savez(tmp_path, sigs=sigs, added=added)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                logger.exception("Failed to save campaign index to %s", self.path)
+
+    def schedule_save(self):
+        self._unsaved = 0
+        if self._saving is not None and not self._saving.done():
+            self._save_again = True
+            return
+        sigs, added = self._snapshot()
+        self._saving = asyncio.get_running_loop().run_in_executor(None, self._write, sigs, added)
+        self._saving.add_done_callback(self._saved)
+
+    def _saved(self, _: asyncio.Future):
+        if self._save_again:
+            self._save_again = False
+            self.schedule_save()
+
+    def save(self):
+        if not self.path or self.loading:
+            return
+        self._unsaved = 0
+        self._write(*self._snapshot())
+        logger.info("Campaign index saved: %d entries (matches=%d)", len(self._entries), self.matches)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                sigs, added = data["sigs"], data["added"]
+            for sig, ts in zip(sigs, added):
+                self._insert(sig, float(ts))
+            self._evict()
+            logger.info("Campaign index loaded: %d entries from %s", len(self._entries), self.path)
+        except Exception:
+            logger.exception("Failed to load campaign index from %s", self.path)
+
+    async def load_async(self):
+        # Builds the index from disk off the event loop, then swaps it in with the
+        # entries added while it loaded appended as the newest.
+        loaded = CampaignIndex(self.similarity, self.max_size, self.max_age, self.path)
+        self.loading = True
+        await asyncio.to_thread(loaded.load)
+        for sig, added in self._entries.values():
+            loaded._insert(sig, added)
+        loaded._evict()
+        self._entries, self._buckets, self._next_id = loaded._entries, loaded._buckets, loaded._next_id
+        self.loading = False
+
+
+campaign_index = CampaignIndex()
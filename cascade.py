@@ -0,0 +1,77 @@
+import math
+import re
+import zlib
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+import numpy as np
+
+from config import CASCADE_HIGH, CASCADE_LOW, CASCADE_PATH
+
+# First stage of the cascade: hashed unigram presence features plus two link/mention
+# signals, scored by a linear model in a few microseconds. Messages it is sure about
+# (below CASCADE_LOW or above CASCADE_HIGH) never reach the TF-IDF pipeline.
+N_FEATURES = 2 ** 18
+TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")
+URL_RE = re.compile(r"https?://|t\.me/|www\.")
+MENTION_RE = re.compile(r"@\w{4,}")
+
+
+def features(text: str) -> Set[int]:
+    lowered = text.lower()
+    tokens = set(TOKEN_RE.findall(lowered))
+    if URL_RE.search(lowered):
+        tokens.add("__url__")
+    if MENTION_RE.search(lowered):
+        tokens.add("__mention__")
+    return {zlib.crc32(token.encode("utf-8")) % N_FEATURES for token in tokens}
+
+
+def feature_matrix(texts: Iterable[str]):
+    from scipy.sparse import csr_matrix
+
+    indices: List[int] = []
+    indptr = [0]
+    for text in texts:
+        indices.extend(sorted(features(text)))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float64)
+    return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, N_FEATURES))
+
+
+def train_prescreen(texts: Sequence[str], labels: Sequence[int]) -> Tuple[np.ndarray, float]:
+    from sklearn.linear_model import LogisticRegression
+
+    clf = LogisticRegression(solver="liblinear")
+    clf.fit(feature_matrix(texts), labels)
+    return clf.coef_[0].astype("<f8"), float(clf.intercept_[0])
+
+
+def save_prescreen(weights: np.ndarray, intercept: float, path: str = CASCADE_PATH):
+    # Only features seen in training have non-zero weights, so the file keeps just those.
+    indices = np.flatnonzero(weights).astype("<i8")
+    with open(path, "wb") as f:
+        np.savez(f, indices=indices, weights=weights[indices], intercept=np.float64(intercept))
+
+
+class Prescreen:
+    def __init__(self, path: str = CASCADE_PATH, low: float = CASCADE_LOW, high: float = CASCADE_HIGH):
+        with np.load(path, allow_pickle=False) as data:
+            indices, weights = data["indices"], data["weights"]
+            self.intercept = float(data["intercept"])
+        if len(indices) != len(weights) or (len(indices) and not 0 <= indices.min() <= indices.max() < N_FEATURES):
+            raise ValueError(f"{path}: malformed pre-screen weights")
+        # A plain dict: scoring one short text is a handful of lookups, cheaper than numpy.
+        self.weights: Dict[int, float] = dict(zip(indices.tolist(), weights.tolist()))
+        self.low = low
+        self.high = high
+
+    def score(self, text: str) -> float:
+        weights = self.weights
+        z = self.intercept + sum(weights.get(index, 0.0) for index in features(text))
+        if z < 0:
+            e = math.exp(z)
+            return e / (1.0 + e)
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def decided(self, prob: float) -> bool:
+        return prob < self.low or prob > self.high
@@ -0,0 +1,143 @@
+import json
+import math
+import re
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+from config import COMPILED_MODEL_PATH, MODEL_PATH
+
+# File layout: MAGIC, uint64 header length, JSON header (padded to 8 bytes),
+# float64 idf[n], float64 coef[n], then the vocabulary as "\n"-joined UTF-8 terms.
+MAGIC = b"SPAMTFLR"
+_ALIGN = 8
+
+
+def _word_ngrams(tokens: List[str], min_n: int, max_n: int) -> List[str]:
+    # Same n-gram expansion as sklearn's VectorizerMixin._word_ngrams.
+    if max_n == 1:
+        return tokens
+    original = tokens
+    if min_n == 1:
+        tokens = list(original)
+        min_n += 1
+    else:
+        tokens = []
+    n_original = len(original)
+    for n in range(min_n, min(max_n + 1, n_original + 1)):
+        for i in range(n_original - n + 1):
+            tokens.append(" ".join(original[i:i + n]))
+    return tokens
+
+
+def export_compiled(pipeline, path: str = COMPILED_MODEL_PATH):
+    tfidf = pipeline.named_steps["tfidf"]
+    clf = pipeline.named_steps["clf"]
+
+    unsupported = (
+        tfidf.analyzer != "word"
+        or tfidf.preprocessor is not None
+        or tfidf.tokenizer is not None
+        or tfidf.strip_accents is not None
+        or tfidf.stop_words is not None
+        or tfidf.binary
+        or tfidf.sublinear_tf
+        or tfidf.norm not in ("l2", None)
+        or len(clf.classes_) != 2
+    )
+    if unsupported:
+        raise ValueError("Pipeline uses TfidfVectorizer/LogisticRegression options the compiled scorer does not support")
+
+    terms = [None] * len(tfidf.vocabulary_)
+    for term, index in tfidf.vocabulary_.items():
+        terms[index] = term
+    if any("\n" in term for term in terms):
+        raise ValueError("Vocabulary terms must not contain newlines")
+
+    idf = np.asarray(tfidf.idf_ if tfidf.use_idf else np.ones(len(terms)), dtype="<f8")
+    coef = np.asarray(clf.coef_[0], dtype="<f8")
+    header = json.dumps({
+        "n_terms": len(terms),
+        "intercept": float(clf.intercept_[0]),
+        "lowercase": bool(tfidf.lowercase),
+        "token_pattern": tfidf.token_pattern,
+        "ngram_range": list(tfidf.ngram_range),
+        "norm": tfidf.norm,
+    }).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % _ALIGN)
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(idf.tobytes())
+        f.write(coef.tobytes())
+        f.write("\n".join(terms).encode("utf-8"))
+
+
+class CompiledScorer:
+    # TF-IDF + logistic regression scoring in a single pass over the message's n-grams.
+    # Exposes predict_proba/predict so it can stand in for the sklearn Pipeline.
+    def __init__(self, path: str = COMPILED_MODEL_PATH):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a compiled spam model")
+            header_len = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            header = json.loads(f.read(header_len))
+
+        n = header["n_terms"]
+        offset = len(MAGIC) + 8 + header_len
+        arrays = np.memmap(path, dtype="<f8", mode="r", offset=offset, shape=(2, n))
+        self.idf = arrays[0]
+        self.coef = arrays[1]
+        with open(path, "rb") as f:
+            f.seek(offset + arrays.nbytes)
+            terms = f.read().decode("utf-8").split("\n") if n else []
+        self.vocabulary: Dict[str, int] = dict(zip(terms, range(n)))
+
+        self.intercept = header["intercept"]
+        self.lowercase = header["lowercase"]
+        self.token_re = re.compile(header["token_pattern"])
+        self.min_n, self.max_n = header["ngram_range"]
+        self.norm = header["norm"]
+
+    def score(self, text: str) -> float:
+        if self.lowercase:
+            text = text.lower()
+        counts: Dict[int, int] = {}
+        vocabulary = self.vocabulary
+        for gram in _word_ngrams(self.token_re.findall(text), self.min_n, self.max_n):
+            index = vocabulary.get(gram)
+            if index is not None:
+                counts[index] = counts.get(index, 0) + 1
+
+        z = self.intercept
+        if counts:
+            indices = np.fromiter(counts.keys(), dtype=np.intp, count=len(counts))
+            x = np.fromiter(counts.values(), dtype=np.float64, count=len(counts)) * self.idf[indices]
+            dot = float(x @ self.coef[indices])
+            if self.norm == "l2":
+                dot /= math.sqrt(float(x @ x))
+            z += dot
+
+        if z >= 0:
+            return 1.0 / (1.0 + math.exp(-z))
+        e = math.exp(z)
+        return e / (1.0 + e)
+
+    def predict_proba(self, texts: List[str]) -> np.ndarray:
+        spam = np.array([self.score(text) for text in texts], dtype=np.float64)
+        return np.column_stack((1.0 - spam, spam))
+
+    def predict(self, texts: List[str]) -> np.ndarray:
+        return (self.predict_proba(texts)[:, 1] > 0.5).astype(int)
+
+
+if __name__ == "__main__":
+    import joblib
+
+    source = sys.argv[1] if len(sys.argv) > 1 else MODEL_PATH
+    target = sys.argv[2] if len(sys.argv) > 2 else COMPILED_MODEL_PATH
+    export_compiled(joblib.load(source), target)
+    print(f"Скомпилированная модель сохранена в файл: {target}")
@@ -1,13 +1,156 @@
-BOT_TOKEN = ""
-
-MODEL_PATH = "spam_detector_model.pkl"
-
-THRESHOLDS = {
-    "weak": 0.8,
-    "normal": 0.9,
-    "high": 0.95
-}
-
-DEFAULT_MAX_WARNINGS = 3
-
-DEFAULT_PUNISHMENT = "ban"
+import os
+
+BOT_TOKEN = ""
+
+MODEL_PATH = "spam_detector_model.pkl"
+COMPILED_MODEL_PATH = "spam_detector_model.bin"
+CASCADE_PATH = "spam_prescreen.npz"
+
+DB_PATH = "bot.db"
+SQLITE_SYNCHRONOUS = "NORMAL"
+
+THRESHOLDS = {
+    "weak": 0.8,
+    "normal": 0.9,
+    "high": 0.95
+}
+
+DEFAULT_MAX_WARNINGS = 3
+
+DEFAULT_PUNISHMENT = "ban"
+
+# A chat's warnings drop by one per warn_decay seconds (0 never expires them). This is
+# the default for new chats; admins change it with /warn_decay.
+DEFAULT_WARN_DECAY = 7 * 24 * 3600
+WARNINGS_FLUSH_INTERVAL = 5
+WARNINGS_PURGE_INTERVAL = 3600
+# Like the reputation store: chats idle for WARNINGS_IDLE_TTL seconds, or beyond
+# WARNINGS_MAX_CHATS, are dropped from memory and reloaded on their next warning.
+WARNINGS_IDLE_TTL = 3600
+WARNINGS_MAX_CHATS = 5000
+
+BATCH_MAX_SIZE = 64
+BATCH_MAX_WAIT_MS = 10
+
+SCORING_WORKERS = os.cpu_count() or 1
+MODEL_WATCH_INTERVAL = 5
+# Pre-screen scores outside [CASCADE_LOW, CASCADE_HIGH] are final; the band must
+# contain every value in THRESHOLDS and RAID_THRESHOLD.
+CASCADE_LOW = 0.05
+CASCADE_HIGH = 0.99
+
+# Group messages that need the model before it has loaded: "queue" waits up to
+# STARTUP_WAIT_TIMEOUT for it, "defer" (and a queue timeout) keeps up to
+# STARTUP_DEFER_LIMIT messages and scores them once it is ready.
+STARTUP_POLICY = "queue"  # queue | defer
+STARTUP_WAIT_TIMEOUT = 30
+STARTUP_DEFER_LIMIT = 10000
+
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL_MS = 1000
+
+ADMIN_CACHE_TTL = 300
+
+BANNED_PAGE_SIZE = 20
+BANNED_EXPORT_FETCH_SIZE = 1000
+
+VERDICT_CACHE_SIZE = 100000
+VERDICT_CACHE_TTL = 3600
+VERDICT_CACHE_PATH = "verdict_cache.bin"
+
+CAMPAIGN_INDEX_PATH = "campaign_index.npz"
+CAMPAIGN_SIMILARITY = 0.8
+CAMPAIGN_MIN_LENGTH = 20
+CAMPAIGN_MAX_SIZE = 20000
+CAMPAIGN_MAX_AGE = 7 * 24 * 3600
+CAMPAIGN_SAVE_EVERY = 50
+# A match counts as spam in every chat, so the index only learns from model scores at
+# least this high (above every preset and calibrated threshold), never from its own
+# matches, and from /report only once near copies of the text were reported in
+# CAMPAIGN_REPORT_MIN_CHATS different chats (up to CAMPAIGN_PENDING_SIZE texts wait).
+CAMPAIGN_MIN_PROB = 0.99
+CAMPAIGN_REPORT_MIN_CHATS = 2
+CAMPAIGN_PENDING_SIZE = 5000
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+SLOW_UPDATE_MS = 1000
+TRACE_SAMPLE_RATE = 0.0
+LOOP_LAG_INTERVAL = 0.05
+
+RUN_MODE = "polling"  # polling | webhook
+WEBHOOK_URL = ""
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = ""
+WEBHOOK_MAX_CONCURRENCY = 64
+WEBHOOK_QUEUE_SIZE = 1000
+
+ACTIONS_GLOBAL_RATE = 25
+ACTIONS_GLOBAL_BURST = 30
+ACTIONS_CHAT_RATE = 5
+ACTIONS_CHAT_BURST = 10
+ACTIONS_NOTICE_RATE = 20 / 60
+ACTIONS_NOTICE_BURST = 3
+ACTIONS_MAX_ATTEMPTS = 5
+ACTIONS_DRAIN_TIMEOUT = 10
+
+# Members with at least TRUST_MIN_MESSAGES clean messages, first seen TRUST_MIN_AGE
+# seconds ago, skip the model unless their message has links or mentions.
+TRUST_ENABLED = True
+TRUST_MIN_MESSAGES = 50
+TRUST_MIN_AGE = 3 * 24 * 3600
+REPUTATION_FLUSH_INTERVAL = 30
+# Chats' members are dropped from memory (they stay in the database and are reloaded on
+# the chat's next message) after REPUTATION_IDLE_TTL seconds without messages, or when
+# more than REPUTATION_MAX_CHATS chats are held, least recently active first.
+REPUTATION_IDLE_TTL = 3600
+REPUTATION_MAX_CHATS = 5000
+
+# A chat enters raid mode when RAID_MIN_FLAGGED spam messages or RAID_MIN_JOINS joins
+# arrive within RAID_WINDOW seconds, and leaves it after RAID_QUIET calm seconds. In raid
+# mode the threshold is at most RAID_THRESHOLD and offenders are punished on first hit.
+RAID_ENABLED = True
+RAID_WINDOW = 30
+RAID_MIN_FLAGGED = 8
+RAID_MIN_JOINS = 20
+RAID_QUIET = 120
+RAID_THRESHOLD = 0.7
+RAID_CHECK_INTERVAL = 1.0
+
+# Threshold calibration from ml_logs scores and admin actions (calibration.py). Every
+# CALIBRATION_INTERVAL seconds (0 disables) chats with auto_threshold on get the lowest
+# threshold whose false-positive rate over the last CALIBRATION_DAYS is at most
+# CALIBRATION_TARGET_FPR, within [CALIBRATION_MIN_THRESHOLD, CALIBRATION_MAX_THRESHOLD]
+# (keep that range inside the cascade band) and never below the current threshold.
+CALIBRATION_INTERVAL = 6 * 3600
+CALIBRATION_DAYS = 30
+CALIBRATION_TARGET_FPR = 0.001
+CALIBRATION_MIN_SPAM = 20
+CALIBRATION_MIN_HAM = 500
+CALIBRATION_MIN_THRESHOLD = 0.5
+CALIBRATION_MAX_THRESHOLD = 0.99
+CALIBRATION_BINS = 200
+CALIBRATION_CHUNK_SIZE = 100000
+
+# Days to keep rows before archiving and deleting them; None keeps them forever.
+RETENTION_DAYS = {
+    "ml_logs": 30,
+    "reports": None,
+    "banned": None,
+}
+ARCHIVE_DIR = "archive"
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH_SIZE = 500
+RETENTION_BATCH_PAUSE = 0.05
+
+# Sharded mode (python sharding.py): updates are routed by chat_id to SHARDS worker
+# processes, each running its own dispatcher; the scoring pool is split between them.
+SHARDS = 2
+SHARD_QUEUE_SIZE = 10000
+SHARD_MAX_CONCURRENCY = 64
+SHARD_CHECK_INTERVAL = 1.0
+SHARD_RESTART_DELAY = 1.0
+SHARD_STOP_TIMEOUT = 30
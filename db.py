@@ -1,77 +1,183 @@
-import sqlite3
-from typing import Dict, Any
-
-conn = sqlite3.connect("bot.db", check_same_thread=False)
-cursor = conn.cursor()
-
-cursor.executescript("""
-CREATE TABLE IF NOT EXISTS chats (
-    chat_id INTEGER PRIMARY KEY,
-    threshold REAL DEFAULT 0.9,
-    anon_reports INTEGER DEFAULT 1,
-    logging INTEGER DEFAULT 1,
-    max_warnings INTEGER DEFAULT 3,
-    punishment TEXT DEFAULT 'ban'
-);
-
-CREATE TABLE IF NOT EXISTS reports (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    chat_id INTEGER,
-    message_text TEXT,
-    spam_prob REAL,
-    reporter_id INTEGER,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
-CREATE TABLE IF NOT EXISTS warnings (
-    chat_id INTEGER,
-    user_id INTEGER,
-    count INTEGER DEFAULT 0,
-    PRIMARY KEY (chat_id, user_id)
-);
-
-CREATE TABLE IF NOT EXISTS banned (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    chat_id INTEGER,
-    user_id INTEGER,
-    reason TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
-CREATE TABLE IF NOT EXISTS ml_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    chat_id INTEGER,
-    message_text TEXT,
-    spam_prob REAL,
-    is_deleted INTEGER,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-""")
-conn.commit()
-
-
-def ensure_chat(chat_id: int):
-    cursor.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
-    conn.commit()
-
-
-def get_chat_settings(chat_id: int) -> Dict[str, Any]:
-    ensure_chat(chat_id)
-    cursor.execute(
-        "SELECT chat_id, threshold, anon_reports, logging, max_warnings, punishment FROM chats WHERE chat_id=?",
-        (chat_id,)
-    )
-    row = cursor.fetchone()
-    return {
-        "chat_id": row[0],
-        "threshold": row[1],
-        "anon_reports": bool(row[2]),
-        "logging": bool(row[3]),
-        "max_warnings": row[4],
-        "punishment": row[5]
-    }
-
-
-def set_chat_field(chat_id: int, field: str, value):
-    cursor.execute(f"UPDATE chats SET {field}=? WHERE chat_id=?", (value, chat_id))
-    conn.commit()
+import hashlib
+import sqlite3
+
+from config import DB_PATH, DEFAULT_WARN_DECAY, SQLITE_SYNCHRONOUS
+
+
+def connect() -> sqlite3.Connection:
+    connection = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    return connection
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+_initialized = False
+
+
+def init():
+    # Creates and migrates the schema on a short-lived connection; queries at runtime go
+    # through storage.py. Called at startup (off the event loop) rather than on import,
+    # so tools that only need connect()/text_hash() don't pay for it. Idempotent.
+    global _initialized
+    if _initialized:
+        return
+    conn = connect()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='chat_stats'")
+    stats_exist = cursor.fetchone() is not None
+
+    cursor.executescript("""
+    CREATE TABLE IF NOT EXISTS chats (
+        chat_id INTEGER PRIMARY KEY,
+        threshold REAL DEFAULT 0.9,
+        anon_reports INTEGER DEFAULT 1,
+        logging INTEGER DEFAULT 1,
+        max_warnings INTEGER DEFAULT 3,
+        punishment TEXT DEFAULT 'ban'
+    );
+
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        message_text TEXT,
+        spam_prob REAL,
+        reporter_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS warnings (
+        chat_id INTEGER,
+        user_id INTEGER,
+        count INTEGER DEFAULT 0,
+        updated_at INTEGER,
+        PRIMARY KEY (chat_id, user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS banned (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        user_id INTEGER,
+        reason TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS ml_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        message_text TEXT,
+        spam_prob REAL,
+        is_deleted INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- ml_logs rows reference their text by hash; each distinct text is stored once.
+    CREATE TABLE IF NOT EXISTS message_texts (
+        hash BLOB PRIMARY KEY,
+        text TEXT
+    );
+
+    -- Per-chat member reputation for the trusted-user fast path (see reputation.py).
+    CREATE TABLE IF NOT EXISTS reputation (
+        chat_id INTEGER,
+        user_id INTEGER,
+        clean INTEGER DEFAULT 0,
+        first_seen INTEGER,
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_ml_logs_chat_created ON ml_logs (chat_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_reports_chat_created ON reports (chat_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_banned_chat_created ON banned (chat_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_banned_chat_user ON banned (chat_id, user_id);
+
+    -- Counters behind /stats, maintained by the triggers below so reads never scan history.
+    CREATE TABLE IF NOT EXISTS chat_stats (
+        chat_id INTEGER PRIMARY KEY,
+        deleted INTEGER DEFAULT 0,
+        reports INTEGER DEFAULT 0,
+        banned INTEGER DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS chat_stats_daily (
+        chat_id INTEGER,
+        day TEXT,
+        deleted INTEGER DEFAULT 0,
+        reports INTEGER DEFAULT 0,
+        banned INTEGER DEFAULT 0,
+        PRIMARY KEY (chat_id, day)
+    );
+
+    CREATE TRIGGER IF NOT EXISTS ml_logs_stats AFTER INSERT ON ml_logs WHEN NEW.is_deleted = 1
+    BEGIN
+        INSERT INTO chat_stats (chat_id, deleted) VALUES (NEW.chat_id, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET deleted = deleted + 1;
+        INSERT INTO chat_stats_daily (chat_id, day, deleted) VALUES (NEW.chat_id, date(NEW.created_at), 1)
+            ON CONFLICT (chat_id, day) DO UPDATE SET deleted = deleted + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reports_stats AFTER INSERT ON reports
+    BEGIN
+        INSERT INTO chat_stats (chat_id, reports) VALUES (NEW.chat_id, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET reports = reports + 1;
+        INSERT INTO chat_stats_daily (chat_id, day, reports) VALUES (NEW.chat_id, date(NEW.created_at), 1)
+            ON CONFLICT (chat_id, day) DO UPDATE SET reports = reports + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS banned_stats AFTER INSERT ON banned
+    BEGIN
+        INSERT INTO chat_stats (chat_id, banned) VALUES (NEW.chat_id, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET banned = banned + 1;
+        INSERT INTO chat_stats_daily (chat_id, day, banned) VALUES (NEW.chat_id, date(NEW.created_at), 1)
+            ON CONFLICT (chat_id, day) DO UPDATE SET banned = banned + 1;
+    END;
+    """)
+    conn.commit()
+
+    cursor.execute("PRAGMA table_info(ml_logs)")
+    if "text_hash" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE ml_logs ADD COLUMN text_hash BLOB")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ml_logs_text_hash ON ml_logs (text_hash)")
+    # Only rows still carrying an inline text (see retention._compact_texts); empty once
+    # they are compacted, so the hourly pass finds nothing without scanning ml_logs.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ml_logs_inline_text ON ml_logs (id) WHERE message_text IS NOT NULL")
+    conn.commit()
+
+    # Warnings decay (see warnings_ledger.py): per-chat window, and the time each count was
+    # last brought up to date. Counts from before decay existed start aging now.
+    cursor.execute("PRAGMA table_info(chats)")
+    if "warn_decay" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE chats ADD COLUMN warn_decay INTEGER DEFAULT {int(DEFAULT_WARN_DECAY)}")
+    cursor.execute("PRAGMA table_info(chats)")
+    if "auto_threshold" not in [column[1] for column in cursor.fetchall()]:
+        # Set by /calibrate auto on|off; see calibration.py.
+        cursor.execute("ALTER TABLE chats ADD COLUMN auto_threshold INTEGER DEFAULT 0")
+    cursor.execute("PRAGMA table_info(warnings)")
+    if "updated_at" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE warnings ADD COLUMN updated_at INTEGER")
+    cursor.execute("UPDATE warnings SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE updated_at IS NULL")
+    conn.commit()
+
+    if not stats_exist:
+        # First start with the counters: roll up the existing history once.
+        cursor.executescript("""
+        BEGIN;
+        INSERT INTO chat_stats_daily (chat_id, day, deleted, reports, banned)
+        SELECT chat_id, day, SUM(deleted), SUM(reports), SUM(banned) FROM (
+            SELECT chat_id, date(created_at) AS day, 1 AS deleted, 0 AS reports, 0 AS banned FROM ml_logs WHERE is_deleted = 1
+            UNION ALL
+            SELECT chat_id, date(created_at), 0, 1, 0 FROM reports
+            UNION ALL
+            SELECT chat_id, date(created_at), 0, 0, 1 FROM banned
+        ) GROUP BY chat_id, day;
+        INSERT INTO chat_stats (chat_id, deleted, reports, banned)
+        SELECT chat_id, SUM(deleted), SUM(reports), SUM(banned) FROM chat_stats_daily GROUP BY chat_id;
+        COMMIT;
+        """)
+
+    conn.close()
+    _initialized = True
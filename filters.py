@@ -1,51 +1,68 @@
-from aiogram.filters import BaseFilter
-from aiogram import types
-import joblib
-import logging
-from db import get_chat_settings, cursor, conn
-from config import MODEL_PATH
-
-try:
-    spam_pipeline = joblib.load(MODEL_PATH)
-    logging.info("ML model loaded from %s", MODEL_PATH)
-except Exception as e:
-    spam_pipeline = None
-    logging.exception("Failed to load ML model (spam_pipeline). ML auto-detection will be disabled.")
-
-
-class SpamFilter(BaseFilter):
-    async def __call__(self, message: types.Message) -> bool:
-        if not message.text or message.chat.type == "private":
-            return False
-
-        if spam_pipeline is None:
-            logging.warning("Spam pipeline not loaded — skipping ML auto-detection.")
-            return False
-
-        settings = get_chat_settings(message.chat.id)
-        threshold = settings["threshold"]
-        logging_enabled = settings["logging"]
-
-        try:
-            proba = spam_pipeline.predict_proba([message.text])[0]
-            spam_prob = float(proba[1])
-        except Exception as e:
-            logging.exception("Error while predicting ML probability: %s", e)
-            try:
-                pred = int(spam_pipeline.predict([message.text])[0])
-                spam_prob = 1.0 if pred == 1 else 0.0
-            except Exception:
-                spam_prob = 0.0
-
-        if logging_enabled:
-            try:
-                cursor.execute(
-                    "INSERT INTO ml_logs (chat_id, message_text, spam_prob, is_deleted) VALUES (?,?,?,?)",
-                    (message.chat.id, message.text, spam_prob, int(spam_prob >= threshold))
-                )
-                conn.commit()
-            except Exception:
-                logging.exception("Failed to write ml_log to DB")
-
-        logging.info("Chat %s ML prob=%.4f threshold=%.4f", message.chat.id, spam_prob, threshold)
-        return spam_prob >= threshold
+from aiogram.filters import BaseFilter
+from aiogram import types
+import logging
+from campaign_index import campaign_index
+from log_writer import log_writer
+from metrics import stage
+from raid import raid
+from reputation import has_links, reputation
+from scoring import scorer
+from startup import startup
+from storage import storage
+
+
+class SpamFilter(BaseFilter):
+    async def __call__(self, message: types.Message) -> bool:
+        if not message.text or message.chat.type == "private":
+            return False
+
+        with stage("get_chat_settings"):
+            settings = await storage.get_chat_settings(message.chat.id)
+        threshold = raid.threshold(message.chat.id, settings["threshold"])
+        logging_enabled = settings["logging"]
+
+        user = message.from_user
+        trusted = False
+        if user is not None and not has_links(message):
+            with stage("reputation"):
+                trusted = await reputation.is_trusted(message.chat.id, user.id)
+
+        with stage("campaign_lookup"):
+            similarity = campaign_index.match(message.text)
+        if similarity is not None:
+            logging.info("Chat %s matches known spam campaign (similarity=%.2f)", message.chat.id, similarity)
+            spam_prob = 1.0
+        elif trusted:
+            # Established members without links or mentions skip the model.
+            reputation.skipped += 1
+            await reputation.record_clean(message.chat.id, user.id)
+            return False
+        else:
+            if not await startup.admit(message):
+                # Model still loading: deferred, scored by main.finish_startup().
+                return False
+            try:
+                with stage("predict"):
+                    spam_prob = await scorer.score(message.text)
+            except Exception:
+                logging.exception("Failed to score message in chat %s", message.chat.id)
+                spam_prob = None
+
+        if spam_prob is None:
+            logging.warning("Spam pipeline not loaded — skipping ML auto-detection.")
+            return False
+
+        if logging_enabled:
+            with stage("ml_log"):
+                log_writer.submit(
+                    "ml_logs",
+                    (message.chat.id, message.text, spam_prob, int(spam_prob >= threshold))
+                )
+
+        logging.info("Chat %s ML prob=%.4f threshold=%.4f", message.chat.id, spam_prob, threshold)
+        if spam_prob < threshold and user is not None:
+            await reputation.record_clean(message.chat.id, user.id)
+        if spam_prob < threshold:
+            return False
+        # Passed on to handle_spam().
+        return {"spam_prob": spam_prob, "campaign_match": similarity is not None}
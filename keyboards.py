@@ -1,22 +1,33 @@
-# keyboards.py
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-
-def private_start_keyboard(bot_username: str):
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="➕ Добавить в группу", url=f"https://t.me/{bot_username}?startgroup=true")],
-            [InlineKeyboardButton(text="📖 Команды (описание)", callback_data="commands")]
-        ]
-    )
-
-
-def threshold_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🟢 Weak (0.8)", callback_data="threshold_weak"),
-                InlineKeyboardButton(text="🟡 Normal (0.9)", callback_data="threshold_normal"),
-                InlineKeyboardButton(text="🔴 High (0.95)", callback_data="threshold_high"),
-            ]
-        ]
-    )
+# keyboards.py
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+def private_start_keyboard(bot_username: str):
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="➕ Добавить в группу", url=f"https://t.me/{bot_username}?startgroup=true")],
+            [InlineKeyboardButton(text="📖 Команды (описание)", callback_data="commands")]
+        ]
+    )
+
+
+def threshold_keyboard():
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="🟢 Weak (0.8)", callback_data="threshold_weak"),
+                InlineKeyboardButton(text="🟡 Normal (0.9)", callback_data="threshold_normal"),
+                InlineKeyboardButton(text="🔴 High (0.95)", callback_data="threshold_high"),
+            ]
+        ]
+    )
+
+
+def banned_keyboard(newer_than=None, older_than=None):
+    nav = []
+    if newer_than is not None:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"banned_newer_{newer_than}"))
+    if older_than is not None:
+        nav.append(InlineKeyboardButton(text="Старше ▶️", callback_data=f"banned_older_{older_than}"))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text="📄 Выгрузить CSV", callback_data="banned_export")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from config import LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL_MS, LOG_QUEUE_SIZE
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    # Buffers ml_logs/reports rows in a bounded queue and writes them from a background
+    # task with executemany, one transaction per batch, on the storage thread.
+    def __init__(
+        self,
+        queue_size: int = LOG_QUEUE_SIZE,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval_ms: float = LOG_FLUSH_INTERVAL_MS,
+    ):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._reported_dropped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, table: str, row: Tuple) -> bool:
+        # Non-blocking: used on the message hot path, where losing a log row is
+        # preferable to stalling the handler.
+        try:
+            self.queue.put_nowait((table, row))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def put(self, table: str, row: Tuple):
+        # Blocking: waits for queue space, for rows that must not be lost.
+        await self.queue.put((table, row))
+
+    async def stop(self):
+        if self._task is not None:
+            await self.queue.put(None)
+            await self._task
+            self._task = None
+
+        rows = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                rows.append(item)
+        if rows:
+            await self._flush(rows)
+        logger.info("Log writer stopped: written=%d dropped=%d failed=%d", self.written, self.dropped, self.failed)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            rows = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                rows.append(item)
+
+            await self._flush(rows)
+
+            if self.dropped != self._reported_dropped:
+                logger.warning("Log queue full: %d rows dropped so far", self.dropped)
+                self._reported_dropped = self.dropped
+
+    async def _flush(self, rows: List[Tuple[str, Tuple]]):
+        try:
+            await storage.write_logs(rows)
+            self.written += len(rows)
+        except Exception:
+            self.failed += len(rows)
+            logger.exception("Failed to write %d log rows to DB", len(rows))
+
+
+log_writer = LogWriter()
@@ -1,420 +1,780 @@
-import asyncio
-import logging
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.enums import ParseMode
-from aiogram.client.default import DefaultBotProperties
-from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
-
-from config import BOT_TOKEN, THRESHOLDS
-from db import conn, cursor, get_chat_settings, set_chat_field, ensure_chat
-from filters import SpamFilter, spam_pipeline
-from keyboards import private_start_keyboard, threshold_keyboard
-
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-
-async def is_user_admin(chat: types.Chat, user_id: int) -> bool:
-    try:
-        admins = await chat.get_administrators()
-        return user_id in [a.user.id for a in admins]
-    except Exception as e:
-        logger.exception("Failed to get admins for chat %s: %s", getattr(chat, "id", None), e)
-        return False
-
-
-def increment_warning(chat_id: int, user_id: int) -> int:
-    try:
-        cursor.execute(
-            "INSERT INTO warnings(chat_id, user_id, count) VALUES(?,?,1) "
-            "ON CONFLICT(chat_id,user_id) DO UPDATE SET count=count+1",
-            (chat_id, user_id)
-        )
-        conn.commit()
-        cursor.execute("SELECT count FROM warnings WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        row = cursor.fetchone()
-        return row[0] if row else 0
-    except Exception:
-        logger.exception("Failed to increment warning")
-        return 0
-
-
-def reset_warnings(chat_id: int, user_id: int):
-    try:
-        cursor.execute("DELETE FROM warnings WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        conn.commit()
-    except Exception:
-        logger.exception("Failed to reset warnings")
-
-
-def add_banned(chat_id: int, user_id: int, reason: str):
-    try:
-        cursor.execute("INSERT INTO banned (chat_id, user_id, reason) VALUES (?,?,?)", (chat_id, user_id, reason))
-        conn.commit()
-    except Exception:
-        logger.exception("Failed to add banned entry")
-
-
-async def private_start(message: types.Message):
-    bot_info = await bot.get_me()
-    kb = private_start_keyboard(bot_info.username)
-    text = (
-        "*👋 Привет! Я - анти-фишинг бот для групп.*\n\n"
-        "*Что я умею:*\n"
-        "• Автоматически удалять фишинговые сообщения с использованием машинного обучения.\n"
-        "• В случае несрабатывения, администратор может пометить сообщение командой /report (reply).\n"
-        "• Настройки: порог детекции, логирование, анонимные репорты, наказания.\n\n"
-        "*Как использовать:*\n"
-        "1. Нажмите «Добавить в группу» и добавьте бота в вашу группу.\n"
-        "2. Выдайте боту права администратора: удаление сообщений, бан/ограничение пользователей.\n\n"
-        "*Команды:*\n"
-        "• `/threshold` - открыть меню порогов (weak/normal/high).\n"
-        "• `/report` - ответьте на сообщение и отправьте /report, чтобы пометить его как спам.\n"
-        "• `/anon_reports on|off` - включить/выключить анонимные репорты.\n"
-        "• `/punishment warn|mute|ban` - установить действие при превышении предупреждений.\n"
-        "• `/stats` - статистика удалений/репортов.\n"
-        "• `/banned` - список забаненных (в базе).\n"
-        "• `/logging on|off` - включить/выключить логирование ML-результатов.\n\n"
-    )
-    await message.answer(text, reply_markup=kb)
-
-
-dp.message.register(private_start, F.chat.type == "private")
-
-
-async def on_my_chat_member(update: types.ChatMemberUpdated):
-    chat = update.chat
-    new_status = update.new_chat_member.status
-    if new_status in ("member", "administrator"):
-        try:
-            await bot.send_message(
-                chat.id,
-                "👋 Спасибо, что добавили меня!\n\n"
-                "Чтобы я мог удалять фишинговые сообщения, выдайте мне права администратора:\n"
-                "• Удаление сообщений\n"
-                "• Бан/ограничение пользователей\n\n"
-            )
-        except Exception:
-            logger.exception("Can't send welcome message to chat %s", chat.id)
-
-
-dp.my_chat_member.register(on_my_chat_member)
-
-async def handle_spam(message: types.Message):
-    chat = message.chat
-    user = message.from_user
-
-    settings = get_chat_settings(chat.id)
-    try:
-        await message.delete()
-    except Exception:
-        logger.exception("Failed to delete message in chat %s", chat.id)
-
-    warns = increment_warning(chat.id, user.id)
-    max_warns = settings["max_warnings"]
-    punishment = settings["punishment"]
-
-    try:
-        await message.answer(
-            f"⚠️ Сообщение от {user.full_name} удалено.\n"
-            f"Предупреждение #{warns} / {max_warns}."
-        )
-    except Exception:
-        logger.exception("Failed to send warning message")
-
-    if warns >= max_warns:
-        reason = "Reached warnings (ML)" 
-        try:
-            if punishment == "ban":
-                await bot.ban_chat_member(chat.id, user.id)
-                add_banned(chat.id, user.id, reason)
-                await message.answer(f"⛔ Пользователь {user.full_name} забанен (достиг лимита предупреждений).")
-            elif punishment == "mute":
-                await bot.restrict_chat_member(
-                    chat.id,
-                    user.id,
-                    permissions=types.ChatPermissions(can_send_messages=False)
-                )
-                add_banned(chat.id, user.id, "muted: reached warnings")
-                await message.answer(f"🔇 Пользователь {user.full_name} лишился голоса (достиг лимита предупреждений).")
-            else:
-                await message.answer(f"⚠️ Пользователь {user.full_name} достиг лимита предупреждений, но действия нет.")
-            reset_warnings(chat.id, user.id)
-        except Exception:
-            logger.exception("Failed to apply punishment for user %s in chat %s", user.id, chat.id)
-
-dp.message.register(handle_spam, F.text, SpamFilter())
-
-async def report_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Команда /report работает только в группах.")
-        return
-
-    if not message.reply_to_message:
-        await message.reply("ℹ️ Использование: ответьте на сообщение, затем отправьте /report.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Команда доступна только администраторам.")
-        return
-
-    original = message.reply_to_message
-    text = original.text or original.caption or ""
-    ml_prob = None
-    if spam_pipeline is not None and text:
-        try:
-            ml_prob = float(spam_pipeline.predict_proba([text])[0][1])
-        except Exception:
-            try:
-                ml_prob = float(spam_pipeline.predict([text])[0])
-            except Exception:
-                ml_prob = None
-
-    settings = get_chat_settings(message.chat.id)
-    reporter_id = None if settings["anon_reports"] else message.from_user.id
-
-    try:
-        cursor.execute(
-            "INSERT INTO reports (chat_id, message_text, spam_prob, reporter_id) VALUES (?,?,?,?)",
-            (message.chat.id, text, ml_prob, reporter_id)
-        )
-        conn.commit()
-    except Exception:
-        logger.exception("Failed to insert report to DB")
-
-    try:
-        await original.delete()
-    except Exception:
-        logger.exception("Failed to delete reported message")
-
-    await message.reply("✅ Сообщение помечено как спам и сохранено в репортах.")
-
-
-dp.message.register(report_cmd, Command(commands=["report"]))
-
-
-async def threshold_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Эта команда доступна только в группах.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Только администраторы могут менять порог.")
-        return
-
-    await message.answer(
-        "*Выберите уровень детекции (чувствительность):*\n\n"
-        "🟢 Weak - агрессивный (много ложных срабатываний)\n"
-        "🟡 Normal - сбалансированный\n"
-        "🔴 High - строгий (только явный спам)",
-        reply_markup=threshold_keyboard()
-    )
-
-
-dp.message.register(threshold_cmd, Command(commands=["threshold"]))
-
-
-async def threshold_callback(call: types.CallbackQuery):
-    await call.answer()
-    data = call.data or ""
-    if not data.startswith("threshold_"):
-        return
-
-    level = data.split("_", 1)[1]
-    mapping = {"weak": THRESHOLDS["weak"], "normal": THRESHOLDS["normal"], "high": THRESHOLDS["high"]}
-    if level not in mapping:
-        await call.message.answer("Неизвестный уровень.")
-        return
-
-    chat = call.message.chat
-    if chat.type != "private":
-        if not await is_user_admin(chat, call.from_user.id):
-            await call.message.answer("Только администраторы могут менять настройки.")
-            return
-
-    set_chat_field(chat.id, "threshold", mapping[level])
-    await call.message.edit_text(f"✅ Порог установлен: *{level.upper()}* ({mapping[level]})", parse_mode=ParseMode.MARKDOWN)
-
-
-dp.callback_query.register(threshold_callback, lambda c: c.data and c.data.startswith("threshold_"))
-
-async def anon_reports_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Эта команда работает только в группах.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Только администратор может менять настройку.")
-        return
-
-    parts = message.text.split()
-    if len(parts) < 2 or parts[1].lower() not in ("on", "off"):
-        await message.reply("Использование: `/anon_reports on` или `/anon_reports off`", parse_mode=ParseMode.MARKDOWN)
-        return
-
-    value = 1 if parts[1].lower() == "on" else 0
-    set_chat_field(message.chat.id, "anon_reports", value)
-    await message.reply(f"✅ Анонимные репорты {'включены' if value else 'выключены'}.")
-
-
-dp.message.register(anon_reports_cmd, Command(commands=["anon_reports"]))
-
-async def logging_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Эта команда работает только в группах.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Только администратор может менять настройку.")
-        return
-
-    parts = message.text.split()
-    if len(parts) < 2 or parts[1].lower() not in ("on", "off"):
-        await message.reply("Использование: `/logging on` или `/logging off`", parse_mode=ParseMode.MARKDOWN)
-        return
-
-    value = 1 if parts[1].lower() == "on" else 0
-    set_chat_field(message.chat.id, "logging", value)
-    await message.reply(f"✅ Логирование ML {'включено' if value else 'выключено'}.")
-
-
-dp.message.register(logging_cmd, Command(commands=["logging"]))
-
-async def punishment_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Эта команда работает только в группах.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Только администратор может менять настройку.")
-        return
-
-    parts = message.text.split()
-    if len(parts) < 2 or parts[1].lower() not in ("warn", "mute", "ban"):
-        await message.reply("Использование: `/punishment warn|mute|ban`")
-        return
-
-    val = parts[1].lower()
-    if val == "warn":
-        set_chat_field(message.chat.id, "punishment", "warn")
-    elif val == "mute":
-        set_chat_field(message.chat.id, "punishment", "mute")
-    else:
-        set_chat_field(message.chat.id, "punishment", "ban")
-
-    await message.reply(f"✅ Тип наказания установлен: *{val}*.", parse_mode=ParseMode.MARKDOWN)
-
-
-dp.message.register(punishment_cmd, Command(commands=["punishment"]))
-
-async def stats_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Команда доступна только в группах.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Только админ может просматривать статистику.")
-        return
-
-    chat_id = message.chat.id
-    cursor.execute("SELECT COUNT(*) FROM ml_logs WHERE chat_id=? AND is_deleted=1", (chat_id,))
-    deleted = cursor.fetchone()[0] or 0
-
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE chat_id=?", (chat_id,))
-    reports = cursor.fetchone()[0] or 0
-
-    cursor.execute("SELECT COUNT(*) FROM banned WHERE chat_id=?", (chat_id,))
-    banned_count = cursor.fetchone()[0] or 0
-
-    await message.reply(
-        f"📊 *Статистика чата*\n\n"
-        f"🗑️ Удалено сообщений: `{deleted}`\n"
-        f"📝 Репортов: `{reports}`\n"
-        f"⛔ Забанено: `{banned_count}`",
-        parse_mode=ParseMode.MARKDOWN
-    )
-
-dp.message.register(stats_cmd, Command(commands=["stats"]))
-
-async def banned_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.reply("Команда доступна только в группах.")
-        return
-
-    if not await is_user_admin(message.chat, message.from_user.id):
-        await message.reply("❌ Только админ может просматривать список забаненных.")
-        return
-
-    chat_id = message.chat.id
-    cursor.execute("SELECT user_id, reason, created_at FROM banned WHERE chat_id=?", (chat_id,))
-    rows = cursor.fetchall()
-    if not rows:
-        await message.reply("Пока никто не забанен (в базе).")
-        return
-
-    text_lines = ["⛔ *Список забаненных (в базе):*"]
-    for uid, reason, created in rows:
-        text_lines.append(f"- `{uid}` - {reason} (в {created})")
-    await message.reply("\n".join(text_lines), parse_mode=ParseMode.MARKDOWN)
-
-
-dp.message.register(banned_cmd, Command(commands=["banned"]))
-
-async def show_commands_callback(call: types.CallbackQuery):
-    await call.answer()
-    text = (
-        "*Команды и кнопки:*\n\n"
-        "• `/settings` - текущие настройки\n"
-        "• `/threshold` - выбрать порог (weak/normal/high).\n"
-        "• `/report` - ответьте на сообщение и отправьте /report (админ).\n"
-        "• `/anon_reports on|off` - включить/выключить анонимные репорты.\n"
-        "• `/punishment warn|mute|ban` - тип наказания после превышения предупреждений.\n"
-        "• `/stats` - статистика (только админы).\n"
-        "• `/banned` - список забаненных (только админы).\n"
-        "• `/logging on|off` - вкл/выкл логирование ML результатов.\n\n"
-    )
-    await call.message.answer(text, parse_mode=ParseMode.MARKDOWN)
-
-
-dp.callback_query.register(show_commands_callback, lambda c: c.data == "commands")
-
-def threshold_to_level(threshold: float) -> str:
-    if threshold <= 0.8:
-        return "🟢 Weak"
-    elif threshold <= 0.9:
-        return "🟡 Normal"
-    return "🔴 High"
-
-async def settings_cmd(message: types.Message):
-    if not await is_user_admin(message.chat, message.from_user.id):
-        return
-
-    settings = get_chat_settings(message.chat.id)
-
-    await message.answer(
-        "*⚙️ Текущие настройки чата*\n\n"
-        f"🧠 *ML порог:* `{settings['threshold']}`\n"
-        f"🎯 *Уровень:* {threshold_to_level(settings['threshold'])}\n\n"
-        f"🕵️ *Анонимные репорты:* {'✅ Включены' if settings['anon_reports'] else '❌ Отключены'}\n"
-        f"📄 *Логирование:* {'✅ Включено' if settings['logging'] else '❌ Отключено'}\n\n"
-        f"⚠️ *Макс. предупреждений:* `{settings['max_warnings']}`\n"
-        f"🚫 *Наказание:* `{settings['punishment']}`\n\n"
-    )
-
-dp.message.register(settings_cmd, F.text == "/settings")
-
-async def main():
-    logger.info("Starting bot...")
-    try:
-        await dp.start_polling(bot)
-    finally:
-        await bot.session.close()
-
-if __name__ == "__main__":
-    asyncio.run(main())
-
+import asyncio
+import logging
+import os
+import signal
+import tempfile
+from typing import List, Optional, Tuple
+from aiogram import Bot, Dispatcher, types, F
+from aiogram.enums import ParseMode
+from aiogram.client.default import DefaultBotProperties
+from aiogram.filters import Command
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from actions import actions
+from admin_cache import admin_cache, admin_status_changed
+from calibration import calibration_job
+from campaign_index import campaign_index
+import db
+from config import (
+    BANNED_PAGE_SIZE,
+    BOT_TOKEN,
+    CALIBRATION_DAYS,
+    CALIBRATION_MIN_HAM,
+    CALIBRATION_MIN_SPAM,
+    CALIBRATION_TARGET_FPR,
+    CAMPAIGN_MIN_PROB,
+    RUN_MODE,
+    THRESHOLDS,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+)
+from filters import SpamFilter
+from keyboards import banned_keyboard, private_start_keyboard, threshold_keyboard
+from log_writer import log_writer
+import metrics
+from metrics import stage
+from raid import raid
+from reputation import reputation
+from retention import retention_job
+from scoring import scorer
+from startup import startup
+from storage import export_banned_csv, storage
+from warnings_ledger import warnings_ledger
+from webhook import WebhookServer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+bot.session.middleware(metrics.ApiMetricsMiddleware())
+fsm_storage = MemoryStorage()
+dp = Dispatcher(storage=fsm_storage)
+dp.update.outer_middleware(metrics.UpdateMetricsMiddleware())
+dp.update.outer_middleware(startup.track_first_update)
+
+metrics.Callback("bot_scoring_queue_depth", "Texts waiting to be batched for scoring", lambda: scorer.batcher.pending)
+metrics.Callback("bot_log_queue_depth", "Rows waiting in the ml_logs/reports writer queue", lambda: log_writer.queue.qsize())
+metrics.Callback("bot_log_rows_dropped_total", "Log rows dropped because the writer queue was full", lambda: log_writer.dropped, "counter")
+metrics.Callback("bot_verdict_cache_hits_total", "Verdict cache hits", lambda: scorer.cache.hits, "counter")
+metrics.Callback("bot_verdict_cache_misses_total", "Verdict cache misses", lambda: scorer.cache.misses, "counter")
+metrics.Callback("bot_storage_queue_depth", "Queries waiting for the storage thread", lambda: storage.pending)
+metrics.Callback("bot_trusted_skips_total", "Messages from trusted members that skipped the model", lambda: reputation.skipped, "counter")
+metrics.Callback("bot_reputation_members", "Members tracked in the in-memory reputation store", lambda: reputation.size)
+metrics.Callback("bot_cascade_prescreened_total", "Texts decided by the cascade pre-screen alone", lambda: scorer.prescreened, "counter")
+metrics.Callback("bot_cascade_full_total", "Texts scored by the full model", lambda: scorer.full_scored, "counter")
+metrics.Callback("bot_warning_ledger_entries", "Members with warnings held in the in-memory ledger", lambda: warnings_ledger.size)
+metrics.Callback("bot_raid_chats", "Chats currently in raid mode", lambda: raid.active_chats)
+metrics.Callback("bot_actions_pending", "Telegram actions waiting in the scheduler", lambda: actions.pending)
+metrics.Callback("bot_campaign_matches_total", "Messages matched against the spam campaign index", lambda: campaign_index.matches, "counter")
+metrics.Callback("bot_startup_first_update_seconds", "Seconds from process start to the first update", lambda: startup.first_update or 0)
+metrics.Callback("bot_startup_ready_seconds", "Seconds from process start until the model and caches were loaded", lambda: startup.ready_after or 0)
+metrics.Callback("bot_startup_deferred_messages", "Messages waiting for the model to load", lambda: len(startup.deferred))
+
+
+async def is_user_admin(chat: types.Chat, user_id: int) -> bool:
+    try:
+        admins = await admin_cache.get_admins(bot, chat.id)
+        return user_id in admins
+    except Exception as e:
+        logger.exception("Failed to get admins for chat %s: %s", getattr(chat, "id", None), e)
+        return False
+
+
+async def increment_warning(chat_id: int, user_id: int) -> int:
+    try:
+        return await warnings_ledger.increment(chat_id, user_id)
+    except Exception:
+        logger.exception("Failed to increment warning")
+        return 0
+
+
+async def reset_warnings(chat_id: int, user_id: int):
+    try:
+        await warnings_ledger.reset(chat_id, user_id)
+    except Exception:
+        logger.exception("Failed to reset warnings")
+
+
+async def add_banned(chat_id: int, user_id: int, reason: str):
+    try:
+        await storage.add_banned(chat_id, user_id, reason)
+    except Exception:
+        logger.exception("Failed to add banned entry")
+
+
+def punish_later(action: asyncio.Future, chat_id: int, user_id: int, reason: str, notice: str):
+    # Ban/restrict calls are paced by the action scheduler; record the ban, reset the
+    # warnings and announce it once the call has actually gone through, without holding
+    # up the handler. A failed call keeps the warnings, so the next offence retries it.
+    def done(fut: asyncio.Future):
+        if fut.cancelled() or fut.exception() is not None:
+            logger.error("Failed to apply punishment for user %s in chat %s", user_id, chat_id)
+            return
+        asyncio.ensure_future(add_banned(chat_id, user_id, reason))
+        asyncio.ensure_future(reset_warnings(chat_id, user_id))
+        actions.notify(chat_id, notice)
+
+    action.add_done_callback(done)
+
+
+async def private_start(message: types.Message):
+    bot_info = await bot.me()
+    kb = private_start_keyboard(bot_info.username)
+    text = (
+        "*👋 Привет! Я - анти-фишинг бот для групп.*\n\n"
+        "*Что я умею:*\n"
+        "• Автоматически удалять фишинговые сообщения с использованием машинного обучения.\n"
+        "• В случае несрабатывения, администратор может пометить сообщение командой /report (reply).\n"
+        "• Настройки: порог детекции, логирование, анонимные репорты, наказания.\n\n"
+        "*Как использовать:*\n"
+        "1. Нажмите «Добавить в группу» и добавьте бота в вашу группу.\n"
+        "2. Выдайте боту права администратора: удаление сообщений, бан/ограничение пользователей.\n\n"
+        "*Команды:*\n"
+        "• `/threshold` - открыть меню порогов (weak/normal/high).\n"
+        "• `/calibrate` - подобрать порог по статистике чата.\n"
+        "• `/report` - ответьте на сообщение и отправьте /report, чтобы пометить его как спам.\n"
+        "• `/anon_reports on|off` - включить/выключить анонимные репорты.\n"
+        "• `/punishment warn|mute|ban` - установить действие при превышении предупреждений.\n"
+        "• `/warn_decay <часы>|off` - через сколько часов сгорает одно предупреждение.\n"
+        "• `/stats` - статистика удалений/репортов.\n"
+        "• `/banned [user_id]` - список забаненных (в базе) или поиск по user_id.\n"
+        "• `/banned_export` - выгрузить список забаненных в CSV.\n"
+        "• `/logging on|off` - включить/выключить логирование ML-результатов.\n\n"
+    )
+    await message.answer(text, reply_markup=kb)
+
+
+dp.message.register(private_start, F.chat.type == "private")
+
+
+async def on_my_chat_member(update: types.ChatMemberUpdated):
+    chat = update.chat
+    new_status = update.new_chat_member.status
+    if admin_status_changed(update):
+        admin_cache.invalidate(chat.id)
+    if new_status in ("member", "administrator"):
+        try:
+            await bot.send_message(
+                chat.id,
+                "👋 Спасибо, что добавили меня!\n\n"
+                "Чтобы я мог удалять фишинговые сообщения, выдайте мне права администратора:\n"
+                "• Удаление сообщений\n"
+                "• Бан/ограничение пользователей\n\n"
+            )
+        except Exception:
+            logger.exception("Can't send welcome message to chat %s", chat.id)
+
+
+dp.my_chat_member.register(on_my_chat_member)
+
+
+async def on_chat_member(update: types.ChatMemberUpdated):
+    if admin_status_changed(update):
+        admin_cache.invalidate(update.chat.id)
+
+
+dp.chat_member.register(on_chat_member)
+
+
+async def on_new_members(message: types.Message):
+    if raid.record_join(message.chat.id, len(message.new_chat_members)):
+        actions.delete(message.chat.id, message.message_id)
+
+
+dp.message.register(on_new_members, F.new_chat_members)
+
+async def handle_spam(message: types.Message, spam_prob: float = 1.0, campaign_match: bool = False):
+    chat = message.chat
+    user = message.from_user
+
+    settings = await storage.get_chat_settings(chat.id)
+    if not campaign_match and spam_prob >= CAMPAIGN_MIN_PROB:
+        with stage("campaign_add"):
+            campaign_index.add(message.text)
+    actions.delete(chat.id, message.message_id)
+
+    if raid.record_flagged(chat.id):
+        # Raid mode: no warning counter or per-user notice, the raid summary covers it.
+        await reputation.penalize(chat.id, user.id)
+        raid.punish(chat.id, user.id, settings["punishment"])
+        return
+
+    with stage("increment_warning"):
+        warns = await increment_warning(chat.id, user.id)
+    await reputation.penalize(chat.id, user.id)
+    max_warns = settings["max_warnings"]
+    punishment = settings["punishment"]
+
+    actions.notify(
+        chat.id,
+        f"⚠️ Сообщение от {user.full_name} удалено.\n"
+        f"Предупреждение #{warns} / {max_warns}."
+    )
+
+    if warns >= max_warns:
+        reason = "Reached warnings (ML)" 
+        try:
+            with stage("punishment"):
+                if punishment == "ban":
+                    punish_later(
+                        actions.ban(chat.id, user.id), chat.id, user.id, reason,
+                        f"⛔ Пользователь {user.full_name} забанен (достиг лимита предупреждений)."
+                    )
+                elif punishment == "mute":
+                    punish_later(
+                        actions.restrict(chat.id, user.id, types.ChatPermissions(can_send_messages=False)),
+                        chat.id, user.id, "muted: reached warnings",
+                        f"🔇 Пользователь {user.full_name} лишился голоса (достиг лимита предупреждений)."
+                    )
+                else:
+                    actions.notify(chat.id, f"⚠️ Пользователь {user.full_name} достиг лимита предупреждений, но действия нет.")
+                    await reset_warnings(chat.id, user.id)
+        except Exception:
+            logger.exception("Failed to apply punishment for user %s in chat %s", user.id, chat.id)
+
+spam_filter = SpamFilter()
+dp.message.register(handle_spam, F.text, spam_filter)
+
+async def report_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Команда /report работает только в группах.")
+        return
+
+    if not message.reply_to_message:
+        await message.reply("ℹ️ Использование: ответьте на сообщение, затем отправьте /report.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Команда доступна только администраторам.")
+        return
+
+    original = message.reply_to_message
+    text = original.text or original.caption or ""
+    ml_prob = None
+    if text:
+        try:
+            ml_prob = await scorer.score(text)
+        except Exception:
+            ml_prob = None
+
+    settings = await storage.get_chat_settings(message.chat.id)
+    reporter_id = None if settings["anon_reports"] else message.from_user.id
+
+    await log_writer.put("reports", (message.chat.id, text, ml_prob, reporter_id))
+    if original.from_user is not None:
+        await reputation.penalize(message.chat.id, original.from_user.id)
+    if text and ((ml_prob is not None and ml_prob >= CAMPAIGN_MIN_PROB) or campaign_index.nominate(text, message.chat.id)):
+        # One admin's report only reaches the shared index if the model agrees or
+        # other chats report it too.
+        campaign_index.add(text)
+
+    actions.delete(message.chat.id, original.message_id)
+
+    await message.reply("✅ Сообщение помечено как спам и сохранено в репортах.")
+
+
+dp.message.register(report_cmd, Command(commands=["report"]))
+
+
+async def threshold_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Эта команда доступна только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только администраторы могут менять порог.")
+        return
+
+    await message.answer(
+        "*Выберите уровень детекции (чувствительность):*\n\n"
+        "🟢 Weak - агрессивный (много ложных срабатываний)\n"
+        "🟡 Normal - сбалансированный\n"
+        "🔴 High - строгий (только явный спам)",
+        reply_markup=threshold_keyboard()
+    )
+
+
+dp.message.register(threshold_cmd, Command(commands=["threshold"]))
+
+
+async def threshold_callback(call: types.CallbackQuery):
+    await call.answer()
+    data = call.data or ""
+    if not data.startswith("threshold_"):
+        return
+
+    level = data.split("_", 1)[1]
+    mapping = {"weak": THRESHOLDS["weak"], "normal": THRESHOLDS["normal"], "high": THRESHOLDS["high"]}
+    if level not in mapping:
+        await call.message.answer("Неизвестный уровень.")
+        return
+
+    chat = call.message.chat
+    if chat.type != "private":
+        if not await is_user_admin(chat, call.from_user.id):
+            await call.message.answer("Только администраторы могут менять настройки.")
+            return
+
+    await storage.set_chat_field(chat.id, "threshold", mapping[level])
+    await call.message.edit_text(f"✅ Порог установлен: *{level.upper()}* ({mapping[level]})", parse_mode=ParseMode.MARKDOWN)
+
+
+dp.callback_query.register(threshold_callback, lambda c: c.data and c.data.startswith("threshold_"))
+
+CALIBRATION_POINTS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+async def calibrate_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Эта команда доступна только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только администраторы могут менять порог.")
+        return
+
+    chat_id = message.chat.id
+    parts = message.text.split()
+    arg = parts[1].lower() if len(parts) > 1 else ""
+    if arg == "auto":
+        if len(parts) < 3 or parts[2].lower() not in ("on", "off"):
+            await message.reply("Использование: `/calibrate auto on` или `/calibrate auto off`", parse_mode=ParseMode.MARKDOWN)
+            return
+        value = 1 if parts[2].lower() == "on" else 0
+        await storage.set_chat_field(chat_id, "auto_threshold", value)
+        await message.reply(f"✅ Автоподбор порога {'включён' if value else 'выключен'}.")
+        return
+    if arg not in ("", "apply"):
+        await message.reply("Использование: `/calibrate`, `/calibrate apply` или `/calibrate auto on|off`", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    curve = await calibration_job.curve(chat_id)
+    if not curve.enough_data():
+        await message.reply(
+            f"📐 Недостаточно данных для калибровки за {CALIBRATION_DAYS} дн.: "
+            f"спама {curve.spam} из {CALIBRATION_MIN_SPAM}, обычных сообщений {curve.ham} из {CALIBRATION_MIN_HAM}."
+        )
+        return
+
+    settings = await storage.get_chat_settings(chat_id)
+    suggested = curve.suggest(floor=settings["threshold"])
+    if arg == "apply":
+        await storage.set_chat_field(chat_id, "threshold", suggested)
+        await message.reply(f"✅ Порог установлен: `{suggested:g}`", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    lines = [
+        f"📐 *Калибровка порога* (за {CALIBRATION_DAYS} дн.: спам `{curve.spam}`, обычных `{curve.ham}`)\n",
+        "`порог  точность  полнота  ложные`",
+    ]
+    for threshold in sorted(set(CALIBRATION_POINTS) | {settings["threshold"], suggested}):
+        precision, recall, fpr = curve.at(threshold)
+        mark = " ←" if threshold == suggested else ""
+        lines.append(f"`{threshold:<5.3g}  {precision:>7.1%}  {recall:>7.1%}  {fpr:>6.2%}`{mark}")
+    lines.append(
+        f"\nТекущий порог: `{settings['threshold']:g}`. "
+        f"Рекомендуемый при доле ложных срабатываний ≤ {CALIBRATION_TARGET_FPR:.2%}: `{suggested:g}` "
+        "(не ниже текущего: удалённые ботом сообщения в разметку не входят).\n"
+        "`/calibrate apply` - применить, `/calibrate auto on|off` - подбирать автоматически."
+    )
+    await message.reply("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+
+dp.message.register(calibrate_cmd, Command(commands=["calibrate"]))
+
+async def anon_reports_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Эта команда работает только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только администратор может менять настройку.")
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or parts[1].lower() not in ("on", "off"):
+        await message.reply("Использование: `/anon_reports on` или `/anon_reports off`", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    value = 1 if parts[1].lower() == "on" else 0
+    await storage.set_chat_field(message.chat.id, "anon_reports", value)
+    await message.reply(f"✅ Анонимные репорты {'включены' if value else 'выключены'}.")
+
+
+dp.message.register(anon_reports_cmd, Command(commands=["anon_reports"]))
+
+async def logging_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Эта команда работает только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только администратор может менять настройку.")
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or parts[1].lower() not in ("on", "off"):
+        await message.reply("Использование: `/logging on` или `/logging off`", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    value = 1 if parts[1].lower() == "on" else 0
+    await storage.set_chat_field(message.chat.id, "logging", value)
+    await message.reply(f"✅ Логирование ML {'включено' if value else 'выключено'}.")
+
+
+dp.message.register(logging_cmd, Command(commands=["logging"]))
+
+async def punishment_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Эта команда работает только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только администратор может менять настройку.")
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or parts[1].lower() not in ("warn", "mute", "ban"):
+        await message.reply("Использование: `/punishment warn|mute|ban`")
+        return
+
+    val = parts[1].lower()
+    if val == "warn":
+        await storage.set_chat_field(message.chat.id, "punishment", "warn")
+    elif val == "mute":
+        await storage.set_chat_field(message.chat.id, "punishment", "mute")
+    else:
+        await storage.set_chat_field(message.chat.id, "punishment", "ban")
+
+    await message.reply(f"✅ Тип наказания установлен: *{val}*.", parse_mode=ParseMode.MARKDOWN)
+
+
+dp.message.register(punishment_cmd, Command(commands=["punishment"]))
+
+def format_decay(seconds: int) -> str:
+    if not seconds:
+        return "не сгорают"
+    hours = seconds / 3600
+    return f"{hours:g} ч" if hours < 48 else f"{hours / 24:g} дн"
+
+async def warn_decay_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Эта команда работает только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только администратор может менять настройку.")
+        return
+
+    parts = message.text.split()
+    value = parts[1].lower() if len(parts) > 1 else ""
+    if value == "off":
+        seconds = 0
+    else:
+        try:
+            seconds = int(float(value.replace(",", ".")) * 3600)
+        except (ValueError, OverflowError):
+            seconds = -1
+        if seconds <= 0:
+            await message.reply("Использование: `/warn_decay <часы>` или `/warn_decay off`", parse_mode=ParseMode.MARKDOWN)
+            return
+
+    await storage.set_chat_field(message.chat.id, "warn_decay", seconds)
+    await message.reply(f"✅ Срок жизни предупреждения: *{format_decay(seconds)}*.", parse_mode=ParseMode.MARKDOWN)
+
+
+dp.message.register(warn_decay_cmd, Command(commands=["warn_decay"]))
+
+async def stats_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Команда доступна только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только админ может просматривать статистику.")
+        return
+
+    stats = await storage.get_chat_stats(message.chat.id)
+    window_names = {1: "Сегодня", 7: "За 7 дней", 30: "За 30 дней"}
+    window_lines = [
+        f"*{window_names[days]}:* "
+        f"🗑️ `{w['deleted']}` · 📝 `{w['reports']}` · ⛔ `{w['banned']}`"
+        for days, w in stats["windows"].items()
+    ]
+
+    await message.reply(
+        f"📊 *Статистика чата*\n\n"
+        f"🗑️ Удалено сообщений: `{stats['deleted']}`\n"
+        f"📝 Репортов: `{stats['reports']}`\n"
+        f"⛔ Забанено: `{stats['banned']}`\n\n"
+        + "\n".join(window_lines),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+dp.message.register(stats_cmd, Command(commands=["stats"]))
+
+async def banned_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Команда доступна только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только админ может просматривать список забаненных.")
+        return
+
+    chat_id = message.chat.id
+    parts = message.text.split()
+    if len(parts) > 1:
+        # /banned <user_id>: that member's entries, via idx_banned_chat_user.
+        try:
+            user_id = int(parts[1])
+        except ValueError:
+            await message.reply("Использование: `/banned` или `/banned <user_id>`", parse_mode=ParseMode.MARKDOWN)
+            return
+        rows = await storage.find_banned(chat_id, user_id, BANNED_PAGE_SIZE)
+        if not rows:
+            await message.reply(f"Пользователь `{user_id}` в базе забаненных не найден.", parse_mode=ParseMode.MARKDOWN)
+            return
+        text_lines = [f"⛔ *Записи о пользователе* `{user_id}`*:*"] + banned_lines(rows)
+        await message.reply("\n".join(text_lines), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    page = await banned_page(chat_id)
+    if page is None:
+        await message.reply("Пока никто не забанен (в базе).")
+        return
+    text, kb = page
+    await message.reply(text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+
+
+dp.message.register(banned_cmd, Command(commands=["banned"]))
+
+
+def banned_lines(rows: List[Tuple[int, int, str, str]]) -> List[str]:
+    return [f"- `{uid}` - {reason} (в {created})" for _, uid, reason, created in rows]
+
+
+async def banned_page(chat_id: int, older_than: Optional[int] = None, newer_than: Optional[int] = None):
+    # One page of /banned, newest first. The buttons carry the id of the first/last row
+    # shown, so each page is a single index range read however deep the list goes.
+    rows = await storage.banned_page(chat_id, BANNED_PAGE_SIZE + 1, older_than, newer_than)
+    more = len(rows) > BANNED_PAGE_SIZE
+    if newer_than is not None:
+        rows = rows[-BANNED_PAGE_SIZE:]
+        has_newer, has_older = more, True
+    else:
+        rows = rows[:BANNED_PAGE_SIZE]
+        has_newer, has_older = older_than is not None, more
+    if not rows:
+        return None
+    text_lines = ["⛔ *Список забаненных (в базе):*"] + banned_lines(rows)
+    kb = banned_keyboard(rows[0][0] if has_newer else None, rows[-1][0] if has_older else None)
+    return "\n".join(text_lines), kb
+
+
+async def send_banned_export(chat_id: int):
+    # The CSV is written to a temporary file from a read cursor in chunks and uploaded
+    # from disk, so the full list is never held in memory.
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+            count = await asyncio.to_thread(export_banned_csv, chat_id, f)
+        if not count:
+            await bot.send_message(chat_id, "Пока никто не забанен (в базе).")
+            return
+        await bot.send_document(
+            chat_id,
+            types.FSInputFile(path, filename=f"banned_{chat_id}.csv"),
+            caption=f"⛔ Забаненных в базе: {count}",
+        )
+    finally:
+        os.remove(path)
+
+
+async def banned_export_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.reply("Команда доступна только в группах.")
+        return
+
+    if not await is_user_admin(message.chat, message.from_user.id):
+        await message.reply("❌ Только админ может выгружать список забаненных.")
+        return
+
+    await send_banned_export(message.chat.id)
+
+
+dp.message.register(banned_export_cmd, Command(commands=["banned_export"]))
+
+
+async def banned_callback(call: types.CallbackQuery):
+    await call.answer()
+    chat = call.message.chat
+    if not await is_user_admin(chat, call.from_user.id):
+        await call.message.answer("Только администраторы могут просматривать список забаненных.")
+        return
+
+    data = call.data
+    if data == "banned_export":
+        await send_banned_export(chat.id)
+        return
+
+    direction, _, cursor = data[len("banned_"):].partition("_")
+    try:
+        cursor_id = int(cursor)
+    except ValueError:
+        return
+    if direction == "older":
+        page = await banned_page(chat.id, older_than=cursor_id)
+    else:
+        page = await banned_page(chat.id, newer_than=cursor_id)
+    if page is None:
+        # The neighbouring rows are gone (e.g. archived); start over from the newest.
+        page = await banned_page(chat.id)
+    if page is None:
+        await call.message.edit_text("Пока никто не забанен (в базе).")
+        return
+    text, kb = page
+    await call.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+
+
+dp.callback_query.register(banned_callback, lambda c: c.data and c.data.startswith("banned_"))
+
+async def show_commands_callback(call: types.CallbackQuery):
+    await call.answer()
+    text = (
+        "*Команды и кнопки:*\n\n"
+        "• `/settings` - текущие настройки\n"
+        "• `/threshold` - выбрать порог (weak/normal/high).\n"
+        "• `/calibrate [apply|auto on|off]` - подбор порога по статистике чата.\n"
+        "• `/report` - ответьте на сообщение и отправьте /report (админ).\n"
+        "• `/anon_reports on|off` - включить/выключить анонимные репорты.\n"
+        "• `/punishment warn|mute|ban` - тип наказания после превышения предупреждений.\n"
+        "• `/warn_decay <часы>|off` - срок жизни предупреждения.\n"
+        "• `/stats` - статистика (только админы).\n"
+        "• `/banned [user_id]` - список забаненных или поиск по user_id (только админы).\n"
+        "• `/banned_export` - выгрузка забаненных в CSV (только админы).\n"
+        "• `/logging on|off` - вкл/выкл логирование ML результатов.\n\n"
+    )
+    await call.message.answer(text, parse_mode=ParseMode.MARKDOWN)
+
+
+dp.callback_query.register(show_commands_callback, lambda c: c.data == "commands")
+
+def threshold_to_level(threshold: float) -> str:
+    if threshold <= 0.8:
+        return "🟢 Weak"
+    elif threshold <= 0.9:
+        return "🟡 Normal"
+    return "🔴 High"
+
+async def settings_cmd(message: types.Message):
+    if not await is_user_admin(message.chat, message.from_user.id):
+        return
+
+    settings = await storage.get_chat_settings(message.chat.id)
+
+    await message.answer(
+        "*⚙️ Текущие настройки чата*\n\n"
+        f"🧠 *ML порог:* `{settings['threshold']}`\n"
+        f"🎯 *Уровень:* {threshold_to_level(settings['threshold'])}\n"
+        f"📐 *Автоподбор порога:* {'✅ Включён' if settings['auto_threshold'] else '❌ Отключён'}\n\n"
+        f"🕵️ *Анонимные репорты:* {'✅ Включены' if settings['anon_reports'] else '❌ Отключены'}\n"
+        f"📄 *Логирование:* {'✅ Включено' if settings['logging'] else '❌ Отключено'}\n\n"
+        f"⚠️ *Макс. предупреждений:* `{settings['max_warnings']}`\n"
+        f"⏳ *Срок жизни предупреждения:* {format_decay(settings['warn_decay'])}\n"
+        f"🚫 *Наказание:* `{settings['punishment']}`\n\n"
+    )
+
+dp.message.register(settings_cmd, F.text == "/settings")
+
+async def run_webhook():
+    server = WebhookServer(dp, bot)
+    await server.start()
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+
+
+async def on_startup():
+    # Only what handlers can't run without; the model, verdict cache and campaign index
+    # load in finish_startup() while updates are already being taken.
+    await asyncio.to_thread(db.init)
+    await scorer.start()
+    log_writer.start()
+    actions.start(bot)
+    retention_job.start()
+    calibration_job.start()
+    reputation.start()
+    warnings_ledger.start()
+    raid.start()
+    metrics.loop_monitor.start()
+    startup.task = asyncio.create_task(finish_startup())
+
+
+async def finish_startup():
+    await asyncio.gather(campaign_index.load_async(), scorer.ready.wait())
+    try:
+        # Cached by aiogram for /start and the polling loop.
+        await bot.me()
+    except Exception:
+        logger.exception("Failed to fetch bot info")
+    startup.mark_ready()
+    await startup.replay(replay_message)
+
+
+async def replay_message(message: types.Message):
+    result = await spam_filter(message)
+    if result:
+        await handle_spam(message, **result)
+
+
+async def on_shutdown():
+    await startup.stop()
+    await metrics.loop_monitor.stop()
+    await retention_job.stop()
+    await calibration_job.stop()
+    await actions.stop()
+    await raid.stop()
+    await scorer.shutdown()
+    await log_writer.stop()
+    await reputation.stop()
+    await warnings_ledger.stop()
+    await storage.close()
+    campaign_index.save()
+
+
+async def main():
+    logger.info("Starting bot...")
+    metrics_runner = await metrics.start_server()
+    await on_startup()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(scorer.reload()))
+    except (NotImplementedError, AttributeError):
+        pass
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await on_shutdown()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
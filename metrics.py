@@ -0,0 +1,251 @@
+import asyncio
+import bisect
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+from config import LOOP_LAG_INTERVAL, METRICS_HOST, METRICS_PORT, SLOW_UPDATE_MS, TRACE_SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("trace")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        _registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *label_values, value: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+
+class Callback(Metric):
+    # Read at scrape time, for values owned by other components (queue sizes, cache counters).
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float], kind: str = "gauge"):
+        super().__init__(name, documentation)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            return [f"{self.name} {float(self.callback())}"]
+        except Exception:
+            logger.exception("Metric callback for %s failed", self.name)
+            return []
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for label_values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+stage_seconds = Histogram("bot_stage_seconds", "Time spent in each update-processing stage", ["stage"])
+api_seconds = Histogram("bot_api_request_seconds", "Telegram Bot API request latency", ["method"])
+api_errors = Counter("bot_api_errors_total", "Failed Telegram Bot API requests", ["method", "error"])
+update_seconds = Histogram("bot_update_seconds", "Total time to process an update", ["type"])
+updates_total = Counter("bot_updates_total", "Updates processed", ["type"])
+update_lag = Histogram(
+    "bot_update_lag_seconds", "Delay between a message being sent and the bot starting to process it",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+loop_lag = Histogram("bot_event_loop_lag_seconds", "How late the event loop woke up a periodic probe")
+
+
+class LoopLagMonitor:
+    # Sleeps LOOP_LAG_INTERVAL at a time and records how much later than asked it woke
+    # up; anything blocking the event loop (sync I/O, CPU work) shows up here.
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_monitor = LoopLagMonitor()
+
+# Spans of the update being processed; None when nothing is collecting them.
+_trace: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, name)
+        spans = _trace.get()
+        if spans is not None:
+            spans.append((name, elapsed))
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    # Outer dp.update middleware: total time and lag per update, plus a span trace that
+    # is logged for slow updates and for a random sample of TRACE_SAMPLE_RATE.
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        update_type = event.event_type
+        message = event.message
+        if message is not None and message.date is not None:
+            update_lag.observe(max(0.0, time.time() - message.date.timestamp()))
+
+        spans: List[Tuple[str, float]] = []
+        token = _trace.set(spans)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            _trace.reset(token)
+            update_seconds.observe(elapsed, update_type)
+            updates_total.inc(update_type)
+            if elapsed * 1000 >= SLOW_UPDATE_MS or (TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE):
+                trace_logger.info(
+                    "update %s (%s) took %.1f ms: %s",
+                    event.update_id, update_type, elapsed * 1000,
+                    ", ".join(f"{name}={duration * 1000:.1f}ms" for name, duration in spans) or "no stages",
+                )
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            api_seconds.observe(elapsed, name)
+            spans = _trace.get()
+            if spans is not None:
+                spans.append((f"api.{name}", elapsed))
+
+
+async def start_server(host: str = METRICS_HOST, port: Optional[int] = METRICS_PORT):
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram import types
+
+import metrics
+from actions import actions
+from config import (
+    RAID_CHECK_INTERVAL,
+    RAID_ENABLED,
+    RAID_MIN_FLAGGED,
+    RAID_MIN_JOINS,
+    RAID_QUIET,
+    RAID_THRESHOLD,
+    RAID_WINDOW,
+)
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+raids_total = metrics.Counter("bot_raids_total", "Chats switched into raid mode")
+raid_punished_total = metrics.Counter("bot_raid_punished_total", "Members banned or muted on first offence in raid mode")
+
+
+class _ChatRaid:
+    __slots__ = ("flagged", "joins", "active", "active_until", "deleted", "joined", "punished")
+
+    def __init__(self):
+        self.flagged: Deque[float] = deque()
+        self.joins: Deque[float] = deque()
+        self.active = False
+        self.active_until = 0.0
+        self.deleted = 0
+        self.joined = 0
+        self.punished: Set[int] = set()
+
+
+class RaidDetector:
+    # Per-chat sliding-window counts of flagged messages and joins. When either reaches
+    # its trip level within RAID_WINDOW seconds the chat enters raid mode: the threshold
+    # drops to RAID_THRESHOLD, offenders are banned/muted on their first flagged message
+    # and per-user notices are replaced by one announcement and one summary. The raid
+    # ends once neither count has been at half its trip level for RAID_QUIET seconds.
+    def __init__(
+        self,
+        window: float = RAID_WINDOW,
+        min_flagged: int = RAID_MIN_FLAGGED,
+        min_joins: int = RAID_MIN_JOINS,
+        quiet: float = RAID_QUIET,
+        threshold: float = RAID_THRESHOLD,
+        check_interval: float = RAID_CHECK_INTERVAL,
+        enabled: bool = RAID_ENABLED,
+    ):
+        self.window = window
+        self.min_flagged = min_flagged
+        self.min_joins = min_joins
+        self.quiet = quiet
+        self.raid_threshold = threshold
+        self.check_interval = check_interval
+        self.enabled = enabled
+        self.raids = 0
+        self._chats: Dict[int, _ChatRaid] = {}
+        self._banned: List[Tuple[int, int, str]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def active_chats(self) -> int:
+        return sum(1 for state in self._chats.values() if state.active)
+
+    def is_active(self, chat_id: int) -> bool:
+        state = self._chats.get(chat_id)
+        return state is not None and state.active
+
+    def threshold(self, chat_id: int, threshold: float) -> float:
+        if self.is_active(chat_id):
+            return min(threshold, self.raid_threshold)
+        return threshold
+
+    def record_flagged(self, chat_id: int) -> bool:
+        if not self.enabled:
+            return False
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatRaid()
+        self._count(chat_id, state, state.flagged, 1, self.min_flagged)
+        if state.active:
+            state.deleted += 1
+        return state.active
+
+    def record_join(self, chat_id: int, count: int = 1) -> bool:
+        if not self.enabled:
+            return False
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatRaid()
+        self._count(chat_id, state, state.joins, count, self.min_joins)
+        if state.active:
+            state.joined += count
+        return state.active
+
+    def _count(self, chat_id: int, state: _ChatRaid, events: Deque[float], count: int, trip: int):
+        now = time.monotonic()
+        events.extend([now] * count)
+        cutoff = now - self.window
+        while events and events[0] < cutoff:
+            events.popleft()
+
+        if state.active:
+            if len(events) * 2 >= trip:
+                state.active_until = now + self.quiet
+        elif len(events) >= trip:
+            state.active = True
+            state.active_until = now + self.quiet
+            state.deleted = state.joined = 0
+            state.punished.clear()
+            self.raids += 1
+            raids_total.inc()
+            logger.warning("Raid detected in chat %s (%d flagged, %d joins in %ss)",
+                           chat_id, len(state.flagged), len(state.joins), self.window)
+            actions.notify(
+                chat_id,
+                "🚨 Обнаружен рейд: включён режим защиты.\n"
+                "Спам удаляется, нарушители блокируются сразу, без предупреждений."
+            )
+
+    def punish(self, chat_id: int, user_id: int, punishment: str):
+        # One ban per raider however many messages they post; "ban" also revokes their
+        # messages, so a single call clears whatever they managed to send.
+        state = self._chats[chat_id]
+        if user_id in state.punished or punishment not in ("ban", "mute"):
+            return
+        state.punished.add(user_id)
+        if punishment == "ban":
+            action, reason = actions.ban(chat_id, user_id, revoke_messages=True), "Raid (ML)"
+        else:
+            action = actions.restrict(chat_id, user_id, types.ChatPermissions(can_send_messages=False))
+            reason = "muted: raid"
+
+        def done(fut: asyncio.Future):
+            if fut.cancelled() or fut.exception() is not None:
+                logger.error("Failed to apply raid punishment for user %s in chat %s", user_id, chat_id)
+                return
+            raid_punished_total.inc()
+            self._banned.append((chat_id, user_id, reason))
+
+        action.add_done_callback(done)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self._expire()
+            await self.flush()
+
+    def _expire(self):
+        now = time.monotonic()
+        cutoff = now - self.window
+        for chat_id, state in list(self._chats.items()):
+            if state.active:
+                if now < state.active_until:
+                    continue
+                state.active = False
+                logger.info("Raid in chat %s is over: %d deleted, %d punished, %d joined",
+                            chat_id, state.deleted, len(state.punished), state.joined)
+                actions.notify(
+                    chat_id,
+                    "✅ Рейд закончился, режим защиты выключен.\n"
+                    f"🗑️ Удалено сообщений: {state.deleted}\n"
+                    f"⛔ Заблокировано участников: {len(state.punished)}\n"
+                    f"👥 Вступило за время рейда: {state.joined}"
+                )
+                state.punished.clear()
+            while state.flagged and state.flagged[0] < cutoff:
+                state.flagged.popleft()
+            while state.joins and state.joins[0] < cutoff:
+                state.joins.popleft()
+            if not state.flagged and not state.joins:
+                del self._chats[chat_id]
+
+    async def flush(self):
+        # Raid bans are recorded in one insert per tick rather than one per user.
+        if not self._banned:
+            return
+        rows, self._banned = self._banned, []
+        try:
+            await storage.add_banned_many(rows)
+        except Exception:
+            logger.exception("Failed to record %d raid bans", len(rows))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+raid = RaidDetector()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram import types
+
+from config import (
+    REPUTATION_FLUSH_INTERVAL,
+    REPUTATION_IDLE_TTL,
+    REPUTATION_MAX_CHATS,
+    TRUST_ENABLED,
+    TRUST_MIN_AGE,
+    TRUST_MIN_MESSAGES,
+)
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+LINK_ENTITIES = frozenset({"url", "text_link", "mention", "text_mention"})
+
+
+def has_links(message: types.Message) -> bool:
+    for entity in (message.entities or []) + (message.caption_entities or []):
+        if entity.type in LINK_ENTITIES:
+            return True
+    text = message.text or message.caption or ""
+    return "://" in text or "t.me/" in text
+
+
+class ReputationStore:
+    # Clean-message count and first-seen time per (chat, user), held as a two-int list
+    # per member. A chat's members are loaded on its first message and changes are
+    # written back in batches every flush_interval seconds. Chats are kept in LRU order
+    # and, once flushed, idle or excess ones are dropped; the database stays complete.
+    def __init__(
+        self,
+        min_messages: int = TRUST_MIN_MESSAGES,
+        min_age: float = TRUST_MIN_AGE,
+        flush_interval: float = REPUTATION_FLUSH_INTERVAL,
+        enabled: bool = TRUST_ENABLED,
+        idle_ttl: float = REPUTATION_IDLE_TTL,
+        max_chats: int = REPUTATION_MAX_CHATS,
+    ):
+        self.min_messages = min_messages
+        self.min_age = min_age
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        self.skipped = 0
+        self._chats: "OrderedDict[int, Dict[int, List[int]]]" = OrderedDict()
+        self._used: Dict[int, float] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return sum(len(members) for members in self._chats.values())
+
+    async def _members(self, chat_id: int) -> Dict[int, List[int]]:
+        members = self._chats.get(chat_id)
+        if members is not None:
+            self._chats.move_to_end(chat_id)
+            self._used[chat_id] = time.monotonic()
+            return members
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._load(chat_id))
+            self._loading[chat_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, chat_id: int) -> Dict[int, List[int]]:
+        rows = await storage.load_reputation(chat_id)
+        members = {user_id: [clean, first_seen] for user_id, clean, first_seen in rows}
+        self._chats[chat_id] = members
+        self._used[chat_id] = time.monotonic()
+        return members
+
+    async def is_trusted(self, chat_id: int, user_id: int) -> bool:
+        if not self.enabled:
+            return False
+        entry = (await self._members(chat_id)).get(user_id)
+        return entry is not None and entry[0] >= self.min_messages and time.time() - entry[1] >= self.min_age
+
+    async def record_clean(self, chat_id: int, user_id: int):
+        members = await self._members(chat_id)
+        entry = members.get(user_id)
+        if entry is None:
+            members[user_id] = [1, int(time.time())]
+        else:
+            entry[0] += 1
+        self._dirty.add((chat_id, user_id))
+
+    async def penalize(self, chat_id: int, user_id: int):
+        # A warning or report wipes the clean streak; trust has to be earned again.
+        members = await self._members(chat_id)
+        entry = members.get(user_id)
+        if entry is None:
+            members[user_id] = [0, int(time.time())]
+        else:
+            entry[0] = 0
+        self._dirty.add((chat_id, user_id))
+
+    def start(self):
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict()
+
+    def _evict(self):
+        # Oldest first; a chat with unsaved changes (failed flush) stops the sweep.
+        dirty_chats = {chat_id for chat_id, _ in self._dirty}
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._chats:
+            chat_id = next(iter(self._chats))
+            if len(self._chats) <= self.max_chats and self._used[chat_id] >= cutoff:
+                break
+            if chat_id in dirty_chats:
+                break
+            del self._chats[chat_id]
+            del self._used[chat_id]
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for chat_id, user_id in dirty:
+            clean, first_seen = self._chats[chat_id][user_id]
+            rows.append((chat_id, user_id, clean, first_seen))
+        try:
+            await storage.save_reputation(rows)
+        except Exception:
+            self._dirty |= dirty
+            logger.exception("Failed to save %d reputation rows", len(rows))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+reputation = ReputationStore()
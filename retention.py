@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set
+
+from config import ARCHIVE_DIR, RETENTION_BATCH_PAUSE, RETENTION_BATCH_SIZE, RETENTION_DAYS, RETENTION_INTERVAL
+from db import connect, init, text_hash
+
+logger = logging.getLogger(__name__)
+
+SELECTS = {
+    "ml_logs": (
+        "SELECT l.id, l.chat_id, l.text_hash, COALESCE(l.message_text, t.text), l.spam_prob, l.is_deleted, l.created_at "
+        "FROM ml_logs l LEFT JOIN message_texts t ON t.hash = l.text_hash WHERE l.id > ? ORDER BY l.id LIMIT ?"
+    ),
+    "reports": "SELECT id, chat_id, message_text, spam_prob, reporter_id, created_at FROM reports WHERE id > ? ORDER BY id LIMIT ?",
+    "banned": "SELECT id, chat_id, user_id, reason, created_at FROM banned WHERE id > ? ORDER BY id LIMIT ?",
+}
+COLUMNS = {
+    "ml_logs": ("id", "chat_id", "text_hash", "text", "spam_prob", "is_deleted", "created_at"),
+    "reports": ("id", "chat_id", "message_text", "spam_prob", "reporter_id", "created_at"),
+    "banned": ("id", "chat_id", "user_id", "reason", "created_at"),
+}
+
+
+class ArchiveWriter:
+    # Appends rows to ARCHIVE_DIR/<table>/<YYYY-MM-DD>.jsonl.gz, one gzip member per batch.
+    # ml_logs texts are written once per file as {"hash", "text"} lines and rows refer
+    # to them by "text_hash".
+    def __init__(self, archive_dir: str = ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self._written_texts: Dict[str, Set[bytes]] = {}
+
+    def write(self, table: str, rows: List[tuple]):
+        by_day: Dict[str, List[tuple]] = {}
+        for row in rows:
+            by_day.setdefault(str(row[-1])[:10], []).append(row)
+
+        os.makedirs(os.path.join(self.archive_dir, table), exist_ok=True)
+        for day, day_rows in by_day.items():
+            path = os.path.join(self.archive_dir, table, f"{day}.jsonl.gz")
+            written = self._written_texts.setdefault(path, set())
+            lines = []
+            for row in day_rows:
+                record = dict(zip(COLUMNS[table], row))
+                if table == "ml_logs":
+                    text = record.pop("text") or ""
+                    digest = record["text_hash"] or text_hash(text)
+                    if digest not in written:
+                        written.add(digest)
+                        lines.append(json.dumps({"hash": digest.hex(), "text": text}, ensure_ascii=False))
+                    record["text_hash"] = digest.hex()
+                lines.append(json.dumps(record, ensure_ascii=False))
+
+            with open(path, "ab") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                    f.write(("\n".join(lines) + "\n").encode("utf-8"))
+                raw.flush()
+                os.fsync(raw.fileno())
+
+
+def _archive_table(conn: sqlite3.Connection, writer: ArchiveWriter, table: str, days: int, stop: threading.Event) -> int:
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{days} days",)).fetchone()[0]
+    last_id = 0
+    total = 0
+    while not stop.is_set():
+        rows = conn.execute(SELECTS[table], (last_id, RETENTION_BATCH_SIZE)).fetchall()
+        # ids grow with created_at, so the first row inside the window ends the run.
+        expired = []
+        for row in rows:
+            if str(row[-1]) >= cutoff:
+                break
+            expired.append(row)
+        if not expired:
+            break
+
+        writer.write(table, expired)
+        ids = [row[0] for row in expired]
+        placeholders = ",".join("?" * len(ids))
+        with conn:
+            conn.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+            if table == "ml_logs":
+                hashes = list({row[2] for row in expired if row[2] is not None})
+                if hashes:
+                    conn.execute(
+                        f"DELETE FROM message_texts WHERE hash IN ({','.join('?' * len(hashes))}) "
+                        "AND NOT EXISTS (SELECT 1 FROM ml_logs WHERE ml_logs.text_hash = message_texts.hash)",
+                        hashes
+                    )
+        total += len(ids)
+        last_id = ids[-1]
+        if len(expired) < len(rows) or len(rows) < RETENTION_BATCH_SIZE:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return total
+
+
+def _compact_texts(conn: sqlite3.Connection, stop: threading.Event) -> int:
+    # Rows written before texts were deduplicated still carry message_text inline. The
+    # partial index idx_ml_logs_inline_text holds just those, so once they are done a
+    # pass costs one empty index lookup.
+    last_id = 0
+    total = 0
+    while not stop.is_set():
+        rows = conn.execute(
+            "SELECT id, message_text FROM ml_logs WHERE id > ? AND message_text IS NOT NULL ORDER BY id LIMIT ?",
+            (last_id, RETENTION_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        hashed = [(row_id, text_hash(text), text) for row_id, text in rows]
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO message_texts (hash, text) VALUES (?,?)",
+                [(digest, text) for _, digest, text in hashed]
+            )
+            conn.executemany(
+                "UPDATE ml_logs SET text_hash=?, message_text=NULL WHERE id=?",
+                [(digest, row_id) for row_id, digest, _ in hashed]
+            )
+        total += len(rows)
+        last_id = rows[-1][0]
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return total
+
+
+def run_retention(stop: Optional[threading.Event] = None) -> Dict[str, int]:
+    stop = stop or threading.Event()
+    conn = connect()
+    writer = ArchiveWriter()
+    result = {}
+    try:
+        result["compacted"] = _compact_texts(conn, stop)
+        for table, days in RETENTION_DAYS.items():
+            if days is not None:
+                result[table] = _archive_table(conn, writer, table, days, stop)
+    finally:
+        conn.close()
+    logger.info("Retention pass finished: %s", result)
+    return result
+
+
+class RetentionJob:
+    # Runs run_retention in a worker thread every RETENTION_INTERVAL seconds. Work is done
+    # in small batches with pauses, so the bot's own writes are never blocked for long.
+    def __init__(self, interval: float = RETENTION_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval and (self._task is None or self._task.done()):
+            self._stop.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(run_retention, self._stop)
+            except Exception:
+                logger.exception("Retention pass failed")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def iter_archive(path: str) -> Iterator[dict]:
+    # Streams archived rows back (a single file or a whole table directory, in date order).
+    # ml_logs rows get their "text" resolved from the file's text lines.
+    paths = sorted(glob.glob(os.path.join(path, "**", "*.jsonl.gz"), recursive=True)) if os.path.isdir(path) else [path]
+    for file_path in paths:
+        texts: Dict[str, str] = {}
+        with gzip.open(file_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if "hash" in record and "id" not in record:
+                    texts[record["hash"]] = record["text"]
+                    continue
+                if "text_hash" in record:
+                    record["text"] = texts.get(record["text_hash"], "")
+                yield record
+
+
+retention_job = RetentionJob()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ml_logs/reports/banned retention and archive tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("run", help="archive and delete expired rows now")
+    read = sub.add_parser("read", help="stream archived rows as JSON lines")
+    read.add_argument("path", help="archive file or directory, e.g. archive/ml_logs")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        logging.basicConfig(level=logging.INFO)
+        init()
+        print(json.dumps(run_retention()))
+    else:
+        for record in iter_archive(args.path):
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from batcher import InferenceBatcher
+from config import CASCADE_PATH, COMPILED_MODEL_PATH, MODEL_PATH, MODEL_WATCH_INTERVAL, SCORING_WORKERS
+from verdict_cache import VerdictCache, text_key
+
+logger = logging.getLogger(__name__)
+
+# Set inside each pool worker by _init_worker; the bot process itself never loads the model.
+_model = None
+_prescreen = None
+
+
+def _load_model(model_path: str, compiled_path: Optional[str]):
+    # Prefer the compiled scorer unless the pickle was retrained after it was exported.
+    if compiled_path and os.path.exists(compiled_path):
+        if os.path.exists(model_path) and os.path.getmtime(model_path) > os.path.getmtime(compiled_path):
+            logging.warning("%s is older than %s, loading the sklearn pipeline instead", compiled_path, model_path)
+        else:
+            from compiled_model import CompiledScorer
+            return CompiledScorer(compiled_path), compiled_path
+    import joblib
+    return joblib.load(model_path), model_path
+
+
+def _init_worker(model_path: str, compiled_path: Optional[str], cascade_path: Optional[str] = None):
+    global _model, _prescreen
+    _prescreen = None
+    try:
+        _model, loaded_from = _load_model(model_path, compiled_path)
+        logging.info("ML model loaded from %s", loaded_from)
+    except Exception:
+        _model = None
+        logging.exception("Failed to load ML model (spam_pipeline). ML auto-detection will be disabled.")
+        return
+
+    # The pre-screen is trained alongside the model; one left over from an older
+    # training run would decide texts the current model might disagree with.
+    if cascade_path and os.path.exists(cascade_path):
+        trained = model_path if os.path.exists(model_path) else loaded_from
+        if os.path.getmtime(cascade_path) < os.path.getmtime(trained):
+            logging.warning("%s is older than %s, scoring everything with the full model", cascade_path, trained)
+            return
+        try:
+            from cascade import Prescreen
+            _prescreen = Prescreen(cascade_path)
+        except Exception:
+            logging.exception("Failed to load the pre-screen model, scoring everything with the full model")
+
+
+def _predict_cascade(texts: List[str]) -> Tuple[List[Optional[float]], int]:
+    # Returns the probabilities and how many of them the pre-screen decided alone.
+    if _prescreen is None:
+        return _predict_batch(texts), 0
+
+    probs: List[Optional[float]] = []
+    uncertain: List[int] = []
+    for i, text in enumerate(texts):
+        try:
+            prob = _prescreen.score(text)
+        except Exception:
+            logging.exception("Pre-screen failed, passing the text to the full model")
+            prob = None
+        if prob is None or not _prescreen.decided(prob):
+            uncertain.append(i)
+        probs.append(prob)
+
+    if uncertain:
+        for i, prob in zip(uncertain, _predict_batch([texts[i] for i in uncertain])):
+            probs[i] = prob
+    return probs, len(texts) - len(uncertain)
+
+
+def _predict_batch(texts: List[str]) -> List[Optional[float]]:
+    if _model is None:
+        return [None] * len(texts)
+
+    try:
+        return [float(proba[1]) for proba in _model.predict_proba(texts)]
+    except Exception as e:
+        logging.exception("Error while predicting ML probability: %s", e)
+
+    results = []
+    for text in texts:
+        try:
+            pred = int(_model.predict([text])[0])
+            results.append(1.0 if pred == 1 else 0.0)
+        except Exception:
+            results.append(None)
+    return results
+
+
+# Canned inputs a freshly loaded model must handle before it is swapped in.
+SANITY_SPAM = [
+    "Заработок от 5000 рублей в день без вложений! Пиши в личку, переходи по ссылке",
+    "Бесплатная крипта каждому, успей забрать бонус по ссылке в профиле",
+]
+SANITY_HAM = [
+    "Привет, как дела? Завтра встречаемся в офисе в десять",
+    "Спасибо за ответ, вопрос решился",
+]
+
+
+def _model_loaded() -> bool:
+    return _model is not None
+
+
+class ScoringBackend:
+    def __init__(
+        self,
+        model_path: str = MODEL_PATH,
+        compiled_path: Optional[str] = COMPILED_MODEL_PATH,
+        workers: int = SCORING_WORKERS,
+        cascade_path: Optional[str] = CASCADE_PATH,
+    ):
+        self.model_path = model_path
+        self.compiled_path = compiled_path
+        self.cascade_path = cascade_path
+        # Texts decided by the pre-screen alone vs. sent to the full model.
+        self.prescreened = 0
+        self.full_scored = 0
+        self.workers = max(1, workers)
+        self.model_loaded = False
+        # Set once the first pool has loaded the model (or failed to); see start().
+        self.ready = asyncio.Event()
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.batcher = InferenceBatcher(self._predict, max_inflight=self.workers)
+        self.cache = VerdictCache()
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        self._generation = 0
+        self._mtimes = (0.0, 0.0, 0.0)
+        self._reload_lock = asyncio.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.model_path, self.compiled_path, self.cascade_path),
+        )
+
+    def _ensure_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = self._create_pool()
+        return self._pool
+
+    def _model_mtimes(self) -> Tuple[float, ...]:
+        mtimes = []
+        for path in (self.model_path, self.compiled_path, self.cascade_path):
+            try:
+                mtimes.append(os.path.getmtime(path) if path else 0.0)
+            except OSError:
+                mtimes.append(0.0)
+        return tuple(mtimes)
+
+    @staticmethod
+    def _model_id(mtimes: Tuple[float, ...]) -> bytes:
+        # Tags the verdict cache file, so a model retrained while the bot was stopped
+        # doesn't inherit the previous model's probabilities.
+        return hashlib.blake2b(repr(mtimes).encode(), digest_size=16).digest()
+
+    async def _check_pool(self, pool: ProcessPoolExecutor) -> bool:
+        # Touch every worker (spawning it and running its initializer), then score
+        # the canned inputs: probabilities must be valid and rank spam above ham.
+        loop = asyncio.get_running_loop()
+        loaded = await asyncio.gather(*(loop.run_in_executor(pool, _model_loaded) for _ in range(self.workers)))
+        if not all(loaded):
+            return False
+        probs, _ = await loop.run_in_executor(pool, _predict_cascade, SANITY_SPAM + SANITY_HAM)
+        if any(p is None or not 0.0 <= p <= 1.0 for p in probs):
+            return False
+        spam, ham = probs[:len(SANITY_SPAM)], probs[len(SANITY_SPAM):]
+        return sum(spam) / len(spam) > sum(ham) / len(ham)
+
+    async def start(self):
+        # Returns at once: spawning the workers, unpickling the model and reading the
+        # verdict cache happen in the background, and `ready` is set when they finish.
+        # Texts scored before that wait in the pool's queue.
+        self._mtimes = self._model_mtimes()
+        self.cache.model_id = self._model_id(self._mtimes)
+        self._ensure_pool()
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self):
+        started = time.perf_counter()
+        await self.cache.load_async()
+        try:
+            self.model_loaded = await self._check_pool(self._ensure_pool())
+        except Exception:
+            logger.exception("Scoring pool failed to start")
+            self.model_loaded = False
+        logger.info("Scoring pool started in %.2f s: %d workers, model loaded=%s",
+                    time.perf_counter() - started, self.workers, self.model_loaded)
+        self.ready.set()
+        if self._watch_task is None and MODEL_WATCH_INTERVAL:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def reload(self) -> bool:
+        # Load the model into a new pool in the background and swap it in only if it
+        # passes the sanity check; the current pool keeps serving until then.
+        async with self._reload_lock:
+            logger.info("Reloading ML model...")
+            mtimes = self._mtimes = self._model_mtimes()
+            pool = self._create_pool()
+            try:
+                ok = await self._check_pool(pool)
+            except Exception:
+                logger.exception("New model pool crashed during warm-up")
+                ok = False
+            if not ok:
+                pool.shutdown(wait=False, cancel_futures=True)
+                logger.error("New ML model failed sanity checks, keeping the previous one")
+                return False
+
+            old_pool, self._pool = self._pool, pool
+            self._generation += 1
+            self.cache.clear()
+            self.cache.model_id = self._model_id(mtimes)
+            self.model_loaded = True
+            if old_pool is not None:
+                # Batches already submitted to the old pool still complete.
+                old_pool.shutdown(wait=False)
+            logger.info("ML model reloaded")
+            return True
+
+    async def _watch(self):
+        pending = None
+        while True:
+            await asyncio.sleep(MODEL_WATCH_INTERVAL)
+            mtimes = self._model_mtimes()
+            if mtimes == self._mtimes:
+                pending = None
+                continue
+            # Reload once the files stop changing, so a half-written model isn't picked up.
+            if mtimes != pending:
+                pending = mtimes
+                continue
+            pending = None
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Model reload failed")
+
+    async def _predict(self, texts: List[str]) -> List[Optional[float]]:
+        loop = asyncio.get_running_loop()
+        probs, prescreened = await loop.run_in_executor(self._ensure_pool(), _predict_cascade, texts)
+        self.prescreened += prescreened
+        self.full_scored += len(texts) - prescreened
+        return probs
+
+    async def score(self, text: str) -> Optional[float]:
+        key = text_key(text)
+        prob = self.cache.get(key)
+        if prob is not None:
+            return prob
+
+        # Identical texts arriving together share one model call.
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._score_uncached(key, text))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(fut)
+
+    async def _score_uncached(self, key: bytes, text: str) -> Optional[float]:
+        generation = self._generation
+        prob = await self.batcher.score(text)
+        if prob is not None and generation == self._generation:
+            self.cache.put(key, prob)
+        return prob
+
+    async def shutdown(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            await asyncio.gather(self._warm_up_task, return_exceptions=True)
+            self._warm_up_task = None
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        await self.batcher.stop()
+        if self.ready.is_set():
+            # Stopped mid warm-up the cache holds only this run's verdicts; keep the file.
+            self.cache.save()
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+            logger.info("Scoring pool stopped")
+
+
+scorer = ScoringBackend()
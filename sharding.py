@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from typing import Any, Callable, Dict, List, Optional
+
+import config
+import metrics
+from config import (
+    METRICS_HOST,
+    METRICS_PORT,
+    RUN_MODE,
+    SHARD_CHECK_INTERVAL,
+    SHARD_MAX_CONCURRENCY,
+    SHARD_QUEUE_SIZE,
+    SHARD_RESTART_DELAY,
+    SHARD_STOP_TIMEOUT,
+    SHARDS,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+# Queue items with this key carry a campaign index change from another shard, not an update.
+CAMPAIGN_EVENT = "_campaign"
+
+def update_chat_id(update: Dict[str, Any]) -> int:
+    # The chat an update belongs to: message-like payloads carry "chat" directly,
+    # callback queries carry it on their message, and chat-less updates (inline
+    # queries and the like) fall back to the sender so they still shard stably.
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"]
+    return 0
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    return chat_id % shards
+
+
+def _shard_path(path: Optional[str], index: int) -> Optional[str]:
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def _configure_worker(index: int, shards: int):
+    # Runs in the worker before main is imported: the bot modules read config at import.
+    # Each shard gets its slice of the CPUs and of the bot-wide Telegram rate limit, its
+    # own cache files, and a metrics port the supervisor scrapes. Only shard 0 runs
+    # retention, since the database is shared. The campaign index file is per shard too,
+    # but its contents are replicated (see ShardSupervisor._relay).
+    config.SCORING_WORKERS = max(1, (os.cpu_count() or 1) // shards)
+    config.ACTIONS_GLOBAL_RATE = config.ACTIONS_GLOBAL_RATE / shards
+    config.ACTIONS_GLOBAL_BURST = max(1, config.ACTIONS_GLOBAL_BURST // shards)
+    config.VERDICT_CACHE_PATH = _shard_path(config.VERDICT_CACHE_PATH, index)
+    config.CAMPAIGN_INDEX_PATH = _shard_path(config.CAMPAIGN_INDEX_PATH, index)
+    if config.METRICS_PORT:
+        config.METRICS_PORT = config.METRICS_PORT + 1 + index
+    if index:
+        config.RETENTION_INTERVAL = 0
+
+
+def _worker_main(index: int, shards: int, updates, processed, events, setup: Optional[Callable[[int], None]]):
+    # Ctrl+C reaches the whole process group; workers stop on the supervisor's sentinel.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"[shard {index}] %(levelname)s:%(name)s:%(message)s")
+    _configure_worker(index, shards)
+    if setup is not None:
+        setup(index)
+    asyncio.run(_worker_loop(index, updates, processed, events))
+
+
+async def _worker_loop(index: int, updates, processed, events):
+    import main
+
+    metrics_runner = await metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+    main.campaign_index.listener = lambda event: events.put((index, event))
+    await main.on_startup()
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(SHARD_MAX_CONCURRENCY)
+    tasks = set()
+
+    def receive() -> List[Optional[Dict[str, Any]]]:
+        batch = [updates.get()]
+        while batch[-1] is not None and len(batch) < SHARD_MAX_CONCURRENCY:
+            try:
+                batch.append(updates.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    async def handle(update: Dict[str, Any]):
+        try:
+            await main.dp.feed_raw_update(main.bot, update)
+        except Exception:
+            logger.exception("Shard %d failed to process update %s", index, update.get("update_id"))
+        finally:
+            slots.release()
+            with processed.get_lock():
+                processed[index] += 1
+
+    stopping = False
+    while not stopping:
+        for update in await loop.run_in_executor(None, receive):
+            if update is None:
+                stopping = True
+                break
+            if CAMPAIGN_EVENT in update:
+                main.campaign_index.apply(update[CAMPAIGN_EVENT])
+                continue
+            await slots.acquire()
+            task = asyncio.create_task(handle(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks)
+    await main.on_shutdown()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await main.bot.session.close()
+
+
+class ShardSupervisor:
+    # Owns one IPC queue per shard and the worker processes reading them. A chat always
+    # maps to the same shard, so its updates stay in order and its in-memory state
+    # (settings, admins, warnings, FSM) lives in one process. The campaign index is the
+    # exception: it is matched across chats, so every shard keeps a full replica and
+    # reports its additions on `events` for the others. Workers that exit are
+    # restarted; updates queued for or held by the dead worker are lost.
+    def __init__(
+        self,
+        shards: int = SHARDS,
+        queue_size: int = SHARD_QUEUE_SIZE,
+        setup: Optional[Callable[[int], None]] = None,
+    ):
+        self.shards = max(1, shards)
+        self.setup = setup
+        self.queue_size = queue_size
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(self.shards)]
+        self.processed = self._ctx.Array("q", self.shards)
+        self.events = self._ctx.Queue()
+        self._relay_task: Optional[asyncio.Task] = None
+        self.processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * self.shards
+        self._watch_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # Created here rather than at import so shard processes don't export them too.
+        self.routed = metrics.Counter("bot_shard_updates_routed_total", "Updates handed to each shard", ["shard"])
+        self.restarts = metrics.Counter("bot_shard_restarts_total", "Shard worker processes restarted after exiting", ["shard"])
+
+    def start(self):
+        for index in range(self.shards):
+            self._spawn(index)
+        self._watch_task = asyncio.create_task(self._watch())
+        self._relay_task = asyncio.create_task(self._relay())
+
+    def _spawn(self, index: int):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self.shards, self.queues[index], self.processed, self.events, self.setup),
+            name=f"shard-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info("Started shard %d (pid %s)", index, process.pid)
+
+    async def _watch(self):
+        while not self._stopping:
+            await asyncio.sleep(SHARD_CHECK_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if self._stopping or process is None or process.is_alive():
+                    continue
+                # A killed worker may still hold the queue's reader lock, so its replacement
+                # gets a fresh queue; whatever was waiting in the old one is dropped.
+                stale, self.queues[index] = self.queues[index], self._ctx.Queue(maxsize=self.queue_size)
+                try:
+                    lost = stale.qsize()
+                except NotImplementedError:
+                    lost = -1
+                stale.cancel_join_thread()
+                logger.error("Shard %d exited with code %s, restarting (%d queued updates lost)", index, process.exitcode, lost)
+                self.restarts.inc(str(index))
+                await asyncio.sleep(SHARD_RESTART_DELAY)
+                if not self._stopping:
+                    self._spawn(index)
+
+    async def _relay(self):
+        # Campaign index changes are rare (confident spam, cross-chat reports), so they
+        # are simply broadcast through the update queues, in order with the updates.
+        while True:
+            item = await asyncio.to_thread(self.events.get)
+            if item is None:
+                return
+            source, event = item
+            for index, updates in enumerate(self.queues):
+                if index == source:
+                    continue
+                try:
+                    updates.put_nowait({CAMPAIGN_EVENT: event})
+                except queue.Full:
+                    if not self._stopping:
+                        await asyncio.to_thread(updates.put, {CAMPAIGN_EVENT: event})
+
+    async def route(self, update: Dict[str, Any]):
+        index = shard_for(update_chat_id(update), self.shards)
+        try:
+            self.queues[index].put_nowait(update)
+        except queue.Full:
+            # Backpressure: stop taking updates until the shard catches up.
+            await asyncio.to_thread(self.queues[index].put, update)
+        self.routed.inc(str(index))
+
+    @property
+    def total_processed(self) -> int:
+        return sum(self.processed[:])
+
+    async def stop(self, timeout: float = SHARD_STOP_TIMEOUT):
+        self._stopping = True
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+        for updates in self.queues:
+            await asyncio.to_thread(updates.put, None)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning("Shard %d did not stop in %ss, terminating", index, timeout)
+                process.terminate()
+                await asyncio.to_thread(process.join)
+        # After the shards, so their last events are drained and don't block their exit.
+        if self._relay_task is not None:
+            self.events.put(None)
+            await asyncio.gather(self._relay_task, return_exceptions=True)
+            self._relay_task = None
+        logger.info("Shards stopped: processed=%s", self.processed[:])
+
+
+def _label_shard(line: str, index: int) -> str:
+    name, brace, rest = line.partition("{")
+    if brace:
+        return f'{name}{{shard="{index}",{rest}'
+    name, _, value = line.partition(" ")
+    return f'{name}{{shard="{index}"}} {value}'
+
+
+def merge_metrics(texts: List[Optional[str]]) -> str:
+    # Joins the shards' Prometheus pages into one, adding a shard label to every sample
+    # and keeping each metric family's samples together as the format requires.
+    families: Dict[str, List[str]] = {}
+    for index, text in enumerate(texts):
+        if text is None:
+            continue
+        family: List[str] = []
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                family = families.setdefault(line.split(" ", 3)[2], [])
+                if line not in family[:2]:
+                    family.append(line)
+            else:
+                family.append(_label_shard(line, index))
+    return "".join(line + "\n" for lines in families.values() for line in lines)
+
+
+async def start_metrics_server(supervisor: ShardSupervisor, host: str = METRICS_HOST, port: Optional[int] = METRICS_PORT):
+    if not port:
+        return None
+    from aiohttp import ClientSession, ClientTimeout, web
+
+    async def scrape(http: ClientSession, index: int) -> Optional[str]:
+        try:
+            async with http.get(f"http://{host}:{port + 1 + index}/metrics") as response:
+                return await response.text()
+        except Exception:
+            return None
+
+    async def handle(request):
+        async with ClientSession(timeout=ClientTimeout(total=2)) as http:
+            texts = await asyncio.gather(*(scrape(http, index) for index in range(supervisor.shards)))
+        own = supervisor.routed.render() + "\n" + supervisor.restarts.render() + "\n"
+        return web.Response(text=own + merge_metrics(list(texts)), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Combined shard metrics available at http://%s:%s/metrics", host, port)
+    return runner
+
+
+async def _poll(bot, supervisor: ShardSupervisor, allowed_updates: List[str], stop: asyncio.Event):
+    offset = None
+    failures = 0
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=10, allowed_updates=allowed_updates)
+            failures = 0
+        except Exception:
+            failures += 1
+            logger.exception("getUpdates failed")
+            await asyncio.sleep(min(30, 2 ** failures))
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await supervisor.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def run_sharded(shards: int = SHARDS):
+    # The ingester: receives updates (polling or webhook, per RUN_MODE) and routes them;
+    # all handling happens in the shard processes.
+    import db
+    import main
+    from webhook import WebhookServer
+
+    # Schema setup once here, so the shards don't race each other migrating it.
+    await asyncio.to_thread(db.init)
+    supervisor = ShardSupervisor(shards)
+    supervisor.start()
+    metrics_runner = await start_metrics_server(supervisor)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    allowed_updates = main.dp.resolve_used_update_types()
+    try:
+        if RUN_MODE == "webhook":
+            server = WebhookServer(main.dp, main.bot, process=lambda bot, update: supervisor.route(update))
+            await server.start()
+            await main.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=allowed_updates,
+            )
+            try:
+                await stop.wait()
+            finally:
+                await server.stop()
+        else:
+            poller = asyncio.create_task(_poll(main.bot, supervisor, allowed_updates, stop))
+            await stop.wait()
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        await supervisor.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await main.bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot as an update ingester plus chat_id-sharded worker processes")
+    parser.add_argument("--shards", type=int, default=SHARDS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_sharded(args.shards))
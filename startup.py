@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram import types
+
+from config import STARTUP_DEFER_LIMIT, STARTUP_POLICY, STARTUP_WAIT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+def _process_age() -> float:
+    # Seconds since the process started, imports included (Linux only; 0 elsewhere).
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0.0
+
+
+class Startup:
+    # Staged startup: the dispatcher takes updates as soon as the cheap parts are up, and
+    # the model and caches load behind `ready`. Records time to first update and to ready,
+    # both measured from process start.
+    def __init__(
+        self,
+        policy: str = STARTUP_POLICY,
+        wait_timeout: float = STARTUP_WAIT_TIMEOUT,
+        defer_limit: int = STARTUP_DEFER_LIMIT,
+    ):
+        self.policy = policy
+        self.wait_timeout = wait_timeout
+        self.started = time.monotonic() - _process_age()
+        self.first_update: Optional[float] = None
+        self.ready_after: Optional[float] = None
+        self.ready = asyncio.Event()
+        self.deferred: Deque[types.Message] = deque()
+        self.defer_limit = defer_limit
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def track_first_update(self, handler: Callable[..., Awaitable[Any]], event: types.Update, data: Dict[str, Any]):
+        if self.first_update is None:
+            self.first_update = time.monotonic() - self.started
+            logger.info("First update received %.2f s after start", self.first_update)
+        return await handler(event, data)
+
+    def mark_ready(self):
+        self.ready_after = time.monotonic() - self.started
+        self.ready.set()
+        logger.info("Ready %.2f s after start (%d messages deferred, %d dropped)",
+                    self.ready_after, len(self.deferred), self.dropped)
+
+    async def admit(self, message: types.Message) -> bool:
+        # Whether a message that needs the model may be scored now; if not it is kept
+        # for replay() (the oldest is dropped once defer_limit is reached).
+        if self.ready.is_set():
+            return True
+        if self.policy == "queue":
+            try:
+                await asyncio.wait_for(asyncio.shield(self.ready.wait()), self.wait_timeout)
+                return True
+            except asyncio.TimeoutError:
+                pass
+        if len(self.deferred) >= self.defer_limit:
+            self.deferred.popleft()
+            self.dropped += 1
+        self.deferred.append(message)
+        return False
+
+    async def replay(self, handle: Callable[[types.Message], Awaitable[None]]):
+        while self.deferred:
+            message = self.deferred.popleft()
+            try:
+                await handle(message)
+            except Exception:
+                logger.exception("Failed to process deferred message in chat %s", message.chat.id)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+startup = Startup()
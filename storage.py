@@ -0,0 +1,310 @@
+import asyncio
+import csv
+import logging
+import queue
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, TextIO, Tuple
+
+from config import BANNED_EXPORT_FETCH_SIZE
+from db import connect, text_hash
+
+logger = logging.getLogger(__name__)
+
+# Hot statements are module constants so the connection's statement cache
+# (keyed by SQL text) reuses their compiled form.
+SELECT_WARNINGS = "SELECT user_id, count, updated_at FROM warnings WHERE chat_id=?"
+UPSERT_WARNINGS = (
+    "INSERT INTO warnings (chat_id, user_id, count, updated_at) VALUES (?,?,?,?) "
+    "ON CONFLICT (chat_id, user_id) DO UPDATE SET count=excluded.count, updated_at=excluded.updated_at"
+)
+DELETE_WARNINGS = "DELETE FROM warnings WHERE chat_id=? AND user_id=?"
+# Rows whose every warning has decayed, for members who never came back to reset them.
+PURGE_WARNINGS = (
+    "DELETE FROM warnings WHERE count <= 0 OR EXISTS (SELECT 1 FROM chats WHERE chats.chat_id = warnings.chat_id "
+    "AND chats.warn_decay > 0 AND warnings.updated_at + warnings.count * chats.warn_decay <= ?)"
+)
+INSERT_BANNED = "INSERT INTO banned (chat_id, user_id, reason) VALUES (?,?,?)"
+# /banned pages are keyset-paginated over idx_banned_chat_created, newest first. The
+# cursor is a row id; its (created_at, id) is looked up by primary key.
+SELECT_BANNED_FIRST = (
+    "SELECT id, user_id, reason, created_at FROM banned WHERE chat_id=? "
+    "ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+SELECT_BANNED_OLDER = (
+    "SELECT id, user_id, reason, created_at FROM banned WHERE chat_id=? "
+    "AND (created_at, id) < (SELECT created_at, id FROM banned WHERE id=?) "
+    "ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+SELECT_BANNED_NEWER = (
+    "SELECT id, user_id, reason, created_at FROM banned WHERE chat_id=? "
+    "AND (created_at, id) > (SELECT created_at, id FROM banned WHERE id=?) "
+    "ORDER BY created_at, id LIMIT ?"
+)
+SELECT_BANNED_USER = (
+    "SELECT id, user_id, reason, created_at FROM banned WHERE chat_id=? AND user_id=? "
+    "ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+SELECT_BANNED_EXPORT = "SELECT user_id, reason, created_at FROM banned WHERE chat_id=? ORDER BY created_at, id"
+INSERT_CHAT = "INSERT OR IGNORE INTO chats (chat_id) VALUES (?)"
+SELECT_CHAT = (
+    "SELECT chat_id, threshold, anon_reports, logging, max_warnings, punishment, warn_decay, auto_threshold "
+    "FROM chats WHERE chat_id=?"
+)
+SELECT_CHAT_STATS = "SELECT deleted, reports, banned FROM chat_stats WHERE chat_id=?"
+SELECT_CHAT_STATS_DAILY = (
+    "SELECT CAST(julianday(date('now')) - julianday(day) AS INTEGER), deleted, reports, banned "
+    "FROM chat_stats_daily WHERE chat_id=? AND day >= date('now', ?)"
+)
+SELECT_REPUTATION = "SELECT user_id, clean, first_seen FROM reputation WHERE chat_id=?"
+UPSERT_REPUTATION = (
+    "INSERT INTO reputation (chat_id, user_id, clean, first_seen) VALUES (?,?,?,?) "
+    "ON CONFLICT (chat_id, user_id) DO UPDATE SET clean=excluded.clean, first_seen=excluded.first_seen"
+)
+INSERT_TEXT = "INSERT OR IGNORE INTO message_texts (hash, text) VALUES (?,?)"
+INSERT_LOGS = {
+    "ml_logs": "INSERT INTO ml_logs (chat_id, text_hash, spam_prob, is_deleted) VALUES (?,?,?,?)",
+    "reports": "INSERT INTO reports (chat_id, message_text, spam_prob, reporter_id) VALUES (?,?,?,?)",
+}
+
+STATS_WINDOWS = (1, 7, 30)
+SETTINGS_FIELDS = ("threshold", "anon_reports", "logging", "max_warnings", "punishment", "warn_decay", "auto_threshold")
+
+
+class Storage:
+    # Every query from the bot runs on one dedicated thread that owns its SQLite
+    # connection, so coroutines never block the event loop (or wait out busy_timeout
+    # behind the log writer) and never share cursor state. Calls run in submission
+    # order, which is also what SQLite's single writer wants.
+    def __init__(self):
+        self._queue: "queue.SimpleQueue[Optional[Tuple]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # Process-local copy of the chats table. Settings are read on every group
+        # message, so they are served from memory and only written through on change.
+        self._settings: Dict[int, Dict[str, Any]] = {}
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def cached_chats(self) -> List[int]:
+        # Chats this process has served since it started.
+        return list(self._settings)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="storage", daemon=True)
+                self._thread.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((loop, future, fn, args))
+        return await future
+
+    def _worker(self):
+        conn = connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                # Everything queued while the previous batch ran is executed back to back
+                # and handed to the event loop with one wakeup per loop.
+                batch = [item]
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(item)
+
+                results: Dict[asyncio.AbstractEventLoop, List[Tuple]] = {}
+                for loop, future, fn, args in batch:
+                    try:
+                        outcome = (future, fn(conn, *args), None)
+                    except Exception as e:
+                        outcome = (future, None, e)
+                    results.setdefault(loop, []).append(outcome)
+                for loop, outcomes in results.items():
+                    loop.call_soon_threadsafe(_resolve, outcomes)
+        finally:
+            conn.close()
+
+    async def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(thread.join)
+
+    async def get_chat_settings(self, chat_id: int) -> Dict[str, Any]:
+        settings = self._settings.get(chat_id)
+        if settings is None:
+            settings = await self.run(_load_chat, chat_id)
+            settings = self._settings.setdefault(chat_id, settings)
+        return settings
+
+    async def set_chat_field(self, chat_id: int, field: str, value):
+        if field not in SETTINGS_FIELDS:
+            raise ValueError(f"Unknown chat setting: {field}")
+        settings = await self.get_chat_settings(chat_id)
+        await self.run(_update_chat, chat_id, field, value)
+        settings[field] = bool(value) if field in ("anon_reports", "logging", "auto_threshold") else value
+
+    async def load_warnings(self, chat_id: int) -> List[Tuple[int, int, int]]:
+        return await self.run(_fetchall, SELECT_WARNINGS, (chat_id,))
+
+    async def save_warnings(self, upserts: List[Tuple[int, int, int, int]], deletes: List[Tuple[int, int]]):
+        await self.run(_save_warnings, upserts, deletes)
+
+    async def purge_warnings(self, now: int):
+        await self.run(_execute, PURGE_WARNINGS, (now,))
+
+    async def add_banned(self, chat_id: int, user_id: int, reason: str):
+        await self.run(_execute, INSERT_BANNED, (chat_id, user_id, reason))
+
+    async def add_banned_many(self, rows: List[Tuple[int, int, str]]):
+        await self.run(_executemany, INSERT_BANNED, rows)
+
+    async def banned_page(
+        self, chat_id: int, limit: int, older_than: Optional[int] = None, newer_than: Optional[int] = None
+    ) -> List[Tuple[int, int, str, str]]:
+        # Rows come back newest first in every direction; callers ask for one extra
+        # row to learn whether there is a further page.
+        if newer_than is not None:
+            rows = await self.run(_fetchall, SELECT_BANNED_NEWER, (chat_id, newer_than, limit))
+            return rows[::-1]
+        if older_than is not None:
+            return await self.run(_fetchall, SELECT_BANNED_OLDER, (chat_id, older_than, limit))
+        return await self.run(_fetchall, SELECT_BANNED_FIRST, (chat_id, limit))
+
+    async def find_banned(self, chat_id: int, user_id: int, limit: int) -> List[Tuple[int, int, str, str]]:
+        return await self.run(_fetchall, SELECT_BANNED_USER, (chat_id, user_id, limit))
+
+    async def get_chat_stats(self, chat_id: int) -> Dict[str, Any]:
+        return await self.run(_chat_stats, chat_id)
+
+    async def load_reputation(self, chat_id: int) -> List[Tuple[int, int, int]]:
+        return await self.run(_fetchall, SELECT_REPUTATION, (chat_id,))
+
+    async def save_reputation(self, rows: List[Tuple[int, int, int, int]]):
+        await self.run(_executemany, UPSERT_REPUTATION, rows)
+
+    async def write_logs(self, rows: List[Tuple[str, Tuple]]):
+        await self.run(_write_logs, rows)
+
+
+def export_banned_csv(chat_id: int, file: TextIO, fetch_size: int = BANNED_EXPORT_FETCH_SIZE) -> int:
+    # Runs on its own thread and read connection, not the storage thread: a large export
+    # would otherwise hold up every other query. Rows are streamed to the file in chunks.
+    conn = connect()
+    try:
+        writer = csv.writer(file)
+        writer.writerow(("user_id", "reason", "created_at"))
+        cursor = conn.execute(SELECT_BANNED_EXPORT, (chat_id,))
+        count = 0
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return count
+            writer.writerows(rows)
+            count += len(rows)
+    finally:
+        conn.close()
+
+
+def _resolve(outcomes: List[Tuple]):
+    for future, result, error in outcomes:
+        if future.cancelled():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+def _execute(conn: sqlite3.Connection, sql: str, params: Tuple):
+    with conn:
+        conn.execute(sql, params)
+
+
+def _executemany(conn: sqlite3.Connection, sql: str, rows: List[Tuple]):
+    with conn:
+        conn.executemany(sql, rows)
+
+
+def _fetchall(conn: sqlite3.Connection, sql: str, params: Tuple) -> List[Tuple]:
+    return conn.execute(sql, params).fetchall()
+
+
+def _load_chat(conn: sqlite3.Connection, chat_id: int) -> Dict[str, Any]:
+    row = conn.execute(SELECT_CHAT, (chat_id,)).fetchone()
+    if row is None:
+        with conn:
+            conn.execute(INSERT_CHAT, (chat_id,))
+        row = conn.execute(SELECT_CHAT, (chat_id,)).fetchone()
+    return {
+        "chat_id": row[0],
+        "threshold": row[1],
+        "anon_reports": bool(row[2]),
+        "logging": bool(row[3]),
+        "max_warnings": row[4],
+        "punishment": row[5],
+        "warn_decay": row[6],
+        "auto_threshold": bool(row[7]),
+    }
+
+
+def _update_chat(conn: sqlite3.Connection, chat_id: int, field: str, value):
+    with conn:
+        conn.execute(f"UPDATE chats SET {field}=? WHERE chat_id=?", (value, chat_id))
+
+
+def _save_warnings(conn: sqlite3.Connection, upserts: List[Tuple], deletes: List[Tuple]):
+    with conn:
+        conn.executemany(UPSERT_WARNINGS, upserts)
+        conn.executemany(DELETE_WARNINGS, deletes)
+
+
+def _chat_stats(conn: sqlite3.Connection, chat_id: int) -> Dict[str, Any]:
+    row = conn.execute(SELECT_CHAT_STATS, (chat_id,)).fetchone() or (0, 0, 0)
+    stats: Dict[str, Any] = {"deleted": row[0], "reports": row[1], "banned": row[2], "windows": {}}
+
+    # Windows are whole UTC days including today, summed from at most max(STATS_WINDOWS)
+    # daily rows read through the primary key.
+    rows = conn.execute(SELECT_CHAT_STATS_DAILY, (chat_id, f"-{max(STATS_WINDOWS) - 1} days")).fetchall()
+    for days in STATS_WINDOWS:
+        window = {"deleted": 0, "reports": 0, "banned": 0}
+        for age, deleted, reports, banned in rows:
+            if age < days:
+                window["deleted"] += deleted
+                window["reports"] += reports
+                window["banned"] += banned
+        stats["windows"][days] = window
+    return stats
+
+
+def _write_logs(conn: sqlite3.Connection, rows: List[Tuple[str, Tuple]]):
+    by_table: Dict[str, List[Tuple]] = {}
+    texts: Dict[bytes, str] = {}
+    for table, row in rows:
+        if table == "ml_logs":
+            chat_id, text, spam_prob, is_deleted = row
+            digest = text_hash(text)
+            texts[digest] = text
+            row = (chat_id, digest, spam_prob, is_deleted)
+        by_table.setdefault(table, []).append(row)
+
+    with conn:
+        if texts:
+            conn.executemany(INSERT_TEXT, texts.items())
+        for table, table_rows in by_table.items():
+            conn.executemany(INSERT_LOGS[table], table_rows)
+
+
+storage = Storage()
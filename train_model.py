@@ -1,46 +1,373 @@
-import joblib
-import pandas as pd
-from datasets import load_dataset
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
-from sklearn.pipeline import Pipeline
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report
-
-# 1. Загрузка датасета с Hugging Face
-print("Скачиваем датасет...")
-dataset = load_dataset("alt-gnome/telegram-spam")
-df = pd.DataFrame(dataset['train'])
-
-print(f"Всего сообщений: {len(df)}")
-print(df.head())
-
-# 2. Разделение на обучение и тест
-X_train, X_test, y_train, y_test = train_test_split(
-    df['text'], 
-    df['label'], 
-    test_size=0.2, 
-    random_state=42
-)
-
-# 3. Создание пайплайна (Векторизатор + Модель)
-# TfidfVectorizer превращает текст в матрицу чисел
-# LogisticRegression классифицирует эти числа
-pipeline = Pipeline([
-    ('tfidf', TfidfVectorizer(ngram_range=(1, 2), max_features=10000)), 
-    ('clf', LogisticRegression(solver='liblinear'))
-])
-
-# 4. Обучение
-print("Обучаем модель...")
-pipeline.fit(X_train, y_train)
-
-# 5. Оценка качества
-print("Результаты на тестовой выборке:")
-predictions = pipeline.predict(X_test)
-print(classification_report(y_test, predictions))
-
-# 6. Сохранение модели в файл
-model_filename = "spam_detector_model.pkl"
-joblib.dump(pipeline, model_filename)
-print(f"Модель сохранена в файл: {model_filename}")
\ No newline at end of file
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import classification_report, precision_score, recall_score, roc_auc_score
+from sklearn.pipeline import Pipeline
+from cascade import Prescreen, feature_matrix, save_prescreen, train_prescreen
+from compiled_model import CompiledScorer, export_compiled
+from config import CASCADE_PATH, COMPILED_MODEL_PATH, DB_PATH, MODEL_PATH, THRESHOLDS
+
+Example = Tuple[str, int]
+
+SPAM_LABELS = {"1", "spam", "true", "yes"}
+HAM_LABELS = {"0", "ham", "false", "no"}
+
+
+def parse_label(value) -> Optional[int]:
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return 1 if value >= 0.5 else 0
+    value = str(value).strip().lower()
+    if value in SPAM_LABELS:
+        return 1
+    if value in HAM_LABELS:
+        return 0
+    return None
+
+
+def _rows_to_examples(rows: Iterable[dict], text_column: str, label_column: str) -> Iterator[Example]:
+    for row in rows:
+        text = row.get(text_column)
+        label = parse_label(row.get(label_column))
+        if text and label is not None:
+            yield str(text), label
+
+
+# Источники данных: каждый читает данные потоком, не загружая их целиком.
+
+def iter_csv(path: str, text_column: str, label_column: str) -> Iterator[Example]:
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from _rows_to_examples(csv.DictReader(f), text_column, label_column)
+
+
+def iter_jsonl(path: str, text_column: str, label_column: str) -> Iterator[Example]:
+    with open(path, encoding="utf-8") as f:
+        yield from _rows_to_examples((json.loads(line) for line in f if line.strip()), text_column, label_column)
+
+
+def iter_parquet(path: str, text_column: str, label_column: str) -> Iterator[Example]:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Для чтения Parquet нужен pyarrow: pip install pyarrow")
+    for batch in pq.ParquetFile(path).iter_batches(columns=[text_column, label_column]):
+        yield from _rows_to_examples(batch.to_pylist(), text_column, label_column)
+
+
+def iter_hf(name: str, text_column: str, label_column: str) -> Iterator[Example]:
+    from datasets import load_dataset
+    yield from _rows_to_examples(load_dataset(name, split="train", streaming=True), text_column, label_column)
+
+
+def iter_db(path: str, ham_max_prob: float, spam_min_prob: Optional[float]) -> Iterator[Example]:
+    # Репорты админов - спам. Из ml_logs берутся уверенные ham-оценки (и, если задан
+    # --db-spam-min-prob, уверенно удалённый спам). Тексты, на которые был репорт,
+    # из ml_logs не берутся. Каждый текст выдаётся один раз.
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute("SELECT DISTINCT message_text FROM reports WHERE message_text IS NOT NULL AND message_text != ''")
+        for (text,) in cursor:
+            yield text, 1
+
+        queries = [(0, "spam_prob <= ?", ham_max_prob)]
+        if spam_min_prob is not None:
+            queries.append((1, "spam_prob >= ? AND is_deleted = 1", spam_min_prob))
+        for label, condition, prob in queries:
+            cursor = conn.execute(
+                f"SELECT text FROM message_texts WHERE hash IN (SELECT text_hash FROM ml_logs WHERE {condition}) "
+                f"UNION SELECT message_text FROM ml_logs WHERE message_text IS NOT NULL AND {condition} "
+                "EXCEPT SELECT message_text FROM reports",
+                (prob, prob)
+            )
+            for (text,) in cursor:
+                if text:
+                    yield text, label
+    finally:
+        conn.close()
+
+
+def iter_archive(path: str, ham_max_prob: float, spam_min_prob: Optional[float]) -> Iterator[Example]:
+    # Архив ml_logs, выгруженный retention.py, с теми же правилами разметки, что и для базы.
+    from retention import iter_archive as read_archive
+    for row in read_archive(path):
+        text, prob = row.get("text"), row.get("spam_prob")
+        if not text or prob is None:
+            continue
+        if prob <= ham_max_prob:
+            yield text, 0
+        elif spam_min_prob is not None and prob >= spam_min_prob and row.get("is_deleted"):
+            yield text, 1
+
+
+def make_source(spec: str, args) -> Callable[[], Iterator[Example]]:
+    # Фабрика, а не итератор: при нескольких эпохах источник читается заново.
+    kind, _, value = spec.partition(":")
+    if kind == "hf":
+        return lambda: iter_hf(value, args.text_column, args.label_column)
+    if kind == "db":
+        return lambda: iter_db(value or DB_PATH, args.db_ham_max_prob, args.db_spam_min_prob)
+    if kind == "archive":
+        return lambda: iter_archive(value or "archive/ml_logs", args.db_ham_max_prob, args.db_spam_min_prob)
+
+    readers = {".csv": iter_csv, ".jsonl": iter_jsonl, ".json": iter_jsonl, ".parquet": iter_parquet}
+    reader = readers.get(os.path.splitext(spec)[1].lower())
+    if reader is None:
+        raise SystemExit(f"Неизвестный источник: {spec}")
+    return lambda: reader(spec, args.text_column, args.label_column)
+
+
+class HoldoutSplit:
+    # Делит поток на обучение и тест по хешу текста: одинаковые тексты всегда попадают
+    # в одну часть, а тестовая часть ограничена reservoir-выборкой из max_size примеров.
+    def __init__(self, percent: float, max_size: int, seed: int):
+        self.percent = percent
+        self.max_size = max_size
+        self.rng = random.Random(seed)
+        self.texts: List[str] = []
+        self.labels: List[int] = []
+        self.seen = 0
+        self.train_count = 0
+
+    def is_test(self, text: str) -> bool:
+        return zlib.crc32(text.encode("utf-8")) % 10000 < self.percent * 100
+
+    def train(self, examples: Iterable[Example], collect_test: bool = True) -> Iterator[Example]:
+        for text, label in examples:
+            if not self.is_test(text):
+                self.train_count += 1
+                yield text, label
+                continue
+            if not collect_test:
+                continue
+            self.seen += 1
+            if len(self.texts) < self.max_size:
+                self.texts.append(text)
+                self.labels.append(label)
+            else:
+                slot = self.rng.randrange(self.seen)
+                if slot < self.max_size:
+                    self.texts[slot] = text
+                    self.labels[slot] = label
+
+
+def chunks(examples: Iterable[Example], size: int) -> Iterator[Tuple[List[str], List[int]]]:
+    texts: List[str] = []
+    labels: List[int] = []
+    for text, label in examples:
+        texts.append(text)
+        labels.append(label)
+        if len(texts) >= size:
+            yield texts, labels
+            texts, labels = [], []
+    if texts:
+        yield texts, labels
+
+
+def peak_rss_mb() -> float:
+    # Модуль resource есть только в Unix; в Windows пик памяти не выводится (0).
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def examples_from(sources: List[Callable[[], Iterator[Example]]]) -> Iterator[Example]:
+    for source in sources:
+        yield from source()
+
+
+def predict_in_chunks(model, texts: List[str], size: int) -> np.ndarray:
+    parts = [model.predict_proba(texts[i:i + size])[:, 1] for i in range(0, len(texts), size)]
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+
+def train_full(split: HoldoutSplit, sources, args):
+    # Исходный режим: TF-IDF по биграммам + логистическая регрессия, все данные в памяти.
+    print("Читаем данные...")
+    texts, labels = [], []
+    for text, label in split.train(examples_from(sources)):
+        texts.append(text)
+        labels.append(label)
+    print(f"Обучающих сообщений: {len(texts)}, тестовых: {len(split.texts)}")
+
+    pipeline = Pipeline([
+        ('tfidf', TfidfVectorizer(ngram_range=(1, 2), max_features=10000)),
+        ('clf', LogisticRegression(solver='liblinear'))
+    ])
+    print("Обучаем модель...")
+    pipeline.fit(texts, labels)
+
+    print("Обучаем предварительный фильтр каскада...")
+    weights, intercept = train_prescreen(texts, labels)
+    return pipeline, (weights, intercept)
+
+
+def train_stream(split: HoldoutSplit, sources, args):
+    # Потоковый режим: хешированные признаки и partial_fit по чанкам, память не зависит
+    # от объёма данных. Предварительный фильтр каскада учится на тех же чанках.
+    vectorizer = HashingVectorizer(
+        ngram_range=(1, 2), n_features=2 ** args.hash_bits, alternate_sign=False, norm="l2"
+    )
+    clf = SGDClassifier(loss="log_loss", alpha=args.alpha, random_state=args.seed)
+    prescreen = SGDClassifier(loss="log_loss", alpha=args.alpha, random_state=args.seed)
+    classes = np.array([0, 1])
+
+    for epoch in range(args.epochs):
+        examples = split.train(examples_from(sources), collect_test=epoch == 0)
+        for i, (texts, labels) in enumerate(chunks(examples, args.chunk_size), 1):
+            y = np.asarray(labels)
+            clf.partial_fit(vectorizer.transform(texts), y, classes=classes)
+            prescreen.partial_fit(feature_matrix(texts), y, classes=classes)
+            if i % 10 == 0:
+                print(f"Эпоха {epoch + 1}: {i * args.chunk_size} сообщений, пик RSS {peak_rss_mb():.0f} МБ")
+        print(f"Эпоха {epoch + 1} завершена: обучающих сообщений {split.train_count}, тестовых {len(split.texts)}")
+        split.train_count = 0
+
+    return Pipeline([("hash", vectorizer), ("clf", clf)]), (prescreen.coef_[0].astype("<f8"), float(prescreen.intercept_[0]))
+
+
+def report(name: str, y_true: np.ndarray, probs: np.ndarray):
+    print(f"Результаты {name} на тестовой выборке:")
+    print(classification_report(y_true, (probs >= 0.5).astype(int), zero_division=0))
+    if len(set(y_true.tolist())) > 1:
+        print(f"ROC AUC: {roc_auc_score(y_true, probs):.4f}")
+    for level, threshold in THRESHOLDS.items():
+        predicted = (probs >= threshold).astype(int)
+        print(f"Порог {level} ({threshold}): precision {precision_score(y_true, predicted, zero_division=0):.3f}, "
+              f"recall {recall_score(y_true, predicted, zero_division=0):.3f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Обучение модели детекции спама")
+    parser.add_argument(
+        "sources", nargs="*", default=["hf:alt-gnome/telegram-spam"],
+        help="файлы .csv/.jsonl/.parquet, db[:путь] (репорты и ml_logs бота), "
+             "archive[:каталог] (архив ml_logs) или hf:<датасет>",
+    )
+    parser.add_argument("--mode", choices=["full", "stream"], default="full",
+                        help="full - TF-IDF в памяти, stream - хешированные признаки и partial_fit")
+    parser.add_argument("--text-column", default="text")
+    parser.add_argument("--label-column", default="label")
+    parser.add_argument("--test-percent", type=float, default=20.0)
+    parser.add_argument("--max-test", type=int, default=50000, help="предел размера тестовой выборки")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--hash-bits", type=int, default=20)
+    parser.add_argument("--alpha", type=float, default=1e-6)
+    parser.add_argument("--db-ham-max-prob", type=float, default=0.05)
+    parser.add_argument("--db-spam-min-prob", type=float)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=MODEL_PATH, help="файл модели .pkl")
+    parser.add_argument("--compiled-output", help="компактный скорер (по умолчанию рядом с --output, .bin)")
+    parser.add_argument("--cascade-output", help="фильтр каскада (по умолчанию рядом с --output, .prescreen.npz)")
+    args = parser.parse_args(argv)
+    # Все три файла должны относиться к одной модели: с --output остальные по умолчанию
+    # пишутся рядом с ним, а не поверх рабочих COMPILED_MODEL_PATH и CASCADE_PATH.
+    base = os.path.splitext(args.output)[0]
+    custom = os.path.abspath(args.output) != os.path.abspath(MODEL_PATH)
+    if args.compiled_output is None:
+        args.compiled_output = base + ".bin" if custom else COMPILED_MODEL_PATH
+    if args.cascade_output is None:
+        args.cascade_output = base + ".prescreen.npz" if custom else CASCADE_PATH
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started_all = time.perf_counter()
+    sources = [make_source(spec, args) for spec in args.sources]
+    split = HoldoutSplit(args.test_percent, args.max_test, args.seed)
+
+    # 1-4. Чтение данных и обучение
+    started = time.perf_counter()
+    if args.mode == "stream":
+        model, (weights, intercept) = train_stream(split, sources, args)
+    else:
+        model, (weights, intercept) = train_full(split, sources, args)
+    train_time = time.perf_counter() - started
+    print(f"Обучение заняло {train_time:.1f} с, пик RSS {peak_rss_mb():.0f} МБ")
+
+    # 5. Оценка качества
+    y_test = np.asarray(split.labels)
+    expected = predict_in_chunks(model, split.texts, args.chunk_size)
+    if len(y_test):
+        report("модели", y_test, expected)
+    else:
+        print("Тестовая выборка пуста, оценка пропущена")
+
+    # 6. Сохранение модели в файл
+    joblib.dump(model, args.output)
+    print(f"Модель сохранена в файл: {args.output}")
+
+    # 7-8. Экспорт компактного скорера и проверка совпадения с пайплайном
+    if args.mode == "full":
+        export_compiled(model, args.compiled_output)
+        started = time.perf_counter()
+        compiled = CompiledScorer(args.compiled_output)
+        print(f"Скомпилированная модель сохранена в файл: {args.compiled_output} "
+              f"(загрузка {(time.perf_counter() - started) * 1000:.1f} мс)")
+        actual = compiled.predict_proba(split.texts)[:, 1]
+        max_diff = float(np.abs(expected - actual).max()) if len(expected) else 0.0
+        print(f"Максимальное расхождение вероятностей: {max_diff:.3e}")
+        if max_diff > 1e-9:
+            os.remove(args.compiled_output)
+            raise SystemExit("Скомпилированная модель расходится с пайплайном и была удалена")
+        full_model = compiled
+    else:
+        # Компактный скорер поддерживает только TF-IDF; старый файл не должен перекрывать новую модель.
+        if os.path.exists(args.compiled_output):
+            os.remove(args.compiled_output)
+            print(f"Удалён устаревший {args.compiled_output}: бот загрузит {args.output}")
+        full_model = None
+
+    # 9. Каскад: дешёвый предварительный фильтр (хешированные униграммы + признаки ссылок/упоминаний).
+    # Уверенные оценки вне полосы [CASCADE_LOW, CASCADE_HIGH] окончательные, остальное идёт в полную модель.
+    save_prescreen(weights, intercept, args.cascade_output)
+    prescreen = Prescreen(args.cascade_output)
+    print(f"Каскад сохранён в файл: {args.cascade_output}")
+
+    if len(y_test):
+        texts = split.texts
+        started = time.perf_counter()
+        first = np.array([prescreen.score(text) for text in texts])
+        prescreen_time = time.perf_counter() - started
+        started = time.perf_counter()
+        if full_model is not None:
+            for text in texts:
+                full_model.score(text)
+        else:
+            predict_in_chunks(model, texts, args.chunk_size)
+        full_time = time.perf_counter() - started
+
+        decided = (first < prescreen.low) | (first > prescreen.high)
+        cascade = np.where(decided, first, expected)
+        print(f"Предварительный фильтр решает {decided.mean():.1%} сообщений "
+              f"(ham: {(first < prescreen.low).mean():.1%}, спам: {(first > prescreen.high).mean():.1%}), "
+              f"полная модель - {1 - decided.mean():.1%}")
+        print(f"Время на сообщение: фильтр {prescreen_time / len(texts) * 1e6:.1f} мкс, "
+              f"полная модель {full_time / len(texts) * 1e6:.1f} мкс")
+        for name, threshold in THRESHOLDS.items():
+            agree = ((cascade >= threshold) == (expected >= threshold)).mean()
+            print(f"Порог {name} ({threshold}): совпадение каскада с полной моделью {agree:.2%}")
+        report("каскада", y_test, cascade)
+
+    print(f"Всего: {time.perf_counter() - started_all:.1f} с, пик RSS {peak_rss_mb():.0f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import VERDICT_CACHE_PATH, VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# File layout: a header naming the model that produced the verdicts, then records of
+# 16-byte key, probability, creation time (unix seconds).
+_MAGIC = b"VRDC2\0\0\0"  # 2: keys use lower() instead of casefold()
+_HEADER = struct.Struct("<8s16s")
+_RECORD = struct.Struct("<16sdd")
+
+
+def text_key(text: str) -> bytes:
+    # lower(), as the model's vectorizer does: casefold() would merge texts the model
+    # tells apart ("ß"/"ss", final sigma).
+    normalized = " ".join(text.lower().split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+
+class VerdictCache:
+    # LRU + TTL cache of model probabilities keyed by a hash of the normalized text,
+    # shared by all chats. Entry size is fixed, so memory is bounded by max_size.
+    def __init__(self, max_size: int = VERDICT_CACHE_SIZE, ttl: float = VERDICT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 16 bytes identifying the model the entries came from; a file written under
+        # another model is discarded on load.
+        self.model_id = bytes(16)
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: bytes) -> Optional[float]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        prob, created = entry
+        if time.time() - created > self.ttl:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return prob
+
+    def put(self, key: bytes, prob: float, created: Optional[float] = None):
+        self._entries[key] = (prob, time.time() if created is None else created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def save(self, path: Optional[str] = VERDICT_CACHE_PATH):
+        if not path:
+            return
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, self.model_id))
+                for key, (prob, created) in self._entries.items():
+                    f.write(_RECORD.pack(key, prob, created))
+            os.replace(tmp_path, path)
+            logger.info("Verdict cache saved: %d entries (hits=%d misses=%d)", len(self._entries), self.hits, self.misses)
+        except Exception:
+            logger.exception("Failed to save verdict cache to %s", path)
+
+    def load(self, path: Optional[str] = VERDICT_CACHE_PATH):
+        if not path or not os.path.exists(path):
+            return
+        now = time.time()
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) < _HEADER.size or _HEADER.unpack_from(data) != (_MAGIC, self.model_id):
+                logger.info("Verdict cache %s was written for another model, discarding it", path)
+                return
+            data = data[_HEADER.size:]
+            usable = len(data) - len(data) % _RECORD.size
+            for key, prob, created in _RECORD.iter_unpack(data[:usable]):
+                if now - created <= self.ttl:
+                    self.put(key, prob, created)
+            logger.info("Verdict cache warm start: %d entries from %s", len(self._entries), path)
+        except Exception:
+            logger.exception("Failed to load verdict cache from %s", path)
+
+    async def load_async(self, path: Optional[str] = VERDICT_CACHE_PATH):
+        # Reads the file into a fresh cache off the event loop, then swaps it in on top
+        # of whatever was scored while it loaded.
+        loaded = VerdictCache(self.max_size, self.ttl)
+        loaded.model_id = self.model_id
+        await asyncio.to_thread(loaded.load, path)
+        for key, (prob, created) in self._entries.items():
+            loaded.put(key, prob, created)
+        self._entries = loaded._entries
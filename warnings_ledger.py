@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import WARNINGS_FLUSH_INTERVAL, WARNINGS_IDLE_TTL, WARNINGS_MAX_CHATS, WARNINGS_PURGE_INTERVAL
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+
+def _decay(entry: List[int], decay: int, now: int):
+    # One warning expires per full decay window; the leftover part of the current
+    # window carries over, so each warning lives about `decay` seconds.
+    if decay > 0 and entry[0] > 0:
+        expired = min(entry[0], (now - entry[1]) // decay)
+        if expired > 0:
+            entry[0] -= expired
+            entry[1] += expired * decay
+
+
+class WarningLedger:
+    # Warning counts per (chat, user) as [count, updated_at] lists. A chat's rows are
+    # loaded on its first warning; increments and resets only touch memory and are
+    # written back in batches every flush_interval seconds, deleting rows that reach 0.
+    # Chats are kept in LRU order and, once flushed, idle or excess ones are dropped.
+    def __init__(
+        self,
+        flush_interval: float = WARNINGS_FLUSH_INTERVAL,
+        purge_interval: float = WARNINGS_PURGE_INTERVAL,
+        idle_ttl: float = WARNINGS_IDLE_TTL,
+        max_chats: int = WARNINGS_MAX_CHATS,
+    ):
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, Dict[int, List[int]]]" = OrderedDict()
+        self._used: Dict[int, float] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return sum(len(members) for members in self._chats.values())
+
+    async def _members(self, chat_id: int) -> Dict[int, List[int]]:
+        members = self._chats.get(chat_id)
+        if members is not None:
+            self._chats.move_to_end(chat_id)
+            self._used[chat_id] = time.monotonic()
+            return members
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._load(chat_id))
+            self._loading[chat_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, chat_id: int) -> Dict[int, List[int]]:
+        rows = await storage.load_warnings(chat_id)
+        members = {user_id: [count, updated_at] for user_id, count, updated_at in rows}
+        self._chats[chat_id] = members
+        self._used[chat_id] = time.monotonic()
+        return members
+
+    async def increment(self, chat_id: int, user_id: int) -> int:
+        members = await self._members(chat_id)
+        decay = (await storage.get_chat_settings(chat_id))["warn_decay"]
+        now = int(time.time())
+        entry = members.get(user_id)
+        if entry is None:
+            entry = members[user_id] = [0, now]
+        _decay(entry, decay, now)
+        if entry[0] == 0:
+            entry[1] = now
+        entry[0] += 1
+        self._dirty.add((chat_id, user_id))
+        return entry[0]
+
+    async def reset(self, chat_id: int, user_id: int):
+        members = await self._members(chat_id)
+        if members.pop(user_id, None) is not None:
+            self._dirty.add((chat_id, user_id))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        purge_at = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict()
+            if time.monotonic() >= purge_at:
+                purge_at = time.monotonic() + self.purge_interval
+                try:
+                    now = int(time.time())
+                    await self._purge_memory(now)
+                    await storage.purge_warnings(now)
+                except Exception:
+                    logger.exception("Failed to purge expired warnings")
+
+    async def _purge_memory(self, now: int):
+        # Drops fully decayed members of loaded chats; their rows go in the same purge.
+        # Unflushed members are left to flush(), which deletes rows that reach 0.
+        for chat_id in list(self._chats):
+            decay = (await storage.get_chat_settings(chat_id))["warn_decay"]
+            members = self._chats.get(chat_id)
+            if members is None:
+                continue
+            for user_id, entry in list(members.items()):
+                _decay(entry, decay, now)
+                if entry[0] <= 0 and (chat_id, user_id) not in self._dirty:
+                    del members[user_id]
+
+    def _evict(self):
+        # Oldest first; a chat with unsaved changes (failed flush) stops the sweep.
+        dirty_chats = {chat_id for chat_id, _ in self._dirty}
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._chats:
+            chat_id = next(iter(self._chats))
+            if len(self._chats) <= self.max_chats and self._used[chat_id] >= cutoff:
+                break
+            if chat_id in dirty_chats:
+                break
+            del self._chats[chat_id]
+            del self._used[chat_id]
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for chat_id, user_id in dirty:
+            entry = self._chats[chat_id].get(user_id)
+            if entry is None or entry[0] <= 0:
+                self._chats[chat_id].pop(user_id, None)
+                deletes.append((chat_id, user_id))
+            else:
+                upserts.append((chat_id, user_id, entry[0], entry[1]))
+        try:
+            await storage.save_warnings(upserts, deletes)
+        except Exception:
+            self._dirty |= dirty
+            logger.exception("Failed to save %d warning rows", len(dirty))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+warnings_ledger = WarningLedger()
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+import metrics
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_MAX_CONCURRENCY,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_SECRET,
+)
+
+logger = logging.getLogger(__name__)
+
+webhook_rejected = metrics.Counter("bot_webhook_rejected_total", "Webhook updates refused with 503 because the queue was full")
+webhook_queue_depth = metrics.Gauge("bot_webhook_queue_depth", "Webhook updates accepted but not yet processed")
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    # Acknowledges webhook requests immediately and processes updates with at most
+    # max_concurrency workers. When queue_size updates are already waiting, the request
+    # is answered with 503 so Telegram redelivers it later instead of us buffering forever.
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        max_concurrency: int = WEBHOOK_MAX_CONCURRENCY,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        process: Optional[Callable[[Bot, Dict[str, Any]], Awaitable[Any]]] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self.process = process or self._background_feed_update
+        self.accepting = True
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.process(self.bot, update)
+            except Exception:
+                logger.exception("Failed to process webhook update %s", update.get("update_id"))
+            finally:
+                self.queue.task_done()
+                webhook_queue_depth.set(self.queue.qsize())
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if not self.accepting:
+            return web.Response(status=503, text="Shutting down")
+        update = await request.json(loads=bot.session.json_loads)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            webhook_rejected.inc()
+            return web.Response(status=503, text="Overloaded", headers={"Retry-After": "1"})
+        webhook_queue_depth.set(self.queue.qsize())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def drain(self):
+        self.accepting = False
+        await self.queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def close(self):
+        # The bot session is owned and closed by main().
+        pass
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        host: str = WEBHOOK_HOST,
+        port: int = WEBHOOK_PORT,
+        path: str = WEBHOOK_PATH,
+        secret: str = WEBHOOK_SECRET,
+        **handler_kwargs: Any,
+    ):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.handler = BoundedRequestHandler(dispatcher, bot, secret_token=secret or None, **handler_kwargs)
+        self._runner: Optional[web.AppRunner] = None
+        self._site: Optional[web.TCPSite] = None
+
+    async def start(self):
+        app = web.Application()
+        self.handler.register(app, path=self.path)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        self._site = web.TCPSite(self._runner, self.host, self.port)
+        await self._site.start()
+        self.port = self._runner.addresses[0][1]
+        self.handler.start()
+        logger.info("Webhook server listening on %s:%s%s", self.host, self.port, self.path)
+
+    async def stop(self):
+        # Stop taking new requests first, then finish everything already queued.
+        self.handler.accepting = False
+        if self._site is not None:
+            await self._site.stop()
+        await self.handler.drain()
+        if self._runner is not None:
+            await self._runner.cleanup()
+        logger.info("Webhook server stopped")